@@ -0,0 +1,13 @@
+"""CONFIG>admin.py"""
+
+from django.contrib import admin
+
+from .models import UploadJob
+
+
+@admin.register(UploadJob)
+class UploadJobAdmin(admin.ModelAdmin):
+    list_display = ("path", "username", "status", "stage", "attempts", "received_at", "updated_at")
+    list_filter = ("status",)
+    search_fields = ("path", "username")
+    readonly_fields = ("received_at", "updated_at")
@@ -0,0 +1,296 @@
+"""CONFIG>authorizers.py"""
+
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+from django_ftpserver.authorizers import FTPAccountAuthorizer
+from django_ftpserver.models import FTPUserGroup
+from pyftpdlib.authorizers import AuthenticationFailed
+
+from .metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AUTH_CACHE = {
+    # seconds an FTP account read from the database (password hash, active
+    # flag, home directory, permissions) is reused; 0 disables the cache
+    "TTL": 60,
+    # accounts kept (LRU)
+    "MAX_ENTRIES": 10000,
+    # seconds between two writes of an account's last_login
+    "LAST_LOGIN_INTERVAL": 300,
+}
+
+DEFAULT_LOGIN_THROTTLE = {
+    # password checks run through the Django password hasher, per client IP:
+    # RATE per second on average, BURST at once; logins answered from the
+    # credential cache are not counted
+    "RATE": 5,
+    "BURST": 20,
+    # failed logins from one client IP within FAILURE_WINDOW seconds after
+    # which its logins are refused for BLOCK_TIME seconds without being checked
+    "MAX_FAILURES": 20,
+    "FAILURE_WINDOW": 60,
+    "BLOCK_TIME": 300,
+    # client IPs tracked (LRU)
+    "MAX_ADDRESSES": 65536,
+}
+
+THROTTLED_MESSAGE = "Too many login attempts, try again later."
+
+# What the authorizer needs of an FTP account, read with one query.
+CachedAccount = namedtuple("CachedAccount", "pk password is_active home_dir perms last_login")
+
+
+def get_auth_cache_settings():
+    conf = dict(DEFAULT_AUTH_CACHE)
+    conf.update(getattr(settings, "FTPSERVER_AUTH_CACHE", None) or {})
+    return conf
+
+
+def get_login_throttle_settings():
+    conf = dict(DEFAULT_LOGIN_THROTTLE)
+    conf.update(getattr(settings, "FTPSERVER_LOGIN_THROTTLE", None) or {})
+    return conf
+
+
+class LoginThrottle:
+    """
+    Per client IP limits on logins: a token bucket of password checks
+    (RATE per second, up to BURST) and a block of BLOCK_TIME seconds once
+    MAX_FAILURES logins failed within FAILURE_WINDOW seconds.
+    """
+
+    def __init__(self, rate=5, burst=20, max_failures=20, failure_window=60, block_time=300,
+                 max_addresses=65536):
+        self.rate = rate
+        self.burst = burst
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+        self.block_time = block_time
+        self.max_addresses = max_addresses
+        # address -> [tokens, tokens updated at, failures, window start, blocked until]
+        self._addresses = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        conf = get_login_throttle_settings()
+        return cls(
+            rate=conf["RATE"],
+            burst=conf["BURST"],
+            max_failures=conf["MAX_FAILURES"],
+            failure_window=conf["FAILURE_WINDOW"],
+            block_time=conf["BLOCK_TIME"],
+            max_addresses=conf["MAX_ADDRESSES"],
+        )
+
+    def _state(self, address, now):
+        state = self._addresses.get(address)
+        if state is None:
+            state = self._addresses[address] = [self.burst, now, 0, now, 0]
+            while len(self._addresses) > self.max_addresses:
+                self._addresses.popitem(last=False)
+        else:
+            self._addresses.move_to_end(address)
+        return state
+
+    def blocked(self, address):
+        """Return whether logins from `address` are refused."""
+        if address is None:
+            return False
+        with self._lock:
+            state = self._addresses.get(address)
+            return state is not None and state[4] > time.monotonic()
+
+    def take(self, address):
+        """Take a password check from the bucket of `address`; return
+        False if there is none left."""
+        if address is None or not self.rate:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(address, now)
+            state[0] = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            state[1] = now
+            if state[0] < 1:
+                return False
+            state[0] -= 1
+            return True
+
+    def failed(self, address):
+        if address is None or not self.max_failures:
+            return
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(address, now)
+            if now - state[3] > self.failure_window:
+                state[2], state[3] = 0, now
+            state[2] += 1
+            if state[2] >= self.max_failures:
+                state[2], state[3] = 0, now
+                state[4] = now + self.block_time
+                logger.warning("too many failed logins from %s, blocked for %ds", address, self.block_time)
+
+
+class CachedAccountAuthorizer(FTPAccountAuthorizer):
+    """
+    django_ftpserver's FTPAccountAuthorizer with the accounts it reads
+    cached, so logins and permission checks do not each query the
+    database and run the password hasher.
+
+    An account (password hash, active flag, home directory, permissions)
+    is read with one query and reused for TTL seconds. After a successful
+    password check through django.contrib.auth.authenticate(), an HMAC of
+    the password and the account's password hash is kept (the key is
+    random per process, passwords are never stored): a login with the same
+    password is accepted by comparing digests as long as the hash has not
+    changed, and a changed password or a deactivated user is noticed when
+    the account is read again. Saving or deleting a user, FTP account or
+    FTP group in this process drops the cached accounts at once; changes
+    made elsewhere (e.g. the admin site) are seen within TTL seconds.
+    last_login is written at most every LAST_LOGIN_INTERVAL seconds.
+
+    Checks that go through the hasher are rate limited per client IP, and
+    an IP with too many failed logins is refused without checking for a
+    while (LoginThrottle). Refused logins get pyftpdlib's usual delayed
+    530 reply.
+    """
+
+    def __init__(self, file_access_user=None):
+        super().__init__(file_access_user)
+        conf = get_auth_cache_settings()
+        self.ttl = conf["TTL"]
+        self.max_entries = conf["MAX_ENTRIES"]
+        self.last_login_interval = conf["LAST_LOGIN_INTERVAL"]
+        self.throttle = LoginThrottle.from_settings()
+        self._secret = os.urandom(32)
+        # username -> [expires, CachedAccount or None, credential digest]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        for sender in (get_user_model(), self.model, FTPUserGroup):
+            post_save.connect(self._changed, sender=sender)
+            post_delete.connect(self._changed, sender=sender)
+
+    # --------------------- account cache ---------------------
+
+    def _changed(self, sender, **kwargs):
+        self.invalidate()
+
+    def invalidate(self, username=None):
+        """Drop the cached account of `username`, or every cached account."""
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
+
+    def _load(self, username):
+        try:
+            account = self.model.objects.select_related("user", "group").get(**self._filter_user_by(username))
+        except self.model.DoesNotExist:
+            return None
+        return CachedAccount(
+            pk=account.pk,
+            password=account.user.password,
+            is_active=account.user.is_active,
+            home_dir=account.get_home_dir(),
+            perms=account.get_perms(),
+            last_login=account.last_login,
+        )
+
+    def _entry(self, username, reload=False):
+        """Return the [expires, account, digest] entry of `username`, read
+        from the database if it is not cached or has expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and not reload and entry[0] > now:
+                self._entries.move_to_end(username)
+                return entry
+        account = self._load(username)
+        digest = entry[2] if entry is not None else None
+        entry = [now + self.ttl, account, digest]
+        if self.ttl and self.max_entries:
+            with self._lock:
+                self._entries[username] = entry
+                self._entries.move_to_end(username)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def _account(self, username):
+        return self._entry(username)[1]
+
+    def _digest(self, account, password):
+        message = "%s\0%s" % (account.password, password)
+        return hmac.new(self._secret, message.encode("utf-8", "surrogatepass"), hashlib.sha256).digest()
+
+    # --------------------- authorizer ---------------------
+
+    def validate_authentication(self, username, password, handler):
+        address = getattr(handler, "remote_ip", None)
+        metrics = get_metrics()
+        if self.throttle.blocked(address):
+            if metrics is not None:
+                metrics.login("throttled", "failed")
+            raise AuthenticationFailed(THROTTLED_MESSAGE)
+        entry = self._entry(username)
+        account = entry[1]
+        if account is not None and account.is_active and entry[2] is not None:
+            if hmac.compare_digest(entry[2], self._digest(account, password)):
+                if metrics is not None:
+                    metrics.login("cached", "ok")
+                return
+        if not self.throttle.take(address):
+            if metrics is not None:
+                metrics.login("throttled", "failed")
+            raise AuthenticationFailed(THROTTLED_MESSAGE)
+        try:
+            super().validate_authentication(username, password, handler)
+        except AuthenticationFailed:
+            self.throttle.failed(address)
+            if metrics is not None:
+                metrics.login("hasher", "failed")
+            raise
+        if metrics is not None:
+            metrics.login("hasher", "ok")
+        # authenticate() may have upgraded the password hash
+        entry = self._entry(username, reload=True)
+        if entry[1] is not None:
+            entry[2] = self._digest(entry[1], password)
+
+    def has_user(self, username):
+        return self._account(username) is not None
+
+    def get_home_dir(self, username):
+        account = self._account(username)
+        return account.home_dir if account is not None else ''
+
+    def get_msg_login(self, username):
+        entry = self._entry(username)
+        account = entry[1]
+        if account is not None:
+            now = timezone.now()
+            last_login = account.last_login
+            if last_login is None or (now - last_login).total_seconds() >= self.last_login_interval:
+                self.model.objects.filter(pk=account.pk).update(last_login=now)
+                entry[1] = account._replace(last_login=now)
+        return 'welcome.'
+
+    def has_perm(self, username, perm, path=None):
+        account = self._account(username)
+        return account is not None and perm in account.perms
+
+    def get_perms(self, username):
+        account = self._account(username)
+        return account and account.perms
@@ -0,0 +1,274 @@
+"""CONFIG>blockcache.py"""
+
+import errno
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .offload import ProcessLocal
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_CACHE = {
+    # directory holding cached objects; empty disables the cache
+    "DIRECTORY": "",
+    # bytes per cached block (also the size of each ranged GET)
+    "BLOCK_SIZE": 1024 * 1024,
+    # bytes of blocks kept per ftpserver process before evicting objects
+    "MAX_BYTES": 1024 * 1024 * 1024,
+}
+
+
+class CachedObject:
+    """
+    Sparse local copy of one version (ETag) of a storage object.
+
+    Blocks are written with pwrite() as they are downloaded and read back
+    through a shared memory map. Once every block is present, fileno()
+    lets pyftpdlib send the file with sendfile().
+    """
+
+    def __init__(self, path, size, block_size):
+        self.path = path
+        self.size = size
+        self.block_size = block_size
+        self.blocks = bytearray((size + block_size - 1) // block_size)
+        self.cached_bytes = 0
+        self.missing = len(self.blocks)
+        self._users = 0
+        self._evicted = False
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size) if size else None
+
+    @property
+    def complete(self):
+        return not self.missing
+
+    def has(self, index):
+        return bool(self.blocks[index])
+
+    def read_block(self, index):
+        start = index * self.block_size
+        return self._map[start:min(start + self.block_size, self.size)]
+
+    def write_block(self, index, data):
+        os.pwrite(self._fd, data, index * self.block_size)
+
+    def mark(self, index, nbytes):
+        """Record block `index` as present; return the bytes added."""
+        if self.blocks[index]:
+            return 0
+        self.blocks[index] = 1
+        self.missing -= 1
+        self.cached_bytes += nbytes
+        return nbytes
+
+    def fileno(self):
+        return self._fd
+
+    def acquire(self):
+        self._users += 1
+
+    def release(self):
+        self._users -= 1
+        if self._evicted and self._users <= 0:
+            self._close()
+
+    def evict(self):
+        """Remove the file; readers still using it keep their mapping."""
+        self._evicted = True
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        if self._users <= 0:
+            self._close()
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class BlockCache:
+    """
+    Read-through on-disk cache of downloaded storage objects.
+
+    Objects are identified by the caller's key plus their ETag, so a new
+    version of an object never reuses old blocks. Space is accounted in
+    cached block bytes and reclaimed by evicting the least recently used
+    objects. Writers call invalidate() to free an object they replaced or
+    deleted right away.
+
+    Every process (e.g. each pre-forked worker) keeps its own objects in
+    a subdirectory named after its pid; directories of dead processes are
+    removed when a cache is created.
+    """
+
+    def __init__(self, directory, block_size=1024 * 1024, max_bytes=1024 * 1024 * 1024):
+        self.root = directory
+        self.directory = os.path.join(directory, str(os.getpid()))
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.miss_bytes = 0
+        self.evictions = 0
+        self._objects = OrderedDict()  # key -> (etag, CachedObject)
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._remove_stale_directories()
+
+    @classmethod
+    def from_settings(cls):
+        conf = dict(DEFAULT_BLOCK_CACHE)
+        conf.update(getattr(settings, "FTPSERVER_BLOCK_CACHE", None) or {})
+        if not conf["DIRECTORY"]:
+            return None
+        return cls(conf["DIRECTORY"], block_size=conf["BLOCK_SIZE"], max_bytes=conf["MAX_BYTES"])
+
+    def _remove_stale_directories(self):
+        for name in os.listdir(self.root):
+            if not name.isdigit() or int(name) == os.getpid():
+                continue
+            try:
+                os.kill(int(name), 0)
+            except ProcessLookupError:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            except PermissionError:
+                pass
+
+    def _path(self, key, etag):
+        digest = hashlib.sha1(repr((key, etag)).encode()).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    # --------------------- objects ---------------------
+
+    def open(self, key, etag, size):
+        """Return the CachedObject for this version of `key`, creating an
+        empty one if needed, or None if it cannot be created or is larger
+        than the whole cache (it is then read straight from the storage).
+        The caller must release() it when done."""
+        if size > self.max_bytes:
+            with self._lock:
+                if key in self._objects:
+                    self._drop(key)
+            return None
+        with self._lock:
+            current = self._objects.get(key)
+            if current is not None and current[0] == etag:
+                self._objects.move_to_end(key)
+                current[1].acquire()
+                return current[1]
+            if current is not None:
+                self._drop(key)
+            try:
+                obj = CachedObject(self._path(key, etag), size, self.block_size)
+            except OSError as err:
+                logger.warning("cannot cache %r: %s", key, err)
+                return None
+            obj.acquire()
+            self._objects[key] = (etag, obj)
+            return obj
+
+    def read(self, obj, index, count=True):
+        """Return block `index` of `obj` if cached, else None. Unless
+        `count` is False, a hit or a miss is counted."""
+        if obj.has(index):
+            data = obj.read_block(index)
+            if count:
+                self.count_hits(1, len(data))
+            return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def count_hits(self, blocks, nbytes):
+        """Count blocks served from the cache without read() (sendfile)."""
+        with self._lock:
+            self.hits += blocks
+            self.hit_bytes += nbytes
+
+    def write(self, obj, index, data):
+        """Cache block `index` of `obj`; failures (e.g. a full disk) only
+        mean the block is not cached."""
+        with self._lock:
+            self.miss_bytes += len(data)
+        if obj.has(index):
+            return
+        try:
+            obj.write_block(index, data)
+        except OSError as err:
+            if err.errno != errno.ENOSPC:
+                logger.warning("caching block %d of %r failed: %s", index, obj.path, err)
+            return
+        with self._lock:
+            added = obj.mark(index, len(data))
+            if not obj._evicted:
+                self.cached_bytes += added
+                self._evict(keep=obj)
+
+    def release(self, obj):
+        """Give back an object returned by open()."""
+        with self._lock:
+            obj.release()
+
+    def _evict(self, keep):
+        # `keep` is never larger than max_bytes (see open()), so evicting
+        # every other object is always enough
+        while self.cached_bytes > self.max_bytes and len(self._objects) > 1:
+            key, (etag, obj) = next(iter(self._objects.items()))
+            if obj is keep:
+                self._objects.move_to_end(key)
+                continue
+            self._drop(key)
+            self.evictions += 1
+
+    def _drop(self, key):
+        etag, obj = self._objects.pop(key)
+        self.cached_bytes -= obj.cached_bytes
+        obj.evict()
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._objects:
+                self._drop(key)
+
+    def invalidate_matching(self, predicate):
+        with self._lock:
+            for key in [k for k in self._objects if predicate(k)]:
+                self._drop(key)
+
+    def stats(self):
+        """Counters to size MAX_BYTES: block hits and misses, bytes served
+        from the cache and from the storage, evictions and current use."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_bytes": self.hit_bytes,
+                "miss_bytes": self.miss_bytes,
+                "evictions": self.evictions,
+                "cached_bytes": self.cached_bytes,
+                "objects": len(self._objects),
+            }
+
+
+_block_cache = ProcessLocal(BlockCache.from_settings)
+
+
+def get_block_cache():
+    """Return this process's BlockCache, or None when it is disabled."""
+    return _block_cache.get()
@@ -0,0 +1,176 @@
+"""CONFIG>bulk.py"""
+
+import contextvars
+import glob
+import logging
+import posixpath
+import threading
+from fnmatch import fnmatchcase
+
+from django.conf import settings
+
+from .offload import StorageWorkerPool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SITE_BULK = {
+    # threads per process running the files of SITE MSTAT, MDELE and MCOPY
+    "WORKERS": 16,
+    # files of one command handled at the same time
+    "CONCURRENCY": 8,
+    # files one command may name (glob matches or manifest lines)
+    "MAX_ITEMS": 10000,
+    # bytes of the largest manifest read
+    "MAX_MANIFEST_SIZE": 1024 * 1024,
+}
+
+# records read at a time from the listing a glob pattern is matched against
+LISTING_BATCH_SIZE = 1000
+
+
+def get_bulk_settings():
+    conf = dict(DEFAULT_SITE_BULK)
+    conf.update(getattr(settings, "FTPSERVER_SITE_BULK", None) or {})
+    conf["CONCURRENCY"] = max(int(conf["CONCURRENCY"]), 1)
+    return conf
+
+
+def expand(fs, spec, resolve, files_only=False, max_items=10000, max_manifest_size=1024 * 1024):
+    """
+    Return the normalized FTP paths named by `spec`.
+
+    "@<path>" reads them from the manifest file <path>, one per line
+    (blank lines and lines starting with "#" are skipped). Anything else
+    is a path whose last component may be a glob pattern, matched against
+    the listing of its directory; with `files_only`, directories do not
+    match. Relative paths are relative to the current directory.
+
+    `resolve(path, perm)` returns the filesystem path of an FTP path after
+    checking that the user has `perm` on it ("r" to read the manifest, "l"
+    to list the directory), or raises PermissionError.
+
+    Raise ValueError for a spec that cannot be used or names more than
+    `max_items` paths, and OSError when the storage fails or the user may
+    not read the manifest or list the directory.
+    """
+    if spec.startswith("@"):
+        manifest = fs.open(resolve(fs.ftpnorm(spec[1:]), "r"), "rb")
+        try:
+            data = manifest.read(max_manifest_size + 1)
+        finally:
+            manifest.close()
+        if len(data) > max_manifest_size:
+            raise ValueError("Manifest larger than %d bytes." % max_manifest_size)
+        try:
+            lines = data.decode("utf-8").splitlines()
+        except UnicodeDecodeError:
+            raise ValueError("Manifest is not UTF-8 text.")
+        paths = [fs.ftpnorm(line) for line in (line.strip() for line in lines) if line and line[0] != "#"]
+        if len(paths) > max_items:
+            raise ValueError("More than %d files." % max_items)
+        return paths
+
+    directory, pattern = posixpath.split(spec)
+    if glob.has_magic(directory):
+        raise ValueError("Globbing is only supported in the last path component.")
+    if not glob.has_magic(pattern):
+        return [fs.ftpnorm(spec)]
+    directory = fs.ftpnorm(directory or fs.cwd)
+    listing = fs.iter_listdir(resolve(directory, "l"))
+    paths = []
+    try:
+        while True:
+            entries = listing.take(LISTING_BATCH_SIZE)
+            if not entries:
+                break
+            for entry in entries:
+                if files_only and entry.is_dir:
+                    continue
+                if fnmatchcase(entry.name, pattern):
+                    paths.append(posixpath.join(directory, entry.name))
+                    if len(paths) > max_items:
+                        raise ValueError("More than %d files." % max_items)
+    finally:
+        listing.close()
+    paths.sort()
+    return paths
+
+
+class BulkJob:
+    """
+    Run `operation(item)` for every item given to start() on a
+    StorageWorkerPool, at most `concurrency` at a time, in the context of
+    the caller of start().
+
+    `on_result(item, value, error)` is called on the IOLoop as each item
+    finishes, then `on_done()` once every item ran or, after cancel(),
+    the items already started finished.
+    """
+
+    def __init__(self, pool, ioloop, operation, on_result, on_done, concurrency=8):
+        self.pool = pool
+        self.ioloop = ioloop
+        self.operation = operation
+        self.on_result = on_result
+        self.on_done = on_done
+        self.concurrency = concurrency
+        self.cancelled = False
+        self._items = None
+        self._running = 0
+        self._context = None
+
+    def start(self, items):
+        self._items = iter(items)
+        self._context = contextvars.copy_context()
+        for _ in range(self.concurrency):
+            if not self._submit_next():
+                break
+        if not self._running:
+            self.on_done()
+
+    def cancel(self):
+        """Start no more items (none at all if not started yet)."""
+        self.cancelled = True
+
+    def _submit_next(self):
+        if self.cancelled:
+            return False
+        for item in self._items:
+            self._running += 1
+            self._context.run(
+                self.pool.submit,
+                self.ioloop,
+                lambda: self.operation(item),
+                lambda future: self._finished(item, future),
+            )
+            return True
+        return False
+
+    def _finished(self, item, future):
+        self._running -= 1
+        try:
+            value, error = future.result(), None
+        except Exception as err:
+            value, error = None, err
+        try:
+            self.on_result(item, value, error)
+        finally:
+            self._submit_next()
+            if not self._running:
+                self.on_done()
+
+
+_bulk_pool = None
+_bulk_pool_lock = threading.Lock()
+
+
+def get_bulk_pool():
+    """Return the process-wide StorageWorkerPool running bulk SITE
+    commands, apart from FTPSERVER_STORAGE_WORKERS so a large bulk
+    command does not hold up the other sessions' storage calls."""
+    global _bulk_pool
+    if _bulk_pool is None:
+        with _bulk_pool_lock:
+            if _bulk_pool is None:
+                _bulk_pool = StorageWorkerPool(get_bulk_settings()["WORKERS"])
+    return _bulk_pool
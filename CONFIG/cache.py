@@ -0,0 +1,233 @@
+"""CONFIG>cache.py"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+# Stored in place of metadata when a lookup found nothing (ENOENT).
+NEGATIVE = object()
+
+# invalidation counters shared with forked workers (see Generations);
+# keys hashing to the same counter only invalidate each other
+GENERATION_SLOTS = 65536
+
+DEFAULT_METADATA_CACHE = {
+    # maximum number of stat and listing entries kept (LRU); 0 disables
+    "MAX_ENTRIES": 100000,
+    # seconds a cached stat or listing stays valid
+    "TTL": 30,
+    # seconds an ENOENT result stays valid; 0 disables negative lookups
+    "NEGATIVE_TTL": 5,
+    # listings with more names than this are not cached
+    "MAX_LISTING_SIZE": 10000,
+}
+
+
+class Generations:
+    """
+    Invalidation counters in memory shared by the processes forked after
+    it was created (the workers of PreforkFTPServer).
+
+    Every key maps to one of `slots` counters; bump() increments the
+    counters of the keys a writer changed and bump_all() a counter every
+    key depends on. An entry cached with the stamp() of its key is stale
+    once the stamp changes, whichever process made the change. Keys are
+    hashed with hash(), which gives the same result in every process
+    forked from the same parent.
+    """
+
+    def __init__(self, slots=GENERATION_SLOTS):
+        import multiprocessing
+
+        self.slots = slots
+        # counter 0 is the one bump_all() increments
+        self._counters = multiprocessing.RawArray("Q", slots + 1)
+        self._lock = multiprocessing.Lock()
+
+    def stamp(self, key):
+        return self._counters[0], self._counters[1 + hash(key) % self.slots]
+
+    def bump(self, keys):
+        with self._lock:
+            for key in keys:
+                self._counters[1 + hash(key) % self.slots] += 1
+
+    def bump_all(self):
+        with self._lock:
+            self._counters[0] += 1
+
+
+class MetadataCache:
+    """
+    Thread-safe LRU cache of storage metadata shared by every FTP session
+    of the process.
+
+    Keys are whatever the caller uses to identify a storage key (StorageFS
+    passes a (namespace, key) tuple). Two kinds of values are kept: the
+    stat of a key and the listing (list of entries, which have a `name`)
+    of a directory key. A cached listing is complete, so it also tells
+    which names do not exist in that directory.
+
+    With `generations` (see share_invalidations()), invalidations made in
+    any of the processes sharing them are seen by all: an entry whose key
+    was invalidated elsewhere since it was cached is a miss.
+    """
+
+    def __init__(self, max_entries=100000, ttl=30, negative_ttl=5, max_listing_size=10000, generations=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_listing_size = max_listing_size
+        self.generations = generations
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls, generations=None):
+        conf = dict(DEFAULT_METADATA_CACHE)
+        conf.update(getattr(settings, "FTPSERVER_METADATA_CACHE", None) or {})
+        return cls(
+            max_entries=conf["MAX_ENTRIES"],
+            ttl=conf["TTL"],
+            negative_ttl=conf["NEGATIVE_TTL"],
+            max_listing_size=conf["MAX_LISTING_SIZE"],
+            generations=generations,
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.max_entries and self.ttl)
+
+    def _get(self, entry_key):
+        with self._lock:
+            item = self._entries.get(entry_key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires, value, stamp = item
+            if expires < time.monotonic() or (
+                    self.generations is not None and self.generations.stamp(entry_key[1]) != stamp):
+                del self._entries[entry_key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_key)
+            self.hits += 1
+            return value
+
+    def _set(self, entry_key, value, ttl):
+        if not self.max_entries or not ttl:
+            return
+        stamp = self.generations.stamp(entry_key[1]) if self.generations is not None else None
+        with self._lock:
+            self._entries[entry_key] = (time.monotonic() + ttl, value, stamp)
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # --------------------- stat entries ---------------------
+
+    def get_stat(self, key):
+        """Return the cached stat for `key`, NEGATIVE, or None if unknown."""
+        return self._get(("stat", key))
+
+    def set_stat(self, key, value):
+        self._set(("stat", key), value, self.ttl)
+
+    def set_missing(self, key):
+        """Remember that `key` does not exist (if negative lookups are on)."""
+        self._set(("stat", key), NEGATIVE, self.negative_ttl)
+
+    # --------------------- directory listings ---------------------
+
+    def get_listing(self, key):
+        """Return the cached list of entries under directory `key`, or None."""
+        listing = self._get(("listing", key))
+        return list(listing[0]) if listing is not None else None
+
+    def set_listing(self, key, entries):
+        if len(entries) <= self.max_listing_size:
+            entries = tuple(entries)
+            names = frozenset(entry.name for entry in entries)
+            self._set(("listing", key), (entries, names, time.monotonic()), self.ttl)
+
+    def listing_contains(self, key, name):
+        """Return whether the cached listing of directory `key` has an entry
+        `name`, or None if `key` has no cached listing. An absent name is an
+        ENOENT result, so it is only reported while the listing is younger
+        than the negative TTL."""
+        listing = self._get(("listing", key))
+        if listing is None:
+            return None
+        if name in listing[1]:
+            return True
+        return False if listing[2] + self.negative_ttl > time.monotonic() else None
+
+    # --------------------- invalidation ---------------------
+
+    def invalidate(self, key, parents=()):
+        """Drop the stat and listing of `key` and of every key in `parents`.
+
+        Writers pass all ancestors of the key they changed so that parent
+        listings, and negative entries for directories that now exist
+        implicitly, are not served stale.
+        """
+        if self.generations is not None:
+            self.generations.bump((key,) + tuple(parents))
+        with self._lock:
+            for k in (key,) + tuple(parents):
+                self._entries.pop(("stat", k), None)
+                self._entries.pop(("listing", k), None)
+
+    def invalidate_matching(self, predicate):
+        """Drop every entry whose key satisfies `predicate`, e.g. all keys
+        under a directory that was removed or renamed as a whole. Other
+        processes sharing the generations drop all their entries."""
+        if self.generations is not None:
+            self.generations.bump_all()
+        with self._lock:
+            for entry_key in [k for k in self._entries if predicate(k[1])]:
+                del self._entries[entry_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Lookups answered from the cache (hits) or not (misses), and the
+        number of entries held."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+_metadata_cache = None
+_metadata_cache_lock = threading.Lock()
+_generations = None
+
+
+def get_metadata_cache():
+    """Return the process-wide MetadataCache configured from settings."""
+    global _metadata_cache
+    if _metadata_cache is None:
+        with _metadata_cache_lock:
+            if _metadata_cache is None:
+                _metadata_cache = MetadataCache.from_settings(_generations)
+    return _metadata_cache
+
+
+def share_invalidations():
+    """
+    Make the invalidations of the process-wide MetadataCache reach the
+    processes forked from now on, and theirs reach it: a client never
+    reads, from any worker, metadata cached before its own write. Called
+    by the parent of pre-forked workers before it forks them.
+    """
+    global _generations
+    with _metadata_cache_lock:
+        if _generations is None:
+            _generations = Generations()
+        if _metadata_cache is not None:
+            _metadata_cache.generations = _generations
@@ -0,0 +1,99 @@
+"""CONFIG>checksums.py"""
+
+import hashlib
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKSUMS = {
+    # compute checksums of S3 uploads while they stream, store them with
+    # the object and verify the stored object against them; off by default
+    "ENABLED": False,
+    # checksums computed for every upload; "crc32c" needs the awscrt
+    # package (pip install "botocore[crt]") and is left out without it
+    "ALGORITHMS": ["md5", "sha256", "crc32c"],
+}
+
+# checksums are stored under "<prefix><algorithm>" in the object's user
+# metadata (x-amz-meta-ftp-sha256) or tags
+STORED_PREFIX = "ftp-"
+
+# HASH command algorithm names (draft-bryan-ftpext-hash) -> our names
+HASH_ALGORITHMS = {
+    "MD5": "md5",
+    "SHA-1": "sha1",
+    "SHA-256": "sha256",
+    "SHA-512": "sha512",
+}
+
+# bytes read at a time when a checksum has to be computed from the file
+READ_SIZE = 1024 * 1024
+
+try:
+    from awscrt.checksums import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+
+def get_checksum_settings():
+    conf = dict(DEFAULT_CHECKSUMS)
+    conf.update(getattr(settings, "FTPSERVER_CHECKSUMS", None) or {})
+    algorithms = []
+    for algorithm in conf["ALGORITHMS"]:
+        if algorithm == "crc32c" and _crc32c is None:
+            logger.debug("crc32c checksums need the awscrt package; skipped")
+        elif algorithm == "crc32c" or algorithm in hashlib.algorithms_available:
+            algorithms.append(algorithm)
+        else:
+            logger.warning("unknown checksum algorithm %r ignored", algorithm)
+    conf["ALGORITHMS"] = algorithms
+    return conf
+
+
+class _CRC32C:
+    """hashlib-style wrapper of awscrt's CRC32C."""
+
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        self._crc = _crc32c(data, self._crc)
+
+    def hexdigest(self):
+        return "%08x" % self._crc
+
+
+def new(algorithm):
+    """Return a hashlib-style object computing `algorithm`."""
+    if algorithm == "crc32c":
+        if _crc32c is None:
+            raise ValueError("crc32c needs the awscrt package")
+        return _CRC32C()
+    return hashlib.new(algorithm)
+
+
+class StreamChecksums:
+    """Several checksums of one byte stream, updated together."""
+
+    def __init__(self, algorithms):
+        self._hashes = {algorithm: new(algorithm) for algorithm in algorithms}
+
+    def update(self, data):
+        for checksum in self._hashes.values():
+            checksum.update(data)
+
+    def hexdigests(self):
+        return {algorithm: checksum.hexdigest() for algorithm, checksum in self._hashes.items()}
+
+
+def file_checksum(fileobj, algorithm):
+    """Compute the hex `algorithm` checksum of what is left to read in
+    `fileobj`."""
+    checksum = new(algorithm)
+    while True:
+        data = fileobj.read(READ_SIZE)
+        if not data:
+            return checksum.hexdigest()
+        checksum.update(data)
@@ -0,0 +1,100 @@
+"""CONFIG>clients.py"""
+
+import logging
+import threading
+
+from django.conf import settings
+
+from .offload import ProcessLocal
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORAGE_CLIENT = {
+    # share one storage instance (and, on S3, one boto3 client with its
+    # connection pool) between all the sessions of a process that use the
+    # same storage options; off: one instance per FTP session
+    "SHARED": True,
+    # HTTP connections the S3 client keeps open for reuse (botocore: 10)
+    "MAX_POOL_CONNECTIONS": 50,
+    # SO_KEEPALIVE on S3 connections, so idle pooled connections are not
+    # silently dropped by NAT gateways and load balancers
+    "TCP_KEEPALIVE": True,
+    # storage constructor options per FTP user, e.g.
+    # {"alice": {"bucket_name": "alice-data", "location": ""}}
+    "USER_OPTIONS": {},
+}
+
+
+def get_client_settings():
+    conf = dict(DEFAULT_STORAGE_CLIENT)
+    conf.update(getattr(settings, "FTPSERVER_STORAGE_CLIENT", None) or {})
+    return conf
+
+
+class _SharedConnections(threading.local):
+    """
+    Stand-in for S3Boto3Storage._connections: every thread gets its own
+    S3 resource object (resources are not thread-safe) built around one
+    shared client (clients are), so all threads use one connection pool.
+    """
+
+    def __init__(self, resource):
+        self.connection = type(resource)(client=resource.meta.client)
+
+
+def _configure_s3(storage, conf):
+    from botocore.config import Config
+
+    storage.client_config = storage.client_config.merge(Config(
+        max_pool_connections=conf["MAX_POOL_CONNECTIONS"],
+        tcp_keepalive=conf["TCP_KEEPALIVE"],
+    ))
+    if conf["SHARED"]:
+        # credentials are resolved and the client is built once, here
+        storage._connections = _SharedConnections(storage.connection)
+
+
+def create_storage(storage_class, options=None, conf=None):
+    """Instantiate `storage_class` with `options`, tuned for long-lived use
+    by FTP sessions (instrumented when metrics are enabled, its requests
+    limited when FTPSERVER_QOS is)."""
+    from .metrics import get_metrics
+    from .qos import get_qos
+
+    conf = conf or get_client_settings()
+    storage = storage_class(**(options or {}))
+    if hasattr(storage, "client_config") and hasattr(storage, "_connections"):
+        _configure_s3(storage, conf)
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.instrument_storage(storage)
+    qos = get_qos()
+    if qos is not None:
+        qos.limit_storage(storage)
+    return storage
+
+
+_storages = ProcessLocal(dict)
+_storages_lock = threading.Lock()
+
+
+def get_storage(storage_class, options=None):
+    """
+    Return the storage instance FTP sessions using `storage_class` with
+    `options` should use: shared by the whole process (per forked worker)
+    when FTPSERVER_STORAGE_CLIENT['SHARED'] is on, a new one otherwise.
+    """
+    conf = get_client_settings()
+    if not conf["SHARED"]:
+        return create_storage(storage_class, options, conf)
+    key = (storage_class, repr(sorted((options or {}).items())))
+    storages = _storages.get()
+    storage = storages.get(key)
+    if storage is None:
+        with _storages_lock:
+            storage = storages.get(key)
+            if storage is None:
+                storage = create_storage(storage_class, options, conf)
+                storages[key] = storage
+                logger.debug("created shared %s storage %r", storage_class.__name__, options or {})
+    return storage
@@ -4,11 +4,23 @@ import logging
 import time
 import os
 import errno
-from collections import namedtuple
+import shutil
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_ISDIR
 
 from pyftpdlib.filesystems import AbstractedFS
 from django.conf import settings
 
+from . import s3ops
+from .blockcache import get_block_cache
+from .cache import NEGATIVE, get_metadata_cache
+from .checksums import file_checksum
+from .clients import get_client_settings, get_storage
+from .nsindex import get_namespace_index
+from .paths import get_path_translator
+from .streams import S3MultipartWriter, S3RangeReader
+
 logger = logging.getLogger(__name__)
 
 PseudoStat = namedtuple(
@@ -25,6 +37,185 @@ PseudoStat = namedtuple(
     ],
 )
 
+# Metadata learned from a directory listing. `size` and `mtime` are None
+# when the backend listing does not report them.
+ListingEntry = namedtuple("ListingEntry", ["name", "is_dir", "size", "mtime"])
+CachedStat = namedtuple("CachedStat", ["is_dir", "size", "mtime"])
+# returned by StorageFS._cached_stat() for a cached ENOENT result
+MISSING = CachedStat(None, None, None)
+DIRECTORY = CachedStat(True, 0, 0)
+
+# bytes read at a time by StorageFS.copy()
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+# ---- listing order ----
+#
+# Storages list a directory page by page, every page holding its
+# directories then its files, the pages following each other in key
+# order (S3 lists the directory "data" as the prefix "data/", so after
+# "data.csv" and "data-2", possibly on a later page). pyftpdlib sends LIST
+# and NLST sorted by name and MLSD in the order listdir() returns, with
+# every directory first.
+
+
+def _listing_key(entry):
+    return entry.name + "/" if entry.is_dir else entry.name
+
+
+def _may_be_preceded(name, last):
+    """Tell whether a directory listed after the key `last` could still
+    sort before `name`: "data" comes before "data.csv" only because "."
+    sorts before "/"."""
+    for i, char in enumerate(name):
+        if char < "/" and name[:i] + "/" > last:
+            return True
+    return False
+
+
+def by_name(pages):
+    """Yield the entries of `pages` sorted by name, a page per page of
+    `pages` (then the rest): entries a directory on a later page could
+    still precede are held back until that page has been read."""
+    held, last = [], ""
+    for page in pages:
+        if page:
+            last = max(map(_listing_key, page))
+            held += page
+            held.sort(key=lambda entry: entry.name)
+        # the entries held back are always the last ones
+        ready, end = 0, len(held)
+        while ready < end:
+            middle = (ready + end) // 2
+            if _may_be_preceded(held[middle].name, last):
+                end = middle
+            else:
+                ready = middle + 1
+        yield held[:ready]
+        del held[:ready]
+    yield held
+
+
+def directories_first(pages):
+    """Yield the entries of `pages` with every directory before every
+    file: directories as their page arrives, files after the last one."""
+    files = []
+    for page in pages:
+        yield [entry for entry in page if entry.is_dir]
+        files += [entry for entry in page if not entry.is_dir]
+    yield files
+
+
+class DirectoryListing:
+    """
+    Iterator over the names of a directory, read from the storage one
+    page at a time.
+
+    `first` holds the ListingEntry records of the first page, read by the
+    caller so that a missing directory fails before anything is sent;
+    `pages` yields the records of the following pages, which are read
+    ahead on a background thread while the current page is consumed.
+    Only the current page and the next one are held in memory.
+
+    ready() tells whether next() can return without waiting for the
+    storage, so the data channel can pause instead of blocking the
+    IOLoop. take() returns the records themselves, a batch at a time.
+    """
+
+    def __init__(self, first, pages=()):
+        self._entries = deque(first)
+        self._pages = iter(pages)
+        self._next_page = None
+        self._executor = None
+        self._done = pages == ()
+        self._fetch()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._entries:
+            if self._done:
+                raise StopIteration
+            self._take(self._next_page)
+        return self._entries.popleft().name
+
+    def take(self, limit):
+        """Return up to `limit` records: those already read or, if there
+        are none, those of the next page (waiting for it). An empty list
+        means the listing is over."""
+        entries = self._entries
+        while not entries:
+            if self._done:
+                return []
+            self._take(self._next_page)
+        if len(entries) <= limit:
+            batch = list(entries)
+            entries.clear()
+            return batch
+        return [entries.popleft() for _ in range(limit)]
+
+    def ready(self):
+        if self._entries or self._done:
+            return True
+        if self._next_page.done():
+            self._take(self._next_page)
+            return True
+        return False
+
+    def _fetch(self):
+        if self._done or self._next_page is not None:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-listing")
+        self._next_page = self._executor.submit(next, self._pages, None)
+
+    def _take(self, future):
+        self._next_page = None
+        try:
+            page = future.result()
+        except Exception as err:
+            self.close()
+            raise OSError(errno.EIO, "Listing from storage failed: %s" % err)
+        if page is None:
+            self.close()
+            return
+        self._entries.extend(page)
+        self._fetch()
+
+    def close(self):
+        self._done = True
+        if self._next_page is not None:
+            self._next_page.cancel()
+            self._next_page = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class WrittenFile:
+    """
+    File object opened for writing by StorageFS: `on_close()` is called
+    once the file is closed, so that metadata cached while it was being
+    written (e.g. a listing made by another session) does not outlive
+    the upload. Everything else is the wrapped file's.
+    """
+
+    def __init__(self, file, on_close):
+        self._file = file
+        self._on_close = on_close
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def close(self):
+        try:
+            self._file.close()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close()
+
 
 class StoragePatch:
     """Base class for patches to StorageFS."""
@@ -43,111 +234,355 @@ class StoragePatch:
 
 
 class FileSystemStoragePatch(StoragePatch):
-    patch_methods = ("mkdir", "rmdir", "stat")
+    """
+    Local storage: files are opened and stat'ed directly at
+    storage.path(), without going through the storage API.
+    """
+
+    patch_methods = (
+        "open", "mkdir", "rmdir", "stat", "isfile", "isdir", "getsize", "getmtime", "lexists", "_list_entries",
+    )
+
+    def open(self, filename, mode="rb"):
+        # a plain file object, not a django File proxying every read() and
+        # write() of the data channel; RETR uses sendfile() on it
+        key = self._storage_key(filename)
+        if not any(c in mode for c in "wa+"):
+            return open(self.storage.path(key), mode)
+        self._forget(key)
+        return WrittenFile(open(self.storage.path(key), mode), lambda: self._forget(key))
 
     def mkdir(self, path):
         # allow the path to be a filesystem path or ftp-style
-        ftp_path = self._ensure_ftp_path(path) if hasattr(self, '_ensure_ftp_path') else path
+        ftp_path = self._ensure_ftp_path(path)
         self.storage.save(self._storage_name(ftp_path).rstrip("/") + "/", b"")
 
     def rmdir(self, path):
         # local filesystem storage: delegate to os.rmdir if storage exposes path
         if hasattr(self.storage, "path"):
-            ftp_path = self._ensure_ftp_path(path) if hasattr(self, '_ensure_ftp_path') else path
-            os.rmdir(self.storage.path(self._storage_name(ftp_path)))
+            ftp_path = self._ensure_ftp_path(path)
+            key = self._storage_name(ftp_path)
+            self._forget(key, tree=True)
+            if getattr(settings, "FTPSERVER_RECURSIVE_RMD", False):
+                if not key.strip("/"):
+                    raise OSError(errno.EPERM, "Operation not permitted", path)
+                shutil.rmtree(self.storage.path(key))
+            else:
+                os.rmdir(self.storage.path(key))
         else:
             # fallback: try deleting placeholder directory if any
             raise NotImplementedError("rmdir not supported for this storage")
 
     def stat(self, path):
-        ftp_path = self._ensure_ftp_path(path) if hasattr(self, '_ensure_ftp_path') else path
+        ftp_path = self._ensure_ftp_path(path)
         return os.stat(self.storage.path(self._storage_name(ftp_path)))
 
+    # storage.exists() cannot tell files from directories: path() drops
+    # the trailing slash StorageFS relies on
+
+    def isfile(self, path):
+        if path in (None, "", "/"):
+            return False
+        return os.path.isfile(self.storage.path(self._storage_key(path)))
+
+    def isdir(self, path):
+        return os.path.isdir(self.storage.path(self._storage_key(path)))
+
+    # one os.stat() instead of the isdir() then size()/get_modified_time()
+    # round of StorageFS; directories still report 0 for both
+
+    def getsize(self, path):
+        st = os.stat(self.storage.path(self._storage_key(path)))
+        return 0 if S_ISDIR(st.st_mode) else st.st_size
+
+    def getmtime(self, path):
+        st = os.stat(self.storage.path(self._storage_key(path)))
+        return 0 if S_ISDIR(st.st_mode) else int(st.st_mtime)
+
+    def lexists(self, path):
+        return os.path.lexists(self.storage.path(self._storage_key(path)))
+
+    def _list_entries(self, key):
+        # directories first, as Django's listdir() returns them, with the
+        # size and mtime of regular files; anything else is left for
+        # stat() to skip
+        directories, files = [], []
+        with os.scandir(self.storage.path(key)) as it:
+            for entry in it:
+                if entry.is_dir():
+                    directories.append(ListingEntry(entry.name, True, 0, 0))
+                    continue
+                size = mtime = None
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        size, mtime = st.st_size, int(st.st_mtime)
+                except OSError:
+                    pass
+                files.append(ListingEntry(entry.name, False, size, mtime))
+        return directories + files
+
 
 class S3Boto3StoragePatch(StoragePatch):
-    patch_methods = ("_exists", "isdir", "getmtime", "isfile")
+    patch_methods = (
+        "_exists", "_lookup", "isdir", "getmtime", "isfile", "_list_entries", "_iter_entry_pages", "open",
+        "lexists", "mkdir", "rename", "copy", "rmdir", "checksum",
+    )
+
+    @classmethod
+    def apply(cls, fs):
+        super().apply(fs)
+        fs.namespace_index = get_namespace_index(fs.storage, fs._cache_namespace)
+
+    def open(self, filename, mode="rb"):
+        """Stream downloads (RETR) and uploads (STOR) straight from and to
+        S3 instead of spooling whole objects to a temporary file."""
+        key = self._storage_key(filename)
+        if mode == "rb":
+            return S3RangeReader(
+                self.storage, key, cache=self.block_cache, cache_key=self._cache_key(key)
+            )
+        if mode == "wb":
+            self._forget(key)
+            return S3MultipartWriter(self.storage, key, on_complete=self._upload_done(key))
+        return self._origin_open(filename, mode)
+
+    def lexists(self, path):
+        if self._ensure_ftp_path(path) in ("/", ""):
+            return True
+        return self._lookup(path) is not MISSING
+
+    def checksum(self, path, algorithm):
+        """Use the checksum stored with the object (see S3MultipartWriter
+        and s3ops.stored_checksums) and only read the object without one."""
+        try:
+            stored = s3ops.stored_checksums(self.storage, self._storage_key(path))
+        except Exception as e:
+            logger.debug("reading the checksums of %r failed: %s", path, e)
+            stored = {}
+        if algorithm in stored:
+            return stored[algorithm]
+        return self._origin_checksum(path, algorithm)
+
+    def mkdir(self, path):
+        """Create the directory marker "key/" so that the new directory
+        exists while it is still empty."""
+        key = self._storage_key(path).rstrip("/")
+        if not key or self.lexists(path):
+            raise OSError(errno.EEXIST, "File exists", path)
+        self._forget(key)
+        try:
+            s3ops.create_marker(self.storage, key)
+        except Exception as e:
+            logger.debug("mkdir failed: %s", e)
+            raise OSError(errno.EACCES, "Cannot create directory", path)
+        self.metadata_cache.set_stat(self._cache_key(key), DIRECTORY)
+        self._indexed("put", key + "/", 0)
+
+    def rename(self, src, dst):
+        """Rename with server-side copies, so no data goes through the FTP
+        server. A directory is renamed by moving every key under it."""
+        src_key = self._storage_key(src).rstrip("/")
+        dst_key = self._storage_key(dst).rstrip("/")
+        if not src_key or not dst_key:
+            raise OSError(errno.EPERM, "Operation not permitted", dst)
+        self._forget(src_key)
+        self._forget(dst_key)
+        moved = None
+        try:
+            if self.isfile(src):
+                if self.isdir(dst):
+                    raise OSError(errno.EISDIR, "Is a directory", dst)
+                moved = "refresh"
+                s3ops.rename_object(self.storage, src_key, dst_key)
+            elif self.isdir(src):
+                if dst_key == src_key or dst_key.startswith(src_key + "/"):
+                    raise OSError(errno.EINVAL, "Invalid argument", dst)
+                if self.lexists(dst):
+                    raise OSError(errno.EEXIST, "File exists", dst)
+                moved = "rescan"
+                src_key, dst_key = src_key + "/", dst_key + "/"
+                s3ops.rename_prefix(self.storage, src_key.rstrip("/"), dst_key.rstrip("/"))
+            else:
+                raise OSError(errno.ENOENT, "No such file or directory", src)
+        finally:
+            # the checks above may have cached what is now stale
+            self._forget(src_key, tree=True)
+            self._forget(dst_key, tree=True)
+            if moved is not None:
+                # read back whatever the (possibly failed) move left behind
+                self._indexed(moved, src_key)
+                self._indexed(moved, dst_key)
+
+    def copy(self, src, dst):
+        """Copy with a server-side copy, so no data goes through the FTP
+        server."""
+        src_key, dst_key = self._check_copy(src, dst)
+        self._forget(dst_key)
+        try:
+            s3ops.copy_object(
+                self.storage, s3ops.s3_key(self.storage, src_key), s3ops.s3_key(self.storage, dst_key)
+            )
+        finally:
+            self._forget(dst_key)
+            self._indexed("refresh", dst_key)
+
+    def rmdir(self, path):
+        """With FTPSERVER_RECURSIVE_RMD, remove the directory together with
+        every object under it (see s3ops.delete_prefix). Otherwise only its
+        placeholder is deleted."""
+        if not getattr(settings, "FTPSERVER_RECURSIVE_RMD", False):
+            return self._origin_rmdir(path)
+        key = self._storage_key(path).rstrip("/")
+        if not key:
+            raise OSError(errno.EPERM, "Operation not permitted", path)
+        if not self.isdir(path):
+            if self.isfile(path):
+                raise OSError(errno.ENOTDIR, "Not a directory", path)
+            raise OSError(errno.ENOENT, "No such file or directory", path)
+        try:
+            s3ops.delete_prefix(self.storage, key)
+        finally:
+            self._forget(key, tree=True)
+            self._indexed("rescan", key + "/")
+
+    def _list_entries(self, key):
+        return [entry for entries in self._iter_entry_pages(key) for entry in entries]
+
+    def _iter_entry_pages(self, key):
+        """List `key` with ListObjectsV2, yielding each page as soon as it
+        arrives and keeping the size and mtime S3 already returns for every
+        object. Every page holds its directories, then its files, and
+        pages follow each other in key order, as S3 returns them.
+
+        Once the namespace index is ready, the listing is read from it
+        instead."""
+        from storages.utils import clean_name
+
+        index = self._ready_index()
+        if index is not None:
+            for entries in index.listing(key):
+                yield [ListingEntry(*entry) for entry in entries]
+            return
+
+        prefix = self.storage._normalize_name(clean_name(key))
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        client = s3ops.get_client(self.storage)
+        paginator = client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.storage.bucket_name, Delimiter="/", Prefix=prefix):
+            entries = []
+            for entry in page.get("CommonPrefixes", ()):
+                name = entry["Prefix"][len(prefix):].rstrip("/")
+                if name:
+                    entries.append(ListingEntry(name, True, 0, 0))
+            for entry in page.get("Contents", ()):
+                name = entry["Key"][len(prefix):]
+                if name:
+                    mtime = int(entry["LastModified"].timestamp())
+                    entries.append(ListingEntry(name, False, entry["Size"], mtime))
+            yield entries
 
     def _exists(self, path):
-        ftp_path = self._ensure_ftp_path(path) if hasattr(self, '_ensure_ftp_path') else path
+        ftp_path = self._ensure_ftp_path(path)
         # For paths ending with slash, check if it's a valid directory prefix
         if ftp_path.endswith("/"):
-            key = self._storage_name(ftp_path) if hasattr(self, '_storage_name') else ftp_path
+            key = self._storage_name(ftp_path)
             if not key:  # root
                 return True
             try:
-                dirs, files = self.storage.listdir(key)
-                return bool(dirs or files)
+                return s3ops.prefix_exists(self.storage, key.rstrip("/"))
             except Exception:
                 return False
         return self.storage.exists(self._storage_name(ftp_path))
 
+    def _lookup(self, path):
+        """Answer from the metadata cache when it knows `path`; otherwise
+        find out with one request (s3ops.probe_key) and remember the
+        answer, including the size and mtime of a file."""
+        cached = self._cached_stat(path)
+        if cached is not None:
+            return cached
+        key = self._storage_key(path).rstrip("/")
+        try:
+            found = s3ops.probe_key(self.storage, key)
+        except Exception as e:
+            # If we can't list it, it's not a valid path
+            logger.debug("probing %r failed: %s", key, e)
+            return MISSING
+        if found is None:
+            self.metadata_cache.set_missing(self._cache_key(key))
+            return MISSING
+        found = CachedStat(*found)
+        self.metadata_cache.set_stat(self._cache_key(key), found)
+        return found
+
     def isfile(self, path):
         """Check if path is a file in S3."""
         if path in (None, "", "/"):
             return False
-        ftp_path = self._ensure_ftp_path(path) if hasattr(self, '_ensure_ftp_path') else path
+        ftp_path = self._ensure_ftp_path(path)
         # Paths ending with / are never files
         if ftp_path.endswith("/"):
             return False
-        # Check if the object exists in S3
-        key = self._storage_name(ftp_path) if hasattr(self, '_storage_name') else ftp_path
-        return self.storage.exists(key)
+        return self._lookup(ftp_path).is_dir is False
 
     def isdir(self, path):
-        """Check if path is a directory in S3 by checking for common prefixes."""
-        ftp_path = self._ensure_ftp_path(path) if hasattr(self, '_ensure_ftp_path') else path
+        """Check if path is a directory in S3: a "key/" marker or objects
+        under the prefix."""
+        ftp_path = self._ensure_ftp_path(path)
 
         # Root is always a directory
         if ftp_path in ("/", ""):
             return True
-
-        # Remove trailing slash for checking
-        ftp_path_clean = ftp_path.rstrip("/")
-
-        # If it's explicitly a file, it's not a directory
-        if self.isfile(ftp_path_clean):
-            return False
-
-        # Check if there are any objects under this prefix (common prefix check)
-        key = self._storage_name(ftp_path_clean)
-        if key and not key.endswith("/"):
-            key = key + "/"
-
-        try:
-            # Check if there are any files or subdirectories under this path
-            dirs, files = self.storage.listdir(key)
-            return bool(dirs or files)
-        except Exception:
-            # If we can't list it, it's not a valid directory
-            return False
+        return bool(self._lookup(ftp_path.rstrip("/")).is_dir)
 
     def getmtime(self, path):
-        if self.isdir(path):
-            return 0
-        ftp_path = self._ensure_ftp_path(path) if hasattr(self, '_ensure_ftp_path') else path
-        return self._origin_getmtime(self._storage_name(ftp_path))
+        found = self._lookup(path)
+        if found is MISSING:
+            raise OSError(errno.ENOENT, "No such file", path)
+        if found.mtime is not None:
+            return found.mtime
+        return self._origin_getmtime(self._ensure_ftp_path(path))
 
 
 class DjangoGCloudStoragePatch(StoragePatch):
     patch_methods = ("_exists", "isdir", "getmtime", "listdir")
 
     def _exists(self, path):
-        ftp_path = self._ensure_ftp_path(path) if hasattr(self, '_ensure_ftp_path') else path
+        ftp_path = self._ensure_ftp_path(path)
         if ftp_path.endswith("/"):
             return True
         return self.storage.exists(self._storage_name(ftp_path))
 
     def isdir(self, path):
-        return not self.isfile(path)
+        cached = self._cached_stat(path)
+        if cached is not None:
+            return bool(cached.is_dir)
+        key = self._storage_key(path).rstrip("/")
+        if not key:
+            return True
+        if self.isfile(path):
+            return False
+        # a "key/" marker, or anything stored under the prefix
+        found = self.storage.exists(key + "/") or any(self.storage.listdir(key + "/"))
+        if found:
+            self.metadata_cache.set_stat(self._cache_key(key), DIRECTORY)
+        else:
+            self.metadata_cache.set_missing(self._cache_key(key))
+        return found
 
     def getmtime(self, path):
+        cached = self._cached_stat(path)
+        if cached is not None and cached.mtime is not None:
+            return cached.mtime
         if self.isdir(path):
             return 0
-        ftp_path = self._ensure_ftp_path(path) if hasattr(self, '_ensure_ftp_path') else path
+        ftp_path = self._ensure_ftp_path(path)
         return self._origin_getmtime(ftp_path)
 
     def listdir(self, path):
-        ftp_path = self._ensure_ftp_path(path) if hasattr(self, '_ensure_ftp_path') else path
+        ftp_path = self._ensure_ftp_path(path)
         if not ftp_path.endswith("/"):
             ftp_path += "/"
         return self._origin_listdir(self._storage_name(ftp_path))
@@ -162,6 +597,9 @@ class StorageFS(AbstractedFS):
     """
 
     storage_class = None
+    # CONFIG.nsindex.NamespaceIndex of the storage, set by the patches of
+    # storages that have one
+    namespace_index = None
     patches = {
         "FileSystemStorage": FileSystemStoragePatch,
         "S3Boto3Storage": S3Boto3StoragePatch,
@@ -187,11 +625,32 @@ class StorageFS(AbstractedFS):
         super(StorageFS, self).__init__(root, cmd_channel)
         # set FTP cwd to root (FTP-style)
         self._cwd = "/"
+        self._paths = get_path_translator(root)
         self.storage = self.get_storage()
+        self.metadata_cache = get_metadata_cache()
+        self.block_cache = get_block_cache()
+        self._cache_namespace = self.get_cache_namespace()
         self.apply_patch()
 
-    def get_storage_class(self):
-        if self.storage_class is None:
+    @classmethod
+    def warm_up(cls, root=None):
+        """
+        Get the storage backend ready before the first login instead of
+        during it: import the storage class (on S3, boto3) and create the
+        storage the sessions of this process share (on S3, resolve the
+        credentials and build the client). With `root`, also create a
+        filesystem on it, which sets up the rest of what sessions share:
+        the caches and the namespace index with its background thread, so
+        not in a process that is going to fork.
+        """
+        if root is None:
+            get_storage(cls.get_storage_class(), {})
+        else:
+            cls(root, None)
+
+    @classmethod
+    def get_storage_class(cls):
+        if cls.storage_class is None:
             # In Django < 6 a helper named `get_storage_class` may be available.
             # Newer Django versions removed that exported helper; prefer reading
             # DEFAULT_FILE_STORAGE or STORAGES settings and import the backend
@@ -223,58 +682,43 @@ class StorageFS(AbstractedFS):
                 # final fallback to default FileSystemStorage
                 from django.core.files.storage import FileSystemStorage
                 return FileSystemStorage
-        return self.storage_class
+        return cls.storage_class
 
     def get_storage(self):
-        storage_class = self.get_storage_class()
-        return storage_class()
+        return get_storage(self.get_storage_class(), self.get_storage_options())
+
+    def get_storage_options(self):
+        """Storage constructor options for the logged-in user, from
+        FTPSERVER_STORAGE_CLIENT['USER_OPTIONS']."""
+        username = getattr(self.cmd_channel, "username", None)
+        return get_client_settings()["USER_OPTIONS"].get(username) or {}
+
+    def get_cache_namespace(self):
+        """Identify the storage in the shared metadata cache so sessions
+        using different backends, buckets or locations never share keys."""
+        cls = self.storage.__class__
+        return "%s.%s:%s:%s" % (
+            cls.__module__,
+            cls.__name__,
+            getattr(self.storage, "bucket_name", ""),
+            getattr(self.storage, "location", ""),
+        )
 
     # --------------------- path helpers ---------------------
 
-    def _make_ftp_path(self, path):
-        """Return an FTP-style path (always begins with '/' except root '').
-
-        Accepts either an absolute FTP path (starts with '/') or a
-        relative name and joins with current _cwd.
-        """
-        if path is None or path == "":
-            return "/"
-        if path.startswith("/"):
-            return path if path != "" else "/"
-        # relative path
-        base = self._cwd if self._cwd not in (None, "") else "/"
-        if base.endswith("/"):
-            return base + path.lstrip("/")
-        return base + "/" + path.lstrip("/")
-
     def _ensure_ftp_path(self, path):
         """
         Accept either a real filesystem path (as passed by pyftpdlib
         handlers) or an FTP-style path and return an FTP-style path.
 
         - If `path` is a filesystem path under self.root, convert it
-          to an FTP-style path using fs2ftp.
+          to an FTP-style path.
         - Otherwise assume the argument is already an FTP-style path
-          and normalize it via _make_ftp_path.
+          (absolute, or relative to the current directory).
+
+        See CONFIG.paths.PathTranslator, which memoises the conversion.
         """
-        # default: root and variants
-        if path in (None, "", "/"):
-            return "/"
-        # If path looks like an absolute real filesystem path and starts
-        # with the configured root, convert it back to ftp style.
-        try:
-            if os.path.isabs(path) and self.root and os.path.normpath(path).startswith(os.path.normpath(self.root)):
-                # compute relative path to root without calling fs2ftp to avoid recursion
-                rel = os.path.relpath(path, self.root)
-                # rel may be '.' if path == root
-                if rel in ('.', ''):
-                    return "/"
-                # Always return slash-prefixed ftp-style path with POSIX separators
-                return "/" + rel.replace(os.sep, "/")
-        except Exception:
-            # fallback to ftp style
-            pass
-        return self._make_ftp_path(path)
+        return self._paths.ftp_path(path, self._cwd)
 
     def _storage_name(self, ftp_path):
         """
@@ -285,31 +729,142 @@ class StorageFS(AbstractedFS):
         - if the ftp_path contains local MEDIA_ROOT segments, make it relative
           to MEDIA_ROOT so absolute local paths don't leak into S3 keys.
         """
-        if ftp_path in (None, "", "/"):
-            return ""
+        return self._paths.storage_name(ftp_path)
+
+    def _storage_key(self, path):
+        """Return the storage key of `path` (any form _ensure_ftp_path accepts)."""
+        return self._paths.storage_name(self._paths.ftp_path(path, self._cwd))
 
-        # ensure ftp_path is ftp-style
-        if not ftp_path.startswith("/"):
-            ftp_path = "/" + ftp_path
+    # --------------------- metadata cache ---------------------
 
-        name = ftp_path.lstrip("/")
+    def _cache_key(self, key):
+        """Return the shared metadata cache key for the storage key `key`."""
+        return (self._cache_namespace, key.rstrip("/"))
 
-        # If MEDIA_ROOT appears inside the name, strip up to MEDIA_ROOT so that
-        # keys are relative to media folder.
+    def _cached_stat(self, path):
+        """Return the CachedStat for `path`, MISSING for a cached ENOENT or
+        a name absent from the cached listing of its directory, or None
+        when nothing is known."""
+        if path in (None, "", "/"):
+            return None
+        index = self._ready_index()
+        if index is not None:
+            found = index.lookup(self._storage_key(path))
+            return MISSING if found is None else CachedStat(*found)
+        cache = self.metadata_cache
+        namespace, key = self._cache_key(self._storage_key(path))
+        cached = cache.get_stat((namespace, key))
+        if cached is NEGATIVE:
+            return MISSING
+        if cached is None and key and cache.negative_ttl:
+            parent, _, name = key.rpartition("/")
+            if cache.listing_contains((namespace, parent), name) is False:
+                return MISSING
+        return cached
+
+    def _lookup(self, path):
+        """Return what is known about `path` without asking the storage
+        (see _cached_stat()). Patches for storages that can tell files,
+        directories and missing paths apart in one request override it to
+        make that request on a cache miss, and never return None."""
+        return self._cached_stat(path)
+
+    def _ready_index(self):
+        """Return the namespace index if it can answer lookups, else None.
+        It is always up to date with the writes made through the FTP
+        server, so it is preferred to the metadata cache."""
+        index = self.namespace_index
+        return index if index is not None and index.ready else None
+
+    def _indexed(self, method, *args):
+        """Record a write made through the FTP server in the namespace
+        index (see CONFIG.nsindex.NamespaceIndex), if there is one."""
+        if self.namespace_index is None:
+            return
         try:
-            media_root = getattr(settings, "MEDIA_ROOT", None)
-            if media_root:
-                media_root_base = os.path.basename(os.path.normpath(media_root))
-                parts = name.split("/")
-                if media_root_base in parts:
-                    idx = parts.index(media_root_base)
-                    # everything after MEDIA_ROOT basename is the real relative key
-                    name = "/".join(parts[idx + 1 :]) or ""
+            getattr(self.namespace_index, method)(*args)
         except Exception:
-            # be conservative: if anything fails, fall back to the raw name
-            pass
-
-        return name
+            # the next reconciliation picks the change up
+            logger.warning("updating the namespace index (%s %r) failed", method, args, exc_info=True)
+
+    def _upload_done(self, key):
+        """Return the on_complete callback of an upload to `key`: metadata
+        cached while it was being written is dropped again and the object
+        recorded in the namespace index."""
+        def on_complete(writer):
+            self._forget(key)
+            self._indexed("put", key, writer.tell(), writer.etag)
+        return on_complete
+
+    def _forget(self, key, tree=False):
+        """Invalidate cached metadata for the storage key `key` after a
+        write, together with the listings and stats of all its parents,
+        and drop its downloaded blocks. With `tree`, everything cached
+        under `key` is dropped as well."""
+        key = key.rstrip("/")
+        parents = []
+        parent = key
+        while parent:
+            parent = parent.rpartition("/")[0]
+            parents.append(self._cache_key(parent))
+        self.metadata_cache.invalidate(self._cache_key(key), parents)
+        if self.block_cache is not None:
+            self.block_cache.invalidate(self._cache_key(key))
+        if tree:
+            namespace, prefix = self._cache_key(key)
+            prefix = prefix + "/" if prefix else prefix
+
+            def under(cache_key):
+                return cache_key[0] == namespace and cache_key[1].startswith(prefix)
+
+            self.metadata_cache.invalidate_matching(under)
+            if self.block_cache is not None:
+                self.block_cache.invalidate_matching(under)
+
+    def _list_entries(self, key):
+        """Return ListingEntry items for the storage prefix `key`.
+
+        The generic implementation only knows the kind of every entry;
+        patches for storages whose listing carries size and mtime override
+        it so stat() does not need a round trip per entry.
+        """
+        directories, files = self.storage.listdir(key)
+        entries = [ListingEntry(d.rstrip("/"), True, 0, 0) for d in directories if d]
+        entries += [ListingEntry(f, False, None, None) for f in files if f]
+        return entries
+
+    def _iter_entry_pages(self, key):
+        """Yield the ListingEntry items for `key` page by page. Patches for
+        storages with paginated listings override it so huge directories
+        are never held in memory at once."""
+        yield self._list_entries(key)
+
+    def _remember_entries(self, key, entries):
+        """Cache the stat of every entry listed under `key` so the stat()
+        calls pyftpdlib makes for each of them do not go back to the
+        storage. A listing with entries also shows that `key` itself is a
+        directory."""
+        for entry in entries:
+            self.metadata_cache.set_stat(
+                self._cache_key(key + entry.name), CachedStat(entry.is_dir, entry.size, entry.mtime)
+            )
+        if entries and key.rstrip("/"):
+            self.metadata_cache.set_stat(self._cache_key(key), DIRECTORY)
+
+    def _remember_pages(self, key, pages):
+        """Yield each page of `pages`, caching it like listdir() does; the
+        listing itself is only cached if it stays small enough."""
+        cache = self.metadata_cache
+        listing = []
+        for entries in pages:
+            self._remember_entries(key, entries)
+            if listing is not None:
+                listing += entries
+                if len(listing) > cache.max_listing_size:
+                    listing = None
+            yield entries
+        if listing is not None:
+            cache.set_listing(self._cache_key(key), listing)
 
     # --------------------- FS operations ---------------------
 
@@ -327,10 +882,16 @@ class StorageFS(AbstractedFS):
         assert isinstance(filename, str), filename
         ftp_path = self._ensure_ftp_path(filename)
         key = self._storage_name(ftp_path)
+        written = any(c in mode for c in "wa+")
+        if written:
+            self._forget(key)
         try:
-            return self.storage.open(key, mode)
+            file = self.storage.open(key, mode)
         except FileNotFoundError:
             raise OSError(errno.ENOENT, "No such file or directory", filename)
+        if written:
+            return WrittenFile(file, lambda: self._forget(key))
+        return file
 
     def mkstemp(self, suffix="", prefix="", dir=None, mode="wb"):
         raise NotImplementedError("mkstemp not implemented for StorageFS")
@@ -342,6 +903,7 @@ class StorageFS(AbstractedFS):
         key = self._storage_name(ftp_path)
         if not key.endswith("/"):
             key = key + "/"
+        self._forget(key)
         # Some storages accept save(...) for directories; try best-effort.
         try:
             # create an empty placeholder (some storages ignore zero-length saves)
@@ -358,21 +920,46 @@ class StorageFS(AbstractedFS):
         # many storages expect '' for root
         if key != "" and not key.endswith("/"):
             key = key + "/"
+        cache = self.metadata_cache
+        entries = cache.get_listing(self._cache_key(key)) if self._ready_index() is None else None
+        if entries is None:
+            try:
+                entries = self._list_entries(key)
+            except FileNotFoundError:
+                raise OSError(errno.ENOENT, "No such directory", path)
+            self._remember_entries(key, entries)
+            cache.set_listing(self._cache_key(key), entries)
+        # Return directory names WITHOUT trailing slash - pyftpdlib identifies
+        # directories through stat() st_mode, not through trailing slashes.
+        return [entry.name for page in directories_first([entries]) for entry in page]
+
+    def iter_listdir(self, path, sort=False):
+        """Like listdir(), but return a DirectoryListing that yields the
+        entries as the storage returns them instead of a complete list.
+        With `sort` they come sorted by name, as pyftpdlib sends LIST and
+        NLST, otherwise directories first, as listdir() returns them."""
+        assert isinstance(path, str), path
+        key = self._storage_key(path)
+        if key != "" and not key.endswith("/"):
+            key = key + "/"
+        order = by_name if sort else directories_first
+        if self._ready_index() is None:
+            entries = self.metadata_cache.get_listing(self._cache_key(key))
+            if entries is not None:
+                return DirectoryListing([entry for page in order([entries]) for entry in page])
+        pages = order(self._remember_pages(key, self._iter_entry_pages(key)))
         try:
-            directories, files = self.storage.listdir(key)
-            # Return directory names WITHOUT trailing slash - pyftpdlib identifies
-            # directories through stat() st_mode, not through trailing slashes
-            dirs = [d.rstrip("/") for d in directories if d]
-            files = [f for f in files if f]
-            return dirs + files
+            first = next(pages, [])
         except FileNotFoundError:
             raise OSError(errno.ENOENT, "No such directory", path)
+        return DirectoryListing(first, pages)
 
     def rmdir(self, path):
         ftp_path = self._ensure_ftp_path(path)
         key = self._storage_name(ftp_path)
         if not key.endswith("/"):
             key = key + "/"
+        self._forget(key)
         # attempt to delete placeholder object if present
         try:
             # Some storages don't provide delete for folders; simply try to delete
@@ -380,15 +967,56 @@ class StorageFS(AbstractedFS):
         except Exception as e:
             logger.debug("rmdir failed: %s", e)
             raise OSError(errno.EACCES, "Cannot remove directory", path)
+        self._indexed("delete", key)
 
     def remove(self, path):
         assert isinstance(path, str), path
         ftp_path = self._ensure_ftp_path(path)
         key = self._storage_name(ftp_path)
+        self._forget(key)
         try:
             self.storage.delete(key)
         except FileNotFoundError:
             raise OSError(errno.ENOENT, "No such file", path)
+        self._indexed("delete", key)
+
+    def rename(self, src, dst):
+        self._forget(self._storage_key(src))
+        self._forget(self._storage_key(dst))
+        super(StorageFS, self).rename(src, dst)
+
+    def _check_copy(self, src, dst):
+        """Return the storage keys of `src` and `dst` if the file `src` can
+        be copied to `dst`; raise OSError otherwise."""
+        src_key = self._storage_key(src).rstrip("/")
+        dst_key = self._storage_key(dst).rstrip("/")
+        if not self.isfile(src):
+            if self.isdir(src):
+                raise OSError(errno.EISDIR, "Is a directory", src)
+            raise OSError(errno.ENOENT, "No such file", src)
+        if not dst_key or self.isdir(dst):
+            raise OSError(errno.EISDIR, "Is a directory", dst)
+        if dst_key == src_key:
+            raise OSError(errno.EINVAL, "Source and destination are the same file", dst)
+        return src_key, dst_key
+
+    def copy(self, src, dst):
+        """Copy the file `src` to `dst`, replacing `dst`. The data is read
+        and written back through the storage; patches for storages that
+        can copy server-side override it."""
+        self._check_copy(src, dst)
+        fsrc = self.open(src, "rb")
+        try:
+            fdst = self.open(dst, "wb")
+            try:
+                shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+            except BaseException:
+                # an unfinished upload must not replace `dst`
+                getattr(fdst, "abort", fdst.close)()
+                raise
+            fdst.close()
+        finally:
+            fsrc.close()
 
     def chmod(self, path, mode):
         raise NotImplementedError("chmod not supported for remote storage")
@@ -398,18 +1026,33 @@ class StorageFS(AbstractedFS):
         try:
             # Clean up path - remove trailing slash for checking
             clean_path = path.rstrip("/") if path not in ("/", "") else path
-            
-            if self.isfile(clean_path):
+
+            cached = self._cached_stat(clean_path)
+            if cached is MISSING:
+                raise OSError(errno.ENOENT, "No such file or directory", path)
+            if cached is not None and cached.size is not None and cached.mtime is not None:
+                st_mode = 0o0040770 if cached.is_dir else 0o0100770
+                size = cached.size
+                mtime = int(cached.mtime)
+            elif self.isfile(clean_path):
                 st_mode = 0o0100770
                 size = self.getsize(clean_path)
                 mtime = int(self.getmtime(clean_path))
+                self.metadata_cache.set_stat(
+                    self._cache_key(self._storage_key(clean_path)),
+                    CachedStat(False, size, mtime),
+                )
             elif self.isdir(clean_path):
                 st_mode = 0o0040770
                 size = 0
                 mtime = 0
             else:
+                if clean_path not in ("/", ""):
+                    self.metadata_cache.set_missing(
+                        self._cache_key(self._storage_key(clean_path))
+                    )
                 raise OSError(errno.ENOENT, "No such file or directory", path)
-            
+
             return PseudoStat(
                 st_size=size,
                 st_mtime=mtime,
@@ -445,6 +1088,9 @@ class StorageFS(AbstractedFS):
         ftp_path = self._ensure_ftp_path(path)
         if ftp_path.endswith("/"):
             return False
+        cached = self._cached_stat(ftp_path)
+        if cached is not None:
+            return cached.is_dir is False
         return self._exists(path)
 
     def islink(self, path):
@@ -455,12 +1101,20 @@ class StorageFS(AbstractedFS):
         ftp_path = self._ensure_ftp_path(path)
         if ftp_path in ("/", ""):
             return True
+        cached = self._cached_stat(ftp_path)
+        if cached is not None:
+            return bool(cached.is_dir)
         # directory if exists with trailing slash or exists as prefix
         if ftp_path.endswith("/"):
             return self._exists(ftp_path)
         return self._exists(ftp_path + "/")
 
     def getsize(self, path):
+        cached = self._cached_stat(path)
+        if cached is MISSING:
+            raise OSError(errno.ENOENT, "No such file", path)
+        if cached is not None and cached.size is not None:
+            return cached.size
         if self.isdir(path):
             return 0
         ftp_path = self._ensure_ftp_path(path)
@@ -472,6 +1126,9 @@ class StorageFS(AbstractedFS):
 
     def getmtime(self, path):
         # dirs -> 0; files -> use storage.get_modified_time
+        cached = self._cached_stat(path)
+        if cached is not None and cached.mtime is not None:
+            return cached.mtime
         if self.isdir(path):
             return 0
         ftp_path = self._ensure_ftp_path(path)
@@ -489,6 +1146,16 @@ class StorageFS(AbstractedFS):
             # fallback: 0
             return 0
 
+    def checksum(self, path, algorithm):
+        """Return the hex `algorithm` checksum (CONFIG.checksums) of the file
+        `path`. Computed by reading the file; patches for storages that
+        keep checksums override it."""
+        f = self.open(path, "rb")
+        try:
+            return file_checksum(f, algorithm)
+        finally:
+            f.close()
+
     def realpath(self, path):
         # return ftp-style path
         return self._ensure_ftp_path(path)
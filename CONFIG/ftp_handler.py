@@ -1,4 +1,249 @@
-from pyftpdlib.handlers import FTPHandler
+import contextlib
+import errno
+import logging
+import os
+import posixpath
+import stat
+import time
+from collections import deque
+
+from pyftpdlib.filesystems import FilesystemError
+from pyftpdlib.handlers import BufferedIteratorProducer, DTPHandler, FTPHandler, _strerror
+
+from .bulk import BulkJob, expand, get_bulk_pool, get_bulk_settings
+from .checksums import HASH_ALGORITHMS
+from .filesystems import DirectoryListing, ListingEntry
+from .listing import ListingFormatter
+from .logqueue import TRANSFER_LOGGER
+from .metrics import get_metrics
+from .offload import PreloadedFS, get_worker_pool
+from .pipeline import get_upload_pipeline
+from .qos import READ, TRANSFER_COMMANDS, WRITE, acting_for, get_qos
+
+logger = logging.getLogger(__name__)
+transfer_logger = logging.getLogger(TRANSFER_LOGGER)
+
+
+class ListingProducer:
+    """
+    Producer of directory listing lines read from a DirectoryListing
+    (see StorageFS.iter_listdir) and rendered by `render(entries)`, a
+    ListingFormatter method, up to `batch_size` entries at a time.
+
+    more() stops at the end of the page already read instead of waiting
+    for the next one, and ready() tells the data channel whether more()
+    has anything to give, so a listing is sent page by page as the
+    storage returns it.
+    """
+
+    batch_size = 512
+
+    def __init__(self, listing, render):
+        self.listing = listing
+        self.render = render
+
+    def ready(self):
+        return self.listing.ready()
+
+    def more(self):
+        while True:
+            entries = self.listing.take(self.batch_size)
+            if not entries:
+                return b""
+            data = self.render(entries)
+            # empty if every entry vanished before it could be stat'ed
+            if data:
+                return data
+
+
+class StorageDTPHandler(DTPHandler):
+    """
+    Data channel aware of streaming storage file objects: upload writers
+    with full() and abort() (CONFIG.streams.S3MultipartWriter), download
+    readers with ready() (CONFIG.streams.S3RangeReader) and listing
+    producers with ready() (ListingProducer).
+
+    It stops reading from, or sending to, the client while the storage
+    side cannot keep up instead of blocking the IOLoop, aborts uploads
+    that do not complete and, when FTPSERVER_STORAGE_WORKERS is set,
+    completes uploads on the worker pool before answering 226.
+
+    When FTPSERVER_QOS limits the bandwidth of its user, it pauses the
+    same way for as long as the user's token bucket is in debt.
+    """
+
+    # seconds between two checks of a storage file object that is not ready
+    resume_interval = 0.05
+
+    def __init__(self, sock, cmd_channel):
+        self._paused = False
+        self._resumer = None
+        self._finishing = False
+        self._qos = get_qos()
+        # direction in which the transfer is rate limited, if it is
+        self._limited = None
+        self._throttled_until = 0
+        super().__init__(sock, cmd_channel)
+
+    # --------------------- QoS ---------------------
+
+    def _acting(self):
+        if self._qos is None:
+            return contextlib.nullcontext()
+        return acting_for(self.cmd_channel.username)
+
+    def _start_transfer(self, direction):
+        if self._qos is not None and self._limited is None:
+            if self._qos.start(self.cmd_channel.username, direction):
+                self._limited = direction
+
+    def _end_transfer(self):
+        if self._limited is not None:
+            self._qos.end(self.cmd_channel.username, self._limited)
+            self._limited = None
+        if self.cmd in TRANSFER_COMMANDS:
+            self.cmd_channel._release_transfer_slot()
+
+    def _charge(self, nbytes):
+        delay = self._qos.charge(self.cmd_channel.username, self._limited, nbytes)
+        if delay:
+            self._throttled_until = time.monotonic() + delay
+
+    def push(self, data):
+        self._start_transfer(READ)
+        super().push(data)
+
+    def push_with_producer(self, producer):
+        self._start_transfer(READ)
+        super().push_with_producer(producer)
+
+    def enable_receiving(self, type, cmd):
+        self._start_transfer(WRITE)
+        super().enable_receiving(type, cmd)
+
+    def use_sendfile(self):
+        # sendfile() bypasses send(), where bandwidth is accounted
+        return self._limited is None and super().use_sendfile()
+
+    def send(self, data):
+        sent = super().send(data)
+        if self._limited is not None and sent:
+            self._charge(sent)
+        return sent
+
+    def recv(self, buffer_size):
+        chunk = super().recv(buffer_size)
+        if self._limited is not None and chunk:
+            self._charge(len(chunk))
+        return chunk
+
+    # --------------------- storage flow control ---------------------
+
+    def _uploading(self):
+        return self.receive and hasattr(self.file_obj, "full") and hasattr(self.file_obj, "abort")
+
+    def _storage_busy(self):
+        if self.receive:
+            return self._uploading() and self.file_obj.full()
+        source = self.file_obj
+        if source is None and self.producer_fifo:
+            source = self.producer_fifo[0]
+        return hasattr(source, "ready") and not source.ready()
+
+    def _wait_for_storage(self):
+        """Pause the channel while the storage is busy or the bandwidth
+        limit is reached; return True if the transfer cannot go on right
+        now."""
+        try:
+            busy = self._storage_busy()
+        except OSError as err:
+            self._resp = ("426 %s; transfer aborted." % err.strerror, logger.warning)
+            self.close()
+            return True
+        throttled = self._throttled_until - time.monotonic() if self._limited is not None else 0
+        waiting = busy or throttled > 0
+        if waiting:
+            if not self._paused:
+                self._paused = True
+                self.del_channel()
+            delay = max(throttled, self.resume_interval if busy else 0)
+            self._resumer = self.ioloop.call_later(delay, self._resume)
+        elif self._paused:
+            self._paused = False
+            self.add_channel(events=self._wanted_io_events)
+        return waiting
+
+    def _resume(self):
+        self._resumer = None
+        if not self._closed and not self._wait_for_storage() and not self.receive:
+            self.initiate_send()
+
+    def handle_read(self):
+        with self._acting():
+            super().handle_read()
+        if not self._closed:
+            self._wait_for_storage()
+
+    handle_read_event = handle_read
+
+    def initiate_send(self):
+        if self._paused or (not self.receive and self._wait_for_storage()):
+            return
+        with self._acting():
+            super().initiate_send()
+
+    def close(self):
+        if self._resumer is not None:
+            if not self._resumer.cancelled:
+                self._resumer.cancel()
+            self._resumer = None
+        if self._closed or self._finishing:
+            return
+        if self._uploading() and not self.file_obj.closed:
+            # completing or aborting the upload makes blocking requests
+            finish = self.file_obj.close if self.transfer_finished else self.file_obj.abort
+            pool = get_worker_pool()
+            if pool is not None:
+                self._finishing = True
+                self.del_channel()
+                with self._acting():
+                    pool.submit(self.ioloop, finish, self._upload_done)
+                return
+            try:
+                with self._acting():
+                    finish()
+            except Exception as err:
+                self._upload_failed(err)
+        self._record_transfer()
+        self._end_transfer()
+        super().close()
+
+    def _upload_done(self, future):
+        self._finishing = False
+        if future.exception() is not None:
+            self._upload_failed(future.exception())
+        if self.cmd_channel._closed:
+            self._resp = None
+        self._record_transfer()
+        self._end_transfer()
+        super().close()
+
+    def _record_transfer(self):
+        metrics = get_metrics()
+        if metrics is not None and self.cmd is not None:
+            metrics.transfer(
+                self.cmd, self.tot_bytes_sent, self.tot_bytes_received,
+                self.get_elapsed_time(), self.transfer_finished,
+            )
+
+    def _upload_failed(self, err):
+        if not self.transfer_finished:
+            # aborting: the reply already says why the transfer failed
+            logger.warning("aborting upload of %r failed: %s", self.file_obj.name, err)
+            return
+        logger.error("completing upload of %r failed: %s", self.file_obj.name, err)
+        self.transfer_finished = False
+        self._resp = ("426 Upload to storage failed; transfer aborted.", logger.warning)
 
 
 class PermissiveFTPHandler(FTPHandler):
@@ -7,6 +252,572 @@ class PermissiveFTPHandler(FTPHandler):
     commands. Use only when you need to support clients using active FTP
     behind NAT that advertise a different IP. This can be a security risk -
     prefer passive mode instead.
+
+    When FTPSERVER_STORAGE_WORKERS is set, the storage calls made by the
+    commands in `offloaded_cmds` run on a worker pool. The command channel
+    stops reading until they finish, then the command is replayed on the
+    IOLoop with the results already at hand, so one slow storage request
+    no longer stalls every other session.
+
+    When FTPSERVER_METRICS is enabled, sessions and commands (with the
+    class of their reply) are recorded in CONFIG.metrics.
+
+    When FTPSERVER_UPLOAD_PIPELINE is enabled, every file received is
+    queued for the post-upload stages (CONFIG.pipeline), and uploads are
+    refused with 450 while that queue is full.
+
+    When FTPSERVER_QOS is enabled, a user's file transfers beyond their
+    MAX_TRANSFERS are refused with 450, and the storage calls of commands
+    are made on behalf of the user (CONFIG.qos.current_user) so backend
+    request slots are shared fairly.
+
+    XMD5 and HASH (draft-bryan-ftpext-hash, algorithm chosen with OPTS
+    HASH) answer with the checksums stored at upload time when there are
+    some (StorageFS.checksum()).
+
+    SITE MSTAT, MDELE and MCOPY stat, delete or copy (server-side on S3)
+    every file matching a glob pattern or listed in a manifest file
+    uploaded beforehand ("@<path>"), several at a time on a worker pool
+    (FTPSERVER_SITE_BULK), with one reply line per file.
+
+    Every file transfer is also logged as an xferlog-style record on the
+    CONFIG.xferlog logger (JSON lines with CONFIG.logqueue.TransferFormatter).
     """
 
     permit_foreign_addresses = True
+    dtp_handler = StorageDTPHandler
+
+    proto_cmds = dict(
+        FTPHandler.proto_cmds,
+        XMD5=dict(perm="r", auth=True, arg=True, help="Syntax: XMD5 <SP> file-name (get MD5 of file)."),
+        HASH=dict(perm="r", auth=True, arg=True, help="Syntax: HASH <SP> file-name (get hash of file)."),
+        # perm=None: the argument is not a single path, permissions are
+        # checked for every file named
+        **{
+            "SITE MSTAT": dict(perm=None, auth=True, arg=True,
+                               help="Syntax: SITE <SP> MSTAT <SP> pattern|@manifest (stat many files)."),
+            "SITE MDELE": dict(perm=None, auth=True, arg=True,
+                               help="Syntax: SITE <SP> MDELE <SP> pattern|@manifest (delete many files)."),
+            "SITE MCOPY": dict(perm=None, auth=True, arg=True,
+                               help="Syntax: SITE <SP> MCOPY <SP> pattern|@manifest <SP> dir-name "
+                                    "(copy many files)."),
+        },
+    )
+    # default HASH algorithm
+    hash_algorithm = "SHA-256"
+
+    offloaded_cmds = frozenset((
+        "LIST", "NLST", "MLSD", "MLST", "STAT", "SIZE", "MDTM",
+        "RETR", "STOR", "APPE", "DELE", "MKD", "RMD", "RNFR", "RNTO", "XMD5", "HASH",
+    ))
+
+    def __init__(self, conn, server, ioloop=None):
+        # set before FTPHandler.__init__, which may already close() us
+        self._offloading = False
+        self._pending_commands = deque()
+        self._metrics = get_metrics()
+        self._session_counted = False
+        self._pipeline = get_upload_pipeline()
+        self._receiving = None
+        self._qos = get_qos()
+        # a MAX_TRANSFERS slot is held for the current file transfer
+        self._transfer_slot = False
+        # the running SITE MSTAT/MDELE/MCOPY
+        self._bulk_job = None
+        super().__init__(conn, server, ioloop=ioloop)
+
+    # --------------------- metrics ---------------------
+
+    def handle(self):
+        if self._metrics is not None:
+            self._session_counted = True
+            self._metrics.session_opened()
+        super().handle()
+
+    def close(self):
+        if self._session_counted:
+            self._session_counted = False
+            self._metrics.session_closed()
+        self._release_transfer_slot()
+        if self._bulk_job is not None:
+            self._bulk_job.cancel()
+        super().close()
+
+    def _record_command(self, cmd, start):
+        self._metrics.command(cmd, time.perf_counter() - start, self._last_response[:1] or None)
+
+    # --------------------- storage offloading ---------------------
+
+    def pre_process_command(self, line, cmd, arg):
+        if self._offloading:
+            if self._bulk_job is not None and cmd[-4:] == "ABOR":
+                self._bulk_job.cancel()
+            # commands pipelined behind an offloaded one keep their order
+            self._pending_commands.append((line, cmd, arg))
+            return
+        super().pre_process_command(line, cmd, arg)
+
+    def process_command(self, cmd, *args, **kwargs):
+        if cmd in ("STOR", "APPE") and self._pipeline is not None and self._pipeline.full():
+            msg = "Too many uploads waiting to be processed, try again later."
+            self._restart_position = 0
+            self.respond("450 " + msg)
+            self.log_cmd(cmd, args[0], 450, msg)
+            return
+        if cmd in TRANSFER_COMMANDS and not self._take_transfer_slot():
+            msg = "Too many transfers in progress, try again later."
+            self._restart_position = 0
+            self.respond("450 " + msg)
+            self.log_cmd(cmd, args[0], 450, msg)
+            return
+        pool = get_worker_pool()
+        if pool is None or cmd not in self.offloaded_cmds or self.fs is None or self._closed:
+            if self._metrics is None and self._qos is None:
+                return super().process_command(cmd, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                with self._acting():
+                    return super().process_command(cmd, *args, **kwargs)
+            finally:
+                self._check_transfer_slot()
+                if self._metrics is not None:
+                    self._record_command(cmd, start)
+
+        start = time.perf_counter()
+
+        fs = PreloadedFS(self.fs)
+        preload = getattr(self, "_preload_" + cmd)
+
+        def run():
+            try:
+                preload(fs, *args, **kwargs)
+            except Exception:
+                # remembered by the proxy; raised again when replayed
+                pass
+
+        def done(future):
+            self._offloading = False
+            if self._closed:
+                fs.discard()
+                return
+            events = self.ioloop.READ
+            if self.producer_fifo:
+                events |= self.ioloop.WRITE
+            self.add_channel(events=events)
+            real_fs, self.fs = self.fs, fs
+            try:
+                with self._acting():
+                    super(PermissiveFTPHandler, self).process_command(cmd, *args, **kwargs)
+            except Exception:
+                self.handle_error()
+            finally:
+                if self.fs is fs:
+                    self.fs = real_fs
+                fs.discard()
+            self._check_transfer_slot()
+            if self._metrics is not None:
+                self._record_command(cmd, start)
+            self._process_pending_commands()
+
+        self._offloading = True
+        self.del_channel()
+        with self._acting():
+            pool.submit(self.ioloop, run, done)
+
+    # --------------------- QoS ---------------------
+
+    def _acting(self):
+        if self._qos is None:
+            return contextlib.nullcontext()
+        return acting_for(self.username)
+
+    def _take_transfer_slot(self):
+        if self._qos is None or self._transfer_slot:
+            return True
+        self._transfer_slot = self._qos.take_transfer(self.username)
+        return self._transfer_slot
+
+    def _release_transfer_slot(self):
+        if self._transfer_slot:
+            self._transfer_slot = False
+            self._qos.release_transfer(self.username)
+
+    def _check_transfer_slot(self):
+        """Give the transfer slot back if the command did not start a
+        transfer (e.g. it failed with 550)."""
+        if not self._transfer_slot:
+            return
+        channel = self.data_channel
+        if self._out_dtp_queue is None and self._in_dtp_queue is None and (
+                channel is None or channel.cmd not in TRANSFER_COMMANDS):
+            self._release_transfer_slot()
+
+    # --------------------- upload pipeline ---------------------
+
+    def ftp_STOR(self, file, mode="w"):
+        # on_file_received() is passed the name of the storage file object,
+        # whose form depends on the backend: remember what is uploaded
+        self._receiving = (file, mode == "w" and not self._restart_position)
+        return super().ftp_STOR(file, mode)
+
+    def on_file_received(self, file):
+        if self._pipeline is None or self._receiving is None:
+            return
+        file, whole = self._receiving
+        self._receiving = None
+        fs = self.fs
+        ftp_path = fs._ensure_ftp_path(file)
+        storage_class = type(fs.storage)
+        self._pipeline.enqueue(
+            path=ftp_path,
+            key=fs._storage_name(ftp_path),
+            storage_class="%s.%s" % (storage_class.__module__, storage_class.__qualname__),
+            username=self.username or "",
+            size=self.data_channel.tot_bytes_received if whole and self.data_channel else None,
+        )
+
+    # --------------------- transfer log ---------------------
+
+    def log_transfer(self, cmd, filename, receive, completed, elapsed, bytes):
+        super().log_transfer(cmd, filename, receive, completed, elapsed, bytes)
+        if not transfer_logger.isEnabledFor(logging.INFO):
+            return
+        fs = self.fs
+        path = fs._ensure_ftp_path(filename) if hasattr(fs, "_ensure_ftp_path") else filename
+        transfer_logger.info("%s %s", cmd, path, extra={"transfer": {
+            "secs": elapsed,
+            "host": self.remote_ip,
+            "bytes": bytes,
+            "file": path,
+            "type": "a" if self._current_type == "a" else "b",
+            "dir": "i" if receive else "o",
+            "mode": "a" if self.username == "anonymous" else "r",
+            "user": self.username,
+            "svc": "ftp",
+            "cmd": cmd,
+            "status": "c" if completed else "i",
+        }})
+
+    # --------------------- checksums ---------------------
+
+    def ftp_FEAT(self, line):
+        extra_feats = self._extra_feats
+        algorithms = [name + ("*" if name == self.hash_algorithm else "") for name in HASH_ALGORITHMS]
+        self._extra_feats = extra_feats + ["XMD5", "HASH " + ";".join(algorithms)]
+        try:
+            return super().ftp_FEAT(line)
+        finally:
+            self._extra_feats = extra_feats
+
+    def ftp_OPTS(self, line):
+        cmd, _, arg = line.partition(" ")
+        if cmd.upper() != "HASH":
+            return super().ftp_OPTS(line)
+        if arg:
+            if arg.upper() not in HASH_ALGORITHMS:
+                self.respond("501 Unknown algorithm.")
+                return
+            self.hash_algorithm = arg.upper()
+        self.respond("200 " + self.hash_algorithm)
+
+    def _checksum(self, path, algorithm):
+        """Return the checksum of the file `path`, or None after replying
+        with an error."""
+        try:
+            if not self.fs.isfile(self.fs.realpath(path)):
+                self.respond("550 %s is not retrievable." % self.fs.fs2ftp(path))
+                return None
+            return self.run_as_current_user(self.fs.checksum, path, algorithm)
+        except (OSError, FilesystemError) as err:
+            self.respond("550 %s." % _strerror(err))
+            return None
+
+    def ftp_XMD5(self, path):
+        checksum = self._checksum(path, "md5")
+        if checksum is not None:
+            self.respond("250 " + checksum)
+
+    def ftp_HASH(self, path):
+        algorithm = self.hash_algorithm
+        checksum = self._checksum(path, HASH_ALGORITHMS[algorithm])
+        if checksum is None:
+            return
+        try:
+            size = self.run_as_current_user(self.fs.getsize, path)
+        except (OSError, FilesystemError) as err:
+            self.respond("550 %s." % _strerror(err))
+            return
+        self.respond("213 %s 0-%d %s %s" % (algorithm, size, checksum, self.fs.fs2ftp(path)))
+
+    # --------------------- bulk SITE commands ---------------------
+
+    def ftp_SITE_MSTAT(self, line):
+        self._run_bulk("SITE MSTAT", line, "213", self._bulk_stat)
+
+    def ftp_SITE_MDELE(self, line):
+        self._run_bulk("SITE MDELE", line, "250", self._bulk_delete, files_only=True)
+
+    def ftp_SITE_MCOPY(self, line):
+        source, _, target = line.rpartition(" ")
+        if not source or not target:
+            msg = "Syntax error: command needs two arguments."
+            self.respond("501 " + msg)
+            self.log_cmd("SITE MCOPY", line, 501, msg)
+            return
+        target = self.fs.ftpnorm(target)
+        if not self.authorizer.has_perm(self.username, "w", self.fs.ftp2fs(target)):
+            msg = "Not enough privileges."
+            self.respond("550 " + msg)
+            self.log_cmd("SITE MCOPY", line, 550, msg)
+            return
+        self._run_bulk("SITE MCOPY", source, "250", lambda path: self._bulk_copy(path, target),
+                       files_only=True, line=line, check=lambda: self._bulk_target(target))
+
+    def _run_bulk(self, cmd, spec, code, operation, files_only=False, line=None, check=None):
+        """
+        Run `operation` on every file named by `spec` (see
+        CONFIG.bulk.expand()) on the bulk worker pool, CONCURRENCY files
+        at a time, and reply with one line per file as they finish:
+        " <code> <text>" on success, " 550 <path>: <error>" on failure,
+        then the count of each. Commands received meanwhile wait, except
+        ABOR, which stops starting new files. `check()`, if given, runs
+        on the pool first and may raise OSError to refuse the command.
+        """
+        line = spec if line is None else line
+        conf = get_bulk_settings()
+        pool = get_bulk_pool()
+        fs = self.fs
+        counts = {"ok": 0, "failed": 0}
+
+        def on_result(path, text, error):
+            if self._closed:
+                job.cancel()
+                return
+            if error is None:
+                counts["ok"] += 1
+                self.push(" %s %s\r\n" % (code, text))
+            else:
+                counts["failed"] += 1
+                self.push(" 550 %s: %s.\r\n" % (path, _strerror(error)))
+
+        def on_done():
+            self._bulk_job = None
+            self._offloading = False
+            if self._closed:
+                return
+            msg = "%d done, %d failed%s." % (counts["ok"], counts["failed"], ", aborted" if job.cancelled else "")
+            self.respond("%s %s" % (code, msg))
+            self.log_cmd(cmd, line, int(code), msg)
+            self._process_pending_commands()
+
+        def refuse(msg):
+            self._bulk_job = None
+            self._offloading = False
+            self.respond("550 " + msg)
+            self.log_cmd(cmd, line, 550, msg)
+            self._process_pending_commands()
+
+        def expanded(future):
+            if self._closed:
+                self._bulk_job = None
+                self._offloading = False
+                return
+            try:
+                paths = future.result()
+            except ValueError as err:
+                refuse(str(err))
+                return
+            except (OSError, FilesystemError) as err:
+                refuse("%s." % _strerror(err))
+                return
+            if not paths:
+                refuse("No files found.")
+                return
+            self.push("%s-%s of %d file(s):\r\n" % (code, cmd, len(paths)))
+            with self._acting():
+                job.start(paths)
+
+        def prepare():
+            if check is not None:
+                check()
+            return expand(fs, spec, self._bulk_path, files_only, conf["MAX_ITEMS"], conf["MAX_MANIFEST_SIZE"])
+
+        job = self._bulk_job = BulkJob(pool, self.ioloop, operation, on_result, on_done, conf["CONCURRENCY"])
+        self._offloading = True
+        pool.submit(self.ioloop, prepare, expanded)
+
+    def _bulk_path(self, path, perm):
+        """Return the filesystem path of the FTP path `path`, checking that
+        the user has `perm` on it."""
+        fs_path = self.fs.ftp2fs(path)
+        if not self.fs.validpath(fs_path) or not self.authorizer.has_perm(self.username, perm, fs_path):
+            raise PermissionError(errno.EACCES, "Not enough privileges")
+        return fs_path
+
+    def _bulk_stat(self, path):
+        fs_path = self._bulk_path(path, "l")
+        st = self.fs.stat(fs_path)
+        kind = "dir" if stat.S_ISDIR(st.st_mode) else "file"
+        modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(st.st_mtime))
+        return "type=%s;size=%d;modify=%s; %s" % (kind, st.st_size, modify, path)
+
+    def _bulk_delete(self, path):
+        self.fs.remove(self._bulk_path(path, "d"))
+        return path
+
+    def _bulk_target(self, target):
+        if not self.fs.isdir(self.fs.ftp2fs(target)):
+            raise NotADirectoryError(errno.ENOTDIR, "Not a directory", target)
+
+    def _bulk_copy(self, path, target):
+        dst = posixpath.join(target, posixpath.basename(path))
+        self.fs.copy(self._bulk_path(path, "r"), self._bulk_path(dst, "w"))
+        return "%s -> %s" % (path, dst)
+
+    # --------------------- streamed listings ---------------------
+
+    def _iter_listdir(self, path, sort=False):
+        return self.run_as_current_user(self.fs.iter_listdir, path, sort)
+
+    def ftp_LIST(self, path):
+        """Like FTPHandler.ftp_LIST, but directory listings are sent, sorted
+        by name, as the storage returns them instead of being read first."""
+        if not hasattr(self.fs, "iter_listdir"):
+            return super().ftp_LIST(path)
+        try:
+            if self.fs.isdir(path):
+                listing = self._iter_listdir(path, True)
+                producer = ListingProducer(listing, ListingFormatter(self.fs, path).format_list)
+            else:
+                basedir, filename = os.path.split(path)
+                self.fs.lstat(path)  # raise exc in case of problems
+                producer = BufferedIteratorProducer(self.fs.format_list(basedir, [filename]))
+        except (OSError, FilesystemError) as err:
+            self.respond("550 %s." % _strerror(err))
+        else:
+            self.push_dtp_data(producer, isproducer=True, cmd="LIST")
+            return path
+
+    def ftp_NLST(self, path):
+        if not hasattr(self.fs, "iter_listdir"):
+            return super().ftp_NLST(path)
+        try:
+            if self.fs.isdir(path):
+                listing = self._iter_listdir(path, True)
+            else:
+                self.fs.lstat(path)  # raise exc in case of problems
+                listing = DirectoryListing([ListingEntry(os.path.basename(path), False, None, None)])
+        except (OSError, FilesystemError) as err:
+            self.respond("550 %s." % _strerror(err))
+        else:
+            producer = ListingProducer(listing, ListingFormatter(self.fs, path).format_names)
+            self.push_dtp_data(producer, isproducer=True, cmd="NLST")
+            return path
+
+    def ftp_MLSD(self, path):
+        if not hasattr(self.fs, "iter_listdir"):
+            return super().ftp_MLSD(path)
+        # RFC-3659 requires 501 response code if path is not a directory
+        if not self.fs.isdir(path):
+            self.respond("501 No such directory.")
+            return
+        try:
+            listing = self._iter_listdir(path)
+        except (OSError, FilesystemError) as err:
+            self.respond("550 %s." % _strerror(err))
+        else:
+            perms = self.authorizer.get_perms(self.username)
+            formatter = ListingFormatter(self.fs, path, perms, self._current_facts)
+            self.push_dtp_data(ListingProducer(listing, formatter.format_mlsx), isproducer=True, cmd="MLSD")
+            return path
+
+    def handle_timeout(self):
+        if self._offloading:
+            # waiting on a long storage operation (e.g. renaming a large
+            # directory) is not idling
+            self._idler = self.ioloop.call_later(
+                self.timeout, self.handle_timeout, _errback=self.handle_error
+            )
+            return
+        super().handle_timeout()
+
+    def _process_pending_commands(self):
+        while self._pending_commands and not self._offloading and not self._closed:
+            self.pre_process_command(*self._pending_commands.popleft())
+
+    # Each _preload_<CMD> makes, on a worker thread, the storage calls the
+    # matching ftp_<CMD> will make, with the same arguments.
+
+    def _preload_listing(self, fs, path):
+        # only the first page: the following ones are read while it is sent
+        if fs.preload("isdir", path):
+            fs.preload("iter_listdir", path, True)
+        else:
+            fs.preload("lstat", path)
+
+    _preload_LIST = _preload_NLST = _preload_listing
+
+    def _preload_STAT(self, fs, path):
+        if fs.preload("isdir", path):
+            fs.preload("listdir", path)
+        else:
+            fs.preload("lstat", path)
+
+    def _preload_MLSD(self, fs, path):
+        if fs.preload("isdir", path):
+            fs.preload("iter_listdir", path, False)
+
+    def _preload_MLST(self, fs, path):
+        # format_mlsx() stats through the real filesystem; this only warms
+        # the shared metadata cache
+        fs.preload("stat", path)
+
+    def _preload_SIZE(self, fs, path):
+        if fs.preload("isfile", fs.realpath(path)):
+            fs.preload("getsize", path)
+
+    def _preload_MDTM(self, fs, path):
+        if fs.preload("isfile", fs.realpath(path)):
+            fs.preload("getmtime", path)
+
+    def _preload_RETR(self, fs, file):
+        fs.preload("open", file, "rb")
+        if self._restart_position:
+            fs.preload("getsize", file)
+
+    def _preload_STOR(self, fs, file, mode="w"):
+        if self._restart_position:
+            mode = "r+"
+        fs.preload("open", file, mode + "b")
+        if self._restart_position:
+            fs.preload("getsize", file)
+
+    def _preload_APPE(self, fs, file):
+        if not self._restart_position:
+            fs.preload("open", file, "ab")
+
+    def _preload_XMD5(self, fs, path):
+        if fs.preload("isfile", fs.realpath(path)):
+            fs.preload("checksum", path, "md5")
+
+    def _preload_HASH(self, fs, path):
+        if fs.preload("isfile", fs.realpath(path)):
+            fs.preload("checksum", path, HASH_ALGORITHMS[self.hash_algorithm])
+            fs.preload("getsize", path)
+
+    def _preload_DELE(self, fs, path):
+        fs.preload("remove", path)
+
+    def _preload_MKD(self, fs, path):
+        fs.preload("mkdir", path)
+
+    def _preload_RMD(self, fs, path):
+        if fs.realpath(path) != fs.realpath(fs.root):
+            fs.preload("rmdir", path)
+
+    def _preload_RNFR(self, fs, path):
+        fs.preload("lexists", path)
+
+    def _preload_RNTO(self, fs, path):
+        if self._rnfr:
+            fs.preload("rename", self._rnfr, path)
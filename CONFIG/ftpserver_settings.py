@@ -0,0 +1,17 @@
+"""CONFIG>ftpserver_settings.py"""
+
+# Settings of `manage.py ftpserver`: CONFIG.settings without the web stack,
+# so the FTP server starts (and forks its workers) without importing the
+# admin site, the template engine or the middleware it never uses.
+
+from .settings import *  # noqa: F401,F403
+from .settings import FTPSERVER_INSTALLED_APPS
+
+INSTALLED_APPS = list(FTPSERVER_INSTALLED_APPS)
+
+MIDDLEWARE = []
+
+TEMPLATES = []
+
+# CONFIG.urls mounts the admin site, which is not installed here
+ROOT_URLCONF = None
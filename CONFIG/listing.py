@@ -0,0 +1,263 @@
+"""CONFIG>listing.py"""
+
+import codecs
+import stat
+import time
+
+from pyftpdlib.filesystems import _months_map
+
+from .filesystems import StorageFS
+
+SIX_MONTHS = 180 * 24 * 60 * 60
+# StorageFS.stat() results (PseudoStat) of directories and files
+DIR_MODE = 0o0040770
+FILE_MODE = 0o0100770
+PSEUDO_UID = PSEUDO_GID = 1000
+# Modification times are turned into local times by adding the UTC
+# offset, looked up once per UTC day (days where the offset changes are
+# rendered entry by entry), and dates are rendered once per local day.
+DAY = 24 * 60 * 60
+# UTC days and local days remembered per listing
+TIME_CACHE_SIZE = 65536
+TWO_DIGITS = tuple("%02d" % i for i in range(60))
+# codecs that encode a string of lines to the same bytes as line by line
+STATELESS_CODECS = frozenset(["utf-8", "latin-1", "ascii", "iso8859-1", "cp1252"])
+# hours and minutes of each minute of a day, as in MLSD and LIST lines
+MLSX_MINUTES = tuple("%02d%02d" % divmod(minute, 60) for minute in range(DAY // 60))
+LIST_MINUTES = tuple("%02d:%02d" % divmod(minute, 60) for minute in range(DAY // 60))
+
+
+class ListingFormatter:
+    """
+    Renders the LIST, MLSD and NLST lines of a directory listing straight
+    from its ListingEntry records (see DirectoryListing.take()), a batch
+    at a time.
+
+    pyftpdlib's AbstractedFS.format_list() and format_mlsx() stat() every
+    entry, build a PseudoStat for it and format it field by field. Here
+    everything that is the same for every directory or every file (mode,
+    owner, permissions, facts) is rendered once per listing into a line
+    template, and dates once per day, so a line costs one template
+    substitution. The output is byte for byte what pyftpdlib would send:
+    entries whose size or mtime the listing does not carry, and every
+    entry when StorageFS.stat() is replaced by a storage patch (the stat
+    of a local file is not a PseudoStat), go through pyftpdlib's own
+    formatter.
+    """
+
+    def __init__(self, fs, basedir, perms="", facts=()):
+        self.fs = fs
+        self.basedir = basedir
+        self.perms = perms
+        self.facts = facts
+        cmd_channel = fs.cmd_channel
+        self._encoding = cmd_channel.encoding
+        self._errors = cmd_channel.unicode_errors
+        try:
+            self._stateless = codecs.lookup(self._encoding).name in STATELESS_CODECS
+        except LookupError:
+            self._stateless = False
+        self._timefunc = time.gmtime if cmd_channel.use_gmt_times else time.localtime
+        self._now = time.time()
+        self._offsets = {}
+        self._days = {}
+        self._list_templates = None
+        self._mlsx_templates = None
+
+    @staticmethod
+    def _pseudo_stat(method):
+        return getattr(method, "__func__", None) is StorageFS.stat
+
+    # --------------------- NLST ---------------------
+
+    def format_names(self, entries):
+        encoding, errors = self._encoding, self._errors
+        return b"".join([(entry.name + "\r\n").encode(encoding, errors) for entry in entries])
+
+    # --------------------- LIST ---------------------
+
+    def format_list(self, entries):
+        """Return the LIST lines of `entries` (AbstractedFS.format_list())."""
+        fs = self.fs
+        if not self._pseudo_stat(fs.lstat):
+            return b"".join(fs.format_list(self.basedir, [entry.name for entry in entries]))
+        if self._list_templates is None:
+            owner = "%-8s %-8s" % (fs.get_user_by_uid(PSEUDO_UID), fs.get_group_by_gid(PSEUDO_GID))
+            self._list_templates = tuple(
+                ("%s %3s %s " % (stat.filemode(mode), 1, owner)).replace("%", "%%") + "%8s %s %s\r\n"
+                for mode in (FILE_MODE, DIR_MODE)
+            )
+        templates = self._list_templates
+        now = self._now
+        offsets, days = self._offsets, self._days
+        output = []
+        lines = []
+        pending = []
+        for name, is_dir, size, mtime in entries:
+            if mtime is None or type(size) is not int:
+                pending.append(name)
+                continue
+            mtime = int(mtime)
+            offset = offsets.get(mtime // DAY)
+            if offset is None:
+                offset = self._utc_offset(mtime // DAY)
+            day = False
+            if offset is not False:
+                day, seconds = divmod(mtime + offset, DAY)
+                day = days.get(day) or self._day(day)
+            if not day:
+                mtimestr = self._list_time(mtime)
+            elif now - mtime > SIX_MONTHS:
+                mtimestr = day[2]
+            else:
+                mtimestr = day[1] + LIST_MINUTES[seconds // 60]
+            if pending:
+                self._flush(output, lines)
+                output.extend(fs.format_list(self.basedir, pending))
+                pending = []
+            lines.append(templates[is_dir] % (size, mtimestr, name))
+        self._flush(output, lines)
+        if pending:
+            output.extend(fs.format_list(self.basedir, pending))
+        return b"".join(output)
+
+    def _list_time(self, mtime):
+        timefunc = self._timefunc
+        t = timefunc(mtime)
+        fmtstr = "%d  %Y" if self._now - mtime > SIX_MONTHS else "%d %H:%M"
+        try:
+            return "%s %s" % (_months_map[t.tm_mon], time.strftime(fmtstr, t))
+        except ValueError:
+            t = timefunc()
+            return "%s %s" % (_months_map[t.tm_mon], time.strftime("%d %H:%M", t))
+
+    def _flush(self, output, lines):
+        """Encode the rendered `lines` onto `output` and empty them."""
+        if not lines:
+            return
+        encoding, errors = self._encoding, self._errors
+        if self._stateless:
+            output.append("".join(lines).encode(encoding, errors))
+        else:
+            output.extend([line.encode(encoding, errors) for line in lines])
+        del lines[:]
+
+    # --------------------- MLSD ---------------------
+
+    def format_mlsx(self, entries):
+        """Return the MLSD lines of `entries` (AbstractedFS.format_mlsx())."""
+        fs = self.fs
+        facts = self.facts
+        if not self._pseudo_stat(fs.stat) or "create" in facts:
+            return b"".join(fs.format_mlsx(self.basedir, [entry.name for entry in entries], self.perms, facts))
+        if self._mlsx_templates is None:
+            self._mlsx_templates = (self._mlsx_template(False), self._mlsx_template(True))
+        templates = self._mlsx_templates
+        offsets, days = self._offsets, self._days
+        output = []
+        lines = []
+        pending = []
+        for name, is_dir, size, mtime in entries:
+            if mtime is None or type(size) is not int or name in (".", ".."):
+                pending.append(name)
+                continue
+            mtime = int(mtime)
+            offset = offsets.get(mtime // DAY)
+            if offset is None:
+                offset = self._utc_offset(mtime // DAY)
+            day = False
+            if offset is not False:
+                day, seconds = divmod(mtime + offset, DAY)
+                day = days.get(day) or self._day(day)
+            if day:
+                modify = day[0] + MLSX_MINUTES[seconds // 60] + TWO_DIGITS[seconds % 60]
+            else:
+                modify = self._mlsx_time(mtime)
+                if modify is None:
+                    pending.append(name)
+                    continue
+            if pending:
+                self._flush(output, lines)
+                output.extend(fs.format_mlsx(self.basedir, pending, self.perms, facts))
+                pending = []
+            lines.append(templates[is_dir] % (modify, size, name))
+        self._flush(output, lines)
+        if pending:
+            output.extend(fs.format_mlsx(self.basedir, pending, self.perms, facts))
+        return b"".join(output)
+
+    def _mlsx_template(self, is_dir):
+        perms = self.perms
+        if is_dir:
+            perm = "".join([x for x in perms if x not in "arw"])
+            if ("w" in perms) or ("a" in perms) or ("f" in perms):
+                perm += "c"
+            if "d" in perms:
+                perm += "p"
+        else:
+            perm = "".join([x for x in perms if x not in "celmp"])
+        mode = DIR_MODE if is_dir else FILE_MODE
+        values = {
+            "type": "dir" if is_dir else "file",
+            "perm": perm.replace("%", "%%"),
+            "size": "%s",
+            "modify": "%s",
+            "unix.mode": oct(mode & 511),
+            "unix.uid": PSEUDO_UID,
+            "unix.gid": PSEUDO_GID,
+            "unique": "0g0",  # st_dev 0, st_ino 0
+        }
+        facts = sorted(fact for fact in values if fact in self.facts)
+        # rendered with (modify, size, name), "modify" sorting before
+        # "size"; "%.0s" consumes the value of a fact left out
+        template = "".join(["%s=%s;" % (fact, values[fact]) for fact in facts])
+        if "modify" not in facts:
+            template = "%.0s" + template
+        if "size" not in facts:
+            template += "%.0s"
+        return template + " %s\r\n"
+
+    def _mlsx_time(self, mtime):
+        try:
+            return time.strftime("%Y%m%d%H%M%S", self._timefunc(mtime))
+        except ValueError:
+            # pyftpdlib then leaves the fact out
+            return None
+
+    # --------------------- times ---------------------
+
+    def _utc_offset(self, utc_day):
+        """Return the UTC offset of the times of `utc_day` (days since the
+        epoch), or False if it changes during that day."""
+        offsets = self._offsets
+        if len(offsets) >= TIME_CACHE_SIZE:
+            offsets.clear()
+        offset = False
+        try:
+            first = self._timefunc(utc_day * DAY).tm_gmtoff
+            if first is not None and first == self._timefunc(utc_day * DAY + DAY - 1).tm_gmtoff:
+                offset = first
+        except (ValueError, OverflowError, OSError):
+            pass
+        offsets[utc_day] = offset
+        return offset
+
+    def _day(self, day):
+        """Render local day `day`: return (MLSD "YYYYmmdd", LIST "Mon DD ",
+        LIST "Mon DD  YYYY"), or False if it cannot be."""
+        days = self._days
+        if len(days) >= TIME_CACHE_SIZE:
+            days.clear()
+        strings = False
+        try:
+            t = time.gmtime(day * DAY)
+            month = _months_map[t.tm_mon]
+            strings = (
+                time.strftime("%Y%m%d", t),
+                "%s %s" % (month, time.strftime("%d ", t)),
+                "%s %s" % (month, time.strftime("%d  %Y", t)),
+            )
+        except (ValueError, OverflowError, OSError):
+            pass
+        days[day] = strings
+        return strings
@@ -1,13 +1,19 @@
 # PYTHON IMPORTS
 import os
+from logging.handlers import TimedRotatingFileHandler
 
 # SETTINGS IMPORTS
 from .local_settings import LOGS_DIR
 
 
-# if not exists, create
-if not os.path.exists(LOGS_DIR):
-    os.makedirs(LOGS_DIR)
+class LogFileHandler(TimedRotatingFileHandler):
+    """TimedRotatingFileHandler creating the directory of its file when it
+    first opens it, rather than when the settings are imported."""
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
 
 LOGGING = {
     'version': 1,
@@ -22,6 +28,9 @@ LOGGING = {
             'format': '{asctime} {levelname} {message}',
             'style': '{',
         },
+        'xferlog': {
+            '()': 'CONFIG.logqueue.TransferFormatter',
+        },
     },  # formatters
     'handlers': {
         'console': {
@@ -32,8 +41,18 @@ LOGGING = {
         'file': {
             'level': 'DEBUG',
             'formatter': 'verbose',
-            'class': 'logging.handlers.TimedRotatingFileHandler',
+            'class': 'CONFIG.logging.LogFileHandler',
             'filename': os.path.join(LOGS_DIR, "debug.log"),
+            'delay': True,
+            'when': 'midnight',
+            'backupCount': 30,
+        },
+        'xferlog': {
+            'level': 'INFO',
+            'formatter': 'xferlog',
+            'class': 'CONFIG.logging.LogFileHandler',
+            'filename': os.path.join(LOGS_DIR, "xferlog.jsonl"),
+            'delay': True,
             'when': 'midnight',
             'backupCount': 30,
         },
@@ -48,6 +67,12 @@ LOGGING = {
             'level': os.getenv('DJANGO_LOG_LEVEL', 'DEBUG').upper(),
             'propagate': False,  # required to eliminate duplication on root
         },
+        # one JSON line per FTP file transfer (CONFIG.ftp_handler)
+        'CONFIG.xferlog': {
+            'handlers': ['xferlog'],
+            'level': 'INFO',
+            'propagate': False,
+        },
         'API': {
             'handlers': ['console', 'file'],
             'level': os.getenv('DJANGO_LOG_LEVEL', 'DEBUG').upper(),
@@ -0,0 +1,278 @@
+"""CONFIG>logqueue.py"""
+
+import json
+import logging
+import logging.config
+import logging.handlers
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOG_QUEUE = {
+    # hand log records to a background thread instead of writing them out
+    # in the thread (usually the IOLoop) that logs them
+    "ENABLED": True,
+    # records waiting to be written; when this many wait, records below
+    # WARNING are dropped
+    "MAX_RECORDS": 10000,
+    # further records of level WARNING and above accepted on top of
+    # MAX_RECORDS before they are dropped too
+    "RESERVE": 1000,
+    # characters of a message kept (longer ones are cut)
+    "MAX_MESSAGE_SIZE": 8192,
+    # fraction of the DEBUG records of a logger (and its children) that are
+    # logged; the DEBUG records of other loggers are all logged
+    "DEBUG_SAMPLING": {"CONFIG.filesystems": 0.01},
+}
+
+# the structured transfer log: one record per file transfer (RETR, STOR,
+# STOU, APPE), formatted by TransferFormatter
+TRANSFER_LOGGER = "CONFIG.xferlog"
+
+DROPPED_MESSAGE = "%d log records dropped, the log queue was full"
+
+
+def get_log_queue_settings():
+    conf = dict(DEFAULT_LOG_QUEUE)
+    conf.update(getattr(settings, "FTPSERVER_LOG_QUEUE", None) or {})
+    return conf
+
+
+class LogQueue:
+    """
+    Bounded queue of log records written out by one background thread.
+
+    Nothing blocks the threads logging: once MAX_RECORDS records wait,
+    full() tells them to drop records below WARNING, and past
+    MAX_RECORDS + RESERVE all records. The thread is only woken up when
+    it went idle, and then writes out
+    every record waiting, so a burst of records costs a single wakeup.
+    It is paused across fork() and a new one, with an empty queue,
+    started in the child, so a forked worker neither inherits a handler
+    in the middle of a write nor records of its parent.
+    """
+
+    def __init__(self, max_records=10000, reserve=1000):
+        self.max_records = max_records
+        self.reserve = reserve
+        self._records = None
+        self._wakeup = None
+        self._thread = None
+        self._busy = None
+        self._stopped = False
+        self._start()
+        os.register_at_fork(
+            before=self._before_fork,
+            after_in_parent=self._after_fork_in_parent,
+            after_in_child=self._after_fork_in_child,
+        )
+
+    def _start(self):
+        self._records = deque()
+        self._wakeup = threading.Event()
+        self._busy = threading.Lock()
+        self._thread = threading.Thread(target=self._run, args=(self._records, self._wakeup, self._busy),
+                                        name="log-queue", daemon=True)
+        self._thread.start()
+
+    def _before_fork(self):
+        self._busy.acquire()
+
+    def _after_fork_in_parent(self):
+        self._busy.release()
+
+    def _after_fork_in_child(self):
+        if not self._stopped:
+            self._start()
+
+    def full(self, level):
+        """Return whether a record of `level` has to be dropped."""
+        waiting = len(self._records)
+        return waiting >= self.max_records and (
+            level < logging.WARNING or waiting >= self.max_records + self.reserve)
+
+    def put(self, handler, record):
+        """Queue `record` for `handler`."""
+        self._records.append((handler, record))
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    @staticmethod
+    def _run(records, wakeup, busy):
+        while True:
+            wakeup.wait()
+            # cleared before the records are taken: one queued after the
+            # last of them sets it again
+            wakeup.clear()
+            while records:
+                item = records.popleft()
+                if item is None:
+                    return
+                handler, record = item
+                with busy:
+                    try:
+                        handler.deliver(record)
+                    except Exception:
+                        handler.handleError(record)
+
+    def stop(self, timeout=5):
+        """Write out the records queued so far and stop the thread."""
+        self._stopped = True
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._records.append(None)
+        self._wakeup.set()
+        thread.join(timeout)
+
+
+class DebugSampler(logging.Filter):
+    """Let through only a fraction, `rates[name]`, of the DEBUG records of
+    the loggers named in `rates` and their children."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._cache = {}
+
+    def _rate(self, name):
+        rate = self._cache.get(name)
+        if rate is None:
+            rate = 1.0
+            prefix = name
+            while prefix:
+                if prefix in self.rates:
+                    rate = float(self.rates[prefix])
+                    break
+                prefix = prefix.rpartition(".")[0]
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+
+class QueueingHandler(logging.handlers.QueueHandler):
+    """
+    Stand-in for the handlers (`targets`) of a logger: records are
+    formatted into their message by the thread that logs them, cut to
+    `max_message_size` characters and queued on `log_queue`, whose thread
+    passes them on to the targets. Dropped records are counted and
+    reported to the targets with the next record that gets through.
+    """
+
+    def __init__(self, log_queue, targets, max_message_size=8192):
+        logging.Handler.__init__(self)
+        self.queue = log_queue
+        self.targets = list(targets)
+        self.max_message_size = max_message_size
+        self.dropped = 0
+
+    def prepare(self, record):
+        # what QueueHandler.prepare() does, with a cheaper copy than
+        # copy.copy(): the record may go on to the handlers of other loggers
+        msg = self.format(record)
+        if len(msg) > self.max_message_size:
+            msg = msg[:self.max_message_size] + " [...]"
+        prepared = object.__new__(type(record))
+        prepared.__dict__.update(record.__dict__)
+        prepared.message = prepared.msg = msg
+        prepared.args = prepared.exc_info = prepared.exc_text = prepared.stack_info = None
+        return prepared
+
+    def emit(self, record):
+        # called with the handler's lock held; a record that would be
+        # dropped is not even formatted
+        if self.queue.full(record.levelno):
+            self.dropped += 1
+            return
+        try:
+            self.queue.put(self, self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def deliver(self, record):
+        """Pass `record` on to the targets (in the queue's thread)."""
+        if self.dropped:
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+            self._handle(logging.LogRecord(
+                record.name, logging.WARNING, __file__, 0, DROPPED_MESSAGE, (dropped,), None,
+            ))
+        self._handle(record)
+
+    def _handle(self, record):
+        for target in self.targets:
+            if record.levelno >= target.level:
+                target.handle(record)
+
+    def close(self):
+        # the queue's thread writes out what is left before the targets
+        # are closed (logging.shutdown() closes the newest handlers first)
+        self.queue.stop()
+        super().close()
+
+
+_log_queue = None
+
+
+def configure(config):
+    """
+    LOGGING_CONFIG callable: apply the dictConfig `config`, then, with
+    FTPSERVER_LOG_QUEUE enabled, put the handlers of the root logger and
+    of every logger it names behind QueueingHandlers sharing one LogQueue.
+    """
+    global _log_queue
+    logging.config.dictConfig(config)
+    conf = get_log_queue_settings()
+    if not conf["ENABLED"]:
+        return
+    if _log_queue is not None:
+        _log_queue.stop()
+    _log_queue = LogQueue(conf["MAX_RECORDS"], conf["RESERVE"])
+    sampler = DebugSampler(conf["DEBUG_SAMPLING"])
+    names = {"" if name == "root" else name for name in config.get("loggers", {})}
+    for name in names | {""}:
+        target = logging.getLogger(name or None)
+        if not target.handlers:
+            continue
+        handler = QueueingHandler(_log_queue, target.handlers, conf["MAX_MESSAGE_SIZE"])
+        if conf["DEBUG_SAMPLING"]:
+            handler.addFilter(sampler)
+        target.handlers = [handler]
+
+
+def stop_log_queue():
+    """Write out the queued records; for processes leaving with os._exit(),
+    which skips logging.shutdown()."""
+    if _log_queue is not None:
+        _log_queue.stop()
+
+
+class TransferFormatter(logging.Formatter):
+    """
+    xferlog-style JSON lines: one object per transfer with the fields of
+    wu-ftpd's xferlog (time, transfer seconds, remote host, bytes, file,
+    type, direction, access mode, user, service, completion status) under
+    short keys, plus the FTP command. Records without transfer fields
+    are written as {"time", "msg"}.
+    """
+
+    def format(self, record):
+        line = {"time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+                + ".%03dZ" % record.msecs}
+        transfer = getattr(record, "transfer", None)
+        if transfer is not None:
+            line.update(transfer)
+        else:
+            line["msg"] = record.getMessage()
+        return json.dumps(line, separators=(",", ":"), ensure_ascii=False)
@@ -0,0 +1,54 @@
+"""CONFIG>management>commands>ftpserver.py"""
+
+import functools
+
+from django.core.management.base import CommandError
+from django_ftpserver import utils
+from django_ftpserver.management.commands import ftpserver
+
+from CONFIG.metrics import start_listener
+from CONFIG.pipeline import get_upload_pipeline
+from CONFIG.servers import PreforkFTPServer
+from CONFIG.startup import log_ready, warm_up
+
+
+class Command(ftpserver.Command):
+    """django_ftpserver's ftpserver command with a pre-forked multi-process
+    mode (--workers / FTPSERVER_WORKERS), the FTPSERVER_METRICS listener
+    and the FTPSERVER_UPLOAD_PIPELINE workers. The storage is made ready
+    before the server accepts its first login."""
+
+    # the system checks import the URLconf and with it the admin site;
+    # run `manage.py check` with the full settings instead
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--workers', action='store', dest='workers', type=int,
+            help="number of pre-forked worker processes (0: one per CPU).")
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if workers is None:
+            workers = utils.get_settings_value('FTPSERVER_WORKERS')
+        if workers is not None and workers < 0:
+            raise CommandError("Invalid number of workers: {}".format(workers))
+        self.workers = workers
+        super().handle(*args, **options)
+
+    def make_server(self, server_class, *args, **kwargs):
+        if self.workers not in (None, 1):
+            server_class = functools.partial(PreforkFTPServer, workers=self.workers)
+        else:
+            # pre-forked workers start their own
+            start_listener()
+            get_upload_pipeline()
+        server = super().make_server(server_class, *args, **kwargs)
+        if isinstance(server, PreforkFTPServer):
+            # imports only: clients and threads do not survive the fork
+            warm_up(server.handler, full=False)
+        else:
+            warm_up(server.handler)
+            log_ready()
+        return server
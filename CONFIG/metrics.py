@@ -0,0 +1,332 @@
+"""CONFIG>metrics.py"""
+
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+
+from .offload import ProcessLocal
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS = {
+    # record metrics and serve them from the ftpserver process; when off,
+    # nothing is instrumented
+    "ENABLED": False,
+    # address of the /metrics listener; pre-forked worker N uses PORT + N
+    "ADDRESS": "127.0.0.1",
+    "PORT": 9121,
+}
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# storage methods timed by Metrics.instrument_storage()
+STORAGE_OPERATIONS = ("exists", "listdir", "size", "get_modified_time", "open", "save", "delete")
+
+# name -> (type, help)
+FAMILIES = {
+    "ftp_sessions_active": ("gauge", "FTP sessions currently open."),
+    "ftp_sessions_total": ("counter", "FTP sessions opened."),
+    "ftp_logins_total": ("counter", "Login attempts, by how the password was checked and result."),
+    "ftp_commands_total": ("counter", "FTP commands processed, by command and reply class."),
+    "ftp_command_duration_seconds": ("histogram", "Time from receiving an FTP command to its reply."),
+    "ftp_transfers_total": ("counter", "Data transfers, by command and result."),
+    "ftp_transfer_bytes_total": ("counter", "Bytes sent or received on data channels."),
+    "ftp_transfer_duration_seconds": ("histogram", "Duration of data transfers."),
+    "ftp_storage_calls_total": ("counter", "Calls to the Django storage backend, by operation and result."),
+    "ftp_storage_call_duration_seconds": ("histogram", "Duration of calls to the Django storage backend."),
+    "ftp_s3_requests_total": ("counter", "S3 API requests, by operation and result."),
+    "ftp_s3_request_duration_seconds": ("histogram", "Time until the response headers of S3 API requests."),
+    "ftp_metadata_cache_hits_total": ("counter", "Metadata cache lookups answered from the cache."),
+    "ftp_metadata_cache_misses_total": ("counter", "Metadata cache lookups that went to the storage."),
+    "ftp_metadata_cache_entries": ("gauge", "Entries held by the metadata cache."),
+    "ftp_block_cache_hits_total": ("counter", "Blocks served from the on-disk block cache."),
+    "ftp_block_cache_misses_total": ("counter", "Blocks downloaded because they were not cached."),
+    "ftp_block_cache_hit_bytes_total": ("counter", "Bytes served from the on-disk block cache."),
+    "ftp_block_cache_miss_bytes_total": ("counter", "Bytes downloaded because they were not cached."),
+    "ftp_block_cache_evictions_total": ("counter", "Objects evicted from the block cache."),
+    "ftp_block_cache_bytes": ("gauge", "Bytes of blocks held by the block cache."),
+    "ftp_block_cache_objects": ("gauge", "Objects held by the block cache."),
+}
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of one ftpserver process,
+    rendered in the Prometheus text format.
+
+    Values are keyed by family name (see FAMILIES) and a tuple of
+    (label, value) pairs. Collectors registered with add_collector() are
+    called at render time for values kept elsewhere (cache statistics).
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._histograms = {}  # key -> [count per bucket..., count above, sum]
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    def add_collector(self, collector):
+        """Register `collector()`, returning (name, labels, value) tuples."""
+        self._collectors.append(collector)
+
+    # --------------------- recording ---------------------
+
+    def session_opened(self):
+        self.inc("ftp_sessions_total")
+        self.inc("ftp_sessions_active")
+
+    def session_closed(self):
+        self.inc("ftp_sessions_active", value=-1)
+
+    def login(self, check, result):
+        """Record a login attempt; `check` is "cached", "hasher" or
+        "throttled"."""
+        self.inc("ftp_logins_total", (("check", check), ("result", result)))
+
+    def command(self, cmd, seconds, reply):
+        """Record an FTP command; `reply` is the first digit of its last
+        reply code (e.g. "2"), or None."""
+        self.inc("ftp_commands_total", (("command", cmd), ("reply", "%sxx" % (reply or "-"))))
+        self.observe("ftp_command_duration_seconds", (("command", cmd),), seconds)
+
+    def transfer(self, cmd, sent, received, seconds, finished):
+        cmd = cmd or "-"
+        self.inc("ftp_transfers_total", (("command", cmd), ("result", "complete" if finished else "incomplete")))
+        if sent:
+            self.inc("ftp_transfer_bytes_total", (("command", cmd), ("direction", "sent")), sent)
+        if received:
+            self.inc("ftp_transfer_bytes_total", (("command", cmd), ("direction", "received")), received)
+        self.observe("ftp_transfer_duration_seconds", (("command", cmd),), seconds)
+
+    def instrument_storage(self, storage):
+        """Time the STORAGE_OPERATIONS of the storage instance `storage`."""
+        backend = type(storage).__name__
+        for operation in STORAGE_OPERATIONS:
+            method = getattr(storage, operation, None)
+            if method is not None:
+                setattr(storage, operation, self._timed(method, backend, operation))
+        return storage
+
+    def _timed(self, method, backend, operation):
+        labels = (("backend", backend), ("operation", operation))
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = "error"
+            try:
+                value = method(*args, **kwargs)
+                result = "ok"
+                return value
+            finally:
+                self.inc("ftp_storage_calls_total", labels + (("result", result),))
+                self.observe("ftp_storage_call_duration_seconds", labels, time.perf_counter() - start)
+
+        return timed
+
+    def instrument_client(self, client):
+        """Time the S3 requests made through the boto3 client `client`.
+        Registering again is a no-op."""
+        events = client.meta.events
+        events.register("before-call.s3", self._before_s3_call, unique_id="ftpserver-metrics-before")
+        events.register("after-call.s3", self._after_s3_call, unique_id="ftpserver-metrics-after")
+        events.register("after-call-error.s3", self._s3_call_failed, unique_id="ftpserver-metrics-error")
+        return client
+
+    def _before_s3_call(self, model, context, **kwargs):
+        context["ftpserver_metrics"] = (model.name, time.perf_counter())
+
+    def _after_s3_call(self, http_response, context, **kwargs):
+        self._s3_call_done(context, "ok" if http_response.status_code < 300 else str(http_response.status_code))
+
+    def _s3_call_failed(self, context, **kwargs):
+        self._s3_call_done(context, "error")
+
+    def _s3_call_done(self, context, result):
+        operation, start = context.pop("ftpserver_metrics", (None, None))
+        if operation is None:
+            return
+        self.inc("ftp_s3_requests_total", (("operation", operation), ("result", result)))
+        self.observe("ftp_s3_request_duration_seconds", (("operation", operation),), time.perf_counter() - start)
+
+    # --------------------- rendering ---------------------
+
+    def render(self):
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._values.items():
+                samples.setdefault(name, []).append((labels, value))
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    samples.setdefault(name, []).append((labels, value))
+            except Exception:
+                logger.warning("metrics collector %r failed", collector, exc_info=True)
+        for (name, labels), histogram in histograms.items():
+            samples.setdefault(name, []).append((labels, histogram))
+
+        lines = []
+        for name in sorted(samples):
+            kind, help_text = FAMILIES.get(name, ("untyped", ""))
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in sorted(samples[name], key=lambda sample: sample[0]):
+                if kind != "histogram":
+                    lines.append("%s%s %s" % (name, _labels(labels), value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (name, _labels(labels + (("le", bound),)), cumulative))
+                lines.append("%s_sum%s %s" % (name, _labels(labels), value[-1]))
+                lines.append("%s_count%s %d" % (name, _labels(labels), cumulative))
+        return "\n".join(lines) + "\n"
+
+
+def _cache_samples():
+    from .blockcache import get_block_cache
+    from .cache import get_metadata_cache
+
+    stats = get_metadata_cache().stats()
+    yield "ftp_metadata_cache_hits_total", (), stats["hits"]
+    yield "ftp_metadata_cache_misses_total", (), stats["misses"]
+    yield "ftp_metadata_cache_entries", (), stats["entries"]
+    block_cache = get_block_cache()
+    if block_cache is not None:
+        stats = block_cache.stats()
+        yield "ftp_block_cache_hits_total", (), stats["hits"]
+        yield "ftp_block_cache_misses_total", (), stats["misses"]
+        yield "ftp_block_cache_hit_bytes_total", (), stats["hit_bytes"]
+        yield "ftp_block_cache_miss_bytes_total", (), stats["miss_bytes"]
+        yield "ftp_block_cache_evictions_total", (), stats["evictions"]
+        yield "ftp_block_cache_bytes", (), stats["cached_bytes"]
+        yield "ftp_block_cache_objects", (), stats["objects"]
+
+
+def get_metrics_settings():
+    conf = dict(DEFAULT_METRICS)
+    conf.update(getattr(settings, "FTPSERVER_METRICS", None) or {})
+    return conf
+
+
+def _create_metrics():
+    if not get_metrics_settings()["ENABLED"]:
+        return None
+    metrics = Metrics()
+    metrics.add_collector(_cache_samples)
+    return metrics
+
+
+_metrics = ProcessLocal(_create_metrics)
+
+
+def get_metrics():
+    """Return this process's Metrics, or None when metrics are disabled."""
+    return _metrics.get()
+
+
+# --------------------- listener ---------------------
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        metrics = get_metrics()
+        if self.path.split("?", 1)[0] != "/metrics" or metrics is None:
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+
+class MetricsListener:
+    """
+    HTTP listener serving GET /metrics on a daemon thread of the
+    ftpserver process.
+
+    If the port is taken (e.g. by a worker of the previous generation
+    still draining after a reload), binding is retried every second until
+    it succeeds or the listener is closed.
+    """
+
+    retry_interval = 1
+
+    def __init__(self, address):
+        self.address = address
+        self._server = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="metrics-listener", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        warned = False
+        while not self._closed:
+            try:
+                server = ThreadingHTTPServer(self.address, _MetricsRequestHandler)
+            except OSError as err:
+                if not warned:
+                    warned = True
+                    logger.warning("metrics listener cannot bind %s:%s (%s), retrying", *self.address, err)
+                time.sleep(self.retry_interval)
+                continue
+            server.daemon_threads = True
+            self._server = server
+            if self._closed:
+                break
+            logger.info("serving metrics on http://%s:%s/metrics", *self.address)
+            server.serve_forever(poll_interval=0.5)
+        if self._server is not None:
+            self._server.server_close()
+
+    def close(self):
+        """Stop serving; does not wait for the listener thread."""
+        self._closed = True
+        if self._server is not None:
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+
+
+def start_listener(offset=0):
+    """Start the /metrics listener of this process (at PORT + `offset`),
+    or return None when metrics are disabled."""
+    if get_metrics() is None:
+        return None
+    conf = get_metrics_settings()
+    return MetricsListener((conf["ADDRESS"], int(conf["PORT"]) + offset)).start()
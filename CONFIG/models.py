@@ -0,0 +1,58 @@
+"""CONFIG>models.py"""
+
+from django.db import models
+
+
+class UploadJob(models.Model):
+    """
+    A file received over FTP waiting for (or going through) the stages of
+    the post-upload pipeline (see CONFIG.pipeline).
+
+    `stage` is the index of the next stage to run, so a job retried after
+    a failure resumes where it stopped. `run_after` is when a pending job
+    may be picked up next, and for a running job when its lease expires
+    and it may be picked up again.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    path = models.CharField(max_length=1024, help_text="FTP path of the file")
+    key = models.CharField(max_length=1024, help_text="storage key of the file")
+    storage_class = models.CharField(max_length=255)
+    username = models.CharField(max_length=150, blank=True)
+    size = models.BigIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    stage = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    run_after = models.DateTimeField()
+    received_at = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"])]
+
+    def __str__(self):
+        return "%s (%s)" % (self.path, self.status)
+
+    def get_storage(self):
+        """Return the storage instance the file was uploaded to."""
+        from django.utils.module_loading import import_string
+
+        from .clients import get_client_settings, get_storage
+
+        options = get_client_settings()["USER_OPTIONS"].get(self.username) or {}
+        return get_storage(import_string(self.storage_class), options)
+
+    def open(self, mode="rb"):
+        """Open the uploaded file through its storage."""
+        return self.get_storage().open(self.key, mode)
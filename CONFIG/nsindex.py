@@ -0,0 +1,391 @@
+"""CONFIG>nsindex.py"""
+
+import atexit
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+from . import s3ops
+from .offload import ProcessLocal
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NAMESPACE_INDEX = {
+    # directory holding one SQLite index file per bucket and location;
+    # empty disables the index
+    "DIRECTORY": "",
+    # seconds between two reconciliations of the index with the bucket
+    "RECONCILE_INTERVAL": 300,
+    # seconds after the start of the last complete reconciliation beyond
+    # which the index is not used until the next one completes (e.g. after
+    # the server was stopped for a while)
+    "MAX_AGE": 3600,
+}
+
+# keys read per query when listing a directory from the index
+LISTING_BATCH_SIZE = 1000
+
+# keys asked for per ListObjectsV2 request while reconciling (S3's maximum)
+SCAN_PAGE_SIZE = 1000
+
+# seconds a process holds the right to reconcile an index file without
+# renewing it; renewed after every page
+LEASE_TIME = 60
+
+# seconds between two checks, by the processes not reconciling, of when
+# the index was last reconciled
+READY_CHECK_INTERVAL = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    etag TEXT,
+    -- the object was deleted through the FTP server (tombstone)
+    deleted INTEGER NOT NULL DEFAULT 0,
+    -- time.time() of the last write through the FTP server, 0 when the
+    -- row comes from a listing
+    touched REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def get_namespace_index_settings():
+    conf = dict(DEFAULT_NAMESPACE_INDEX)
+    conf.update(getattr(settings, "FTPSERVER_NAMESPACE_INDEX", None) or {})
+    return conf
+
+
+def prefix_end(prefix):
+    """Return the smallest string greater than every string starting
+    with the non-empty `prefix`."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _is_file(entry):
+    return not entry[1]
+
+
+class NamespaceIndex:
+    """
+    Persistent local mirror of the keys, sizes, mtimes and ETags of every
+    object under the location of an S3 bucket, in a SQLite file, so that
+    stats and directory listings are answered without a request to S3.
+
+    Keys are stored sorted, as S3 lists them; a directory is any prefix
+    of a key ending with "/", so a listing seeks over the index once per
+    subdirectory. Writes made through the FTP server update the index
+    right away (put(), delete(), refresh(), rescan()), and a background
+    thread reconciles it with a full listing of the bucket every
+    RECONCILE_INTERVAL seconds, one page at a time: rows written through
+    the FTP server after a page was requested are left alone, and deletes
+    are kept as tombstones until a listing confirms them, so a reconcile
+    racing with uploads never undoes them.
+
+    The file is shared by the processes of the server (WAL mode); one of
+    them at a time holds the lease to reconcile it. The index is only
+    used (`ready`) once a reconciliation completed less than MAX_AGE
+    seconds ago; until then StorageFS asks S3 as usual. Changes made to
+    the bucket by other clients show up at the next reconciliation.
+    """
+
+    def __init__(self, path, storage, reconcile_interval=300, max_age=3600):
+        self.path = path
+        self.storage = storage
+        self.reconcile_interval = reconcile_interval
+        self.max_age = max_age
+        # bucket key of the location: "" or "location/"
+        self.root = s3ops.s3_key(storage, "")
+        self._owner = "%d:%s" % (os.getpid(), os.urandom(4).hex())
+        self._local = threading.local()
+        self._fresh_until = 0
+        self._stopping = threading.Event()
+        self._thread = None
+        self._connection().executescript(SCHEMA)
+        self._check_ready()
+
+    def _connection(self):
+        """Return this thread's connection to the index file."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _get_meta(self, conn, name):
+        row = conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, conn, name, value):
+        conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, str(value)))
+
+    @property
+    def ready(self):
+        return time.time() < self._fresh_until
+
+    def _check_ready(self):
+        reconciled = self._get_meta(self._connection(), "reconciled_at")
+        self._fresh_until = float(reconciled) + self.max_age if reconciled else 0
+
+    # --------------------- lookups ---------------------
+
+    def lookup(self, key):
+        """Return (is_dir, size, mtime) of the storage key `key`, or None
+        if nothing exists there; an object wins over a directory of the
+        same name, as with s3ops.probe_key()."""
+        key = key.rstrip("/")
+        if not key:
+            return True, 0, 0
+        conn = self._connection()
+        row = conn.execute("SELECT size, mtime FROM objects WHERE key = ? AND deleted = 0", (key,)).fetchone()
+        if row is not None:
+            return False, row[0], row[1]
+        row = conn.execute(
+            "SELECT 1 FROM objects WHERE key >= ? AND key < ? AND deleted = 0 LIMIT 1",
+            (key + "/", prefix_end(key + "/")),
+        ).fetchone()
+        return (True, 0, 0) if row is not None else None
+
+    def listing(self, key):
+        """Yield the entries of the directory `key` ("" or ending with
+        "/") as lists of (name, is_dir, size, mtime), in the order S3
+        lists them: batches follow each other in key order, each holding
+        its directories, then its files."""
+        end = " AND key < ?" if key else ""
+        limit = (prefix_end(key),) if key else ()
+        bound, inclusive = key, True
+        batch = []
+        while True:
+            # pages may be read on another thread (DirectoryListing)
+            rows = self._connection().execute(
+                "SELECT key, size, mtime FROM objects WHERE key %s ?%s AND deleted = 0 ORDER BY key LIMIT ?"
+                % (">=" if inclusive else ">", end),
+                (bound,) + limit + (LISTING_BATCH_SIZE,),
+            ).fetchall()
+            skipped = False
+            for name, size, mtime in rows:
+                name = name[len(key):]
+                slash = name.find("/")
+                if slash < 0:
+                    # "" is the marker of the directory itself
+                    if name:
+                        batch.append((name, False, size, mtime))
+                    bound, inclusive = key + name, False
+                    continue
+                if slash:
+                    batch.append((name[:slash], True, 0, 0))
+                # jump over everything in the subdirectory ("0" follows "/")
+                bound, inclusive = key + name[:slash] + "0", True
+                skipped = True
+                break
+            if len(batch) >= LISTING_BATCH_SIZE:
+                yield sorted(batch, key=_is_file)
+                batch = []
+            if not skipped and len(rows) < LISTING_BATCH_SIZE:
+                break
+        if batch:
+            yield sorted(batch, key=_is_file)
+
+    # --------------------- writes through the FTP server ---------------------
+
+    def put(self, key, size, etag=None, mtime=None):
+        """Record that the object `key` was written."""
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO objects (key, size, mtime, etag, deleted, touched) VALUES (?, ?, ?, ?, 0, ?)",
+            (key, size, int(now) if mtime is None else mtime, etag, now),
+        )
+
+    def delete(self, key):
+        """Record that the object `key` was deleted."""
+        self._connection().execute(
+            "INSERT OR REPLACE INTO objects (key, size, mtime, etag, deleted, touched) VALUES (?, 0, 0, NULL, 1, ?)",
+            (key, time.time()),
+        )
+
+    def refresh(self, key):
+        """Read the object `key` back from S3 after a write whose outcome
+        is not known here (e.g. a server-side copy). One request."""
+        full_key = self.root + key
+        response = s3ops.get_client(self.storage).list_objects_v2(
+            Bucket=self.storage.bucket_name, Prefix=full_key, MaxKeys=1
+        )
+        contents = response.get("Contents", ())
+        # "key" itself sorts before every other key it prefixes
+        if contents and contents[0]["Key"] == full_key:
+            entry = contents[0]
+            self.put(key, entry["Size"], entry.get("ETag", "").strip('"'), int(entry["LastModified"].timestamp()))
+        else:
+            self.delete(key)
+
+    def rescan(self, prefix):
+        """Bring every key under `prefix` (e.g. a directory that was renamed
+        or removed as a whole) up to date with S3."""
+        self._sync(prefix, lambda: None)
+
+    # --------------------- reconciliation ---------------------
+
+    def _sync(self, prefix, renew):
+        """List every key under `prefix` page by page and make the index
+        match each page. `renew()` is called after every page."""
+        client = s3ops.get_client(self.storage)
+        params = dict(Bucket=self.storage.bucket_name, Prefix=self.root + prefix, MaxKeys=SCAN_PAGE_SIZE)
+        after = None
+        while True:
+            listed_at = time.time()
+            response = client.list_objects_v2(**params)
+            objects = {}
+            for entry in response.get("Contents", ()):
+                key = entry["Key"][len(self.root):]
+                if key:
+                    objects[key] = (entry["Size"], int(entry["LastModified"].timestamp()),
+                                    entry.get("ETag", "").strip('"'))
+            truncated = response.get("IsTruncated")
+            # a page may hold nothing but the marker of the location itself
+            if objects or not truncated:
+                last = max(objects) if truncated else None
+                self._apply(prefix, after, last, objects, listed_at)
+                renew()
+                after = last
+            if not truncated:
+                return
+            params["ContinuationToken"] = response["NextContinuationToken"]
+
+    def _apply(self, prefix, after, last, objects, listed_at):
+        """Make the rows of the keys under `prefix`, after `after` (or
+        from the first one) and up to `last` (or to the last one) match
+        `objects`, the listing of that range made at `listed_at`."""
+        where, args = [], []
+        if after is None:
+            where.append("key >= ?")
+            args.append(prefix)
+        else:
+            where.append("key > ?")
+            args.append(after)
+        if last is not None:
+            where.append("key <= ?")
+            args.append(last)
+        elif prefix:
+            where.append("key < ?")
+            args.append(prefix_end(prefix))
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT key, size, mtime, etag, deleted, touched FROM objects WHERE " + " AND ".join(where), args
+            ).fetchall()
+            existing = {row[0]: row[1:] for row in rows}
+            upserts = []
+            for key, listed in objects.items():
+                row = existing.get(key)
+                if row is None:
+                    upserts.append((key,) + listed)
+                elif row[4] > listed_at:
+                    # written through the FTP server since the listing
+                    continue
+                elif row[3] or row[:3] != listed:
+                    upserts.append((key,) + listed)
+            removed = [(key,) for key, row in existing.items() if key not in objects and row[4] <= listed_at]
+            conn.executemany(
+                "INSERT OR REPLACE INTO objects (key, size, mtime, etag, deleted, touched) VALUES (?, ?, ?, ?, 0, 0)",
+                upserts,
+            )
+            conn.executemany("DELETE FROM objects WHERE key = ?", removed)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _take_lease(self):
+        """Take or renew the right to reconcile the index file; return
+        False if another process holds it."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            lease = self._get_meta(conn, "lease")
+            if lease is not None:
+                owner, _, expires = lease.rpartition(" ")
+                if owner != self._owner and float(expires) > now:
+                    return False
+            self._set_meta(conn, "lease", "%s %f" % (self._owner, now + LEASE_TIME))
+            return True
+        finally:
+            conn.execute("COMMIT")
+
+    def _renew_lease(self):
+        if not self._take_lease():
+            raise RuntimeError("lost the lease of %s" % self.path)
+
+    def reconcile(self):
+        """Make the whole index match a fresh listing of the bucket."""
+        started = time.time()
+        self._sync("", self._renew_lease)
+        conn = self._connection()
+        self._set_meta(conn, "reconciled_at", started)
+        self._fresh_until = started + self.max_age
+        logger.info("namespace index %s reconciled in %.1fs", self.path, time.time() - started)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            interval = READY_CHECK_INTERVAL
+            try:
+                if self._take_lease():
+                    self.reconcile()
+                    interval = self.reconcile_interval
+                else:
+                    self._check_ready()
+            except Exception:
+                logger.exception("reconciling namespace index %s failed", self.path)
+            self._stopping.wait(min(interval, self.reconcile_interval))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="nsindex", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+
+_indexes = ProcessLocal(dict)
+_indexes_lock = threading.Lock()
+
+
+def get_namespace_index(storage, namespace):
+    """Return this process's NamespaceIndex of the S3 storage identified in
+    the metadata cache by `namespace` (see StorageFS.get_cache_namespace()),
+    or None when FTPSERVER_NAMESPACE_INDEX is not enabled."""
+    conf = get_namespace_index_settings()
+    if not conf["DIRECTORY"]:
+        return None
+    indexes = _indexes.get()
+    with _indexes_lock:
+        index = indexes.get(namespace)
+        if index is None:
+            os.makedirs(conf["DIRECTORY"], exist_ok=True)
+            name = hashlib.sha256(namespace.encode("utf-8")).hexdigest()[:32] + ".sqlite3"
+            index = NamespaceIndex(
+                os.path.join(conf["DIRECTORY"], name),
+                storage,
+                reconcile_interval=conf["RECONCILE_INTERVAL"],
+                max_age=conf["MAX_AGE"],
+            )
+            index.start()
+            atexit.register(index.close)
+            indexes[namespace] = index
+    return index
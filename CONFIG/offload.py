@@ -0,0 +1,208 @@
+"""CONFIG>offload.py"""
+
+import contextvars
+import logging
+import os
+import socket
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from pyftpdlib.ioloop import AsyncChat
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessLocal:
+    """
+    Value made by `factory()` on first use and shared by the threads of
+    the process. Threads, sockets, storage clients and database
+    connections do not survive a fork(), so a process forked after the
+    value was made (a pre-forked worker) makes its own.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # a lock held by another thread at fork() time stays held in the child
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self.factory()
+                    self._pid = os.getpid()
+        return self._value
+
+
+class _Waker(AsyncChat):
+    """
+    Socketpair registered with an IOLoop so that other threads can wake it
+    up and have callbacks run on the IOLoop thread.
+    """
+
+    # not a session: does not keep a draining server process alive
+    daemon = True
+
+    def __init__(self, ioloop):
+        self._reader, self._writer = socket.socketpair()
+        self._writer.setblocking(False)
+        self._callbacks = deque()
+        AsyncChat.__init__(self, self._reader, ioloop=ioloop)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self._reader.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._callbacks:
+            callback = self._callbacks.popleft()
+            try:
+                callback()
+            except Exception:
+                logger.exception("callback %r failed on the IOLoop", callback)
+
+    def call_soon(self, callback):
+        """Schedule `callback` on the IOLoop thread. Safe from any thread."""
+        self._callbacks.append(callback)
+        try:
+            self._writer.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # the socket buffer is full: a wake-up is already pending
+            pass
+
+    def close(self):
+        AsyncChat.close(self)
+        self._writer.close()
+
+
+class StorageWorkerPool:
+    """
+    Bounded thread pool running blocking storage calls off the IOLoop.
+
+    Results are delivered back on the IOLoop thread that submitted the
+    work, so callbacks may use the command channel freely.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = None
+        self._wakers = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _reset_after_fork(self):
+        # worker threads and wake-up sockets do not survive a fork()
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="storage"
+            )
+            self._wakers = {}
+            self._pid = os.getpid()
+
+    def _waker(self, ioloop):
+        waker = self._wakers.get(id(ioloop))
+        if waker is None or waker._closed:
+            waker = self._wakers[id(ioloop)] = _Waker(ioloop)
+        return waker
+
+    def submit(self, ioloop, fn, callback):
+        """Run `fn()` on the pool, in a copy of the caller's context, then
+        `callback(future)` on `ioloop`.
+
+        Must be called from the IOLoop thread.
+        """
+        context = contextvars.copy_context()
+        with self._lock:
+            self._reset_after_fork()
+            waker = self._waker(ioloop)
+            future = self._executor.submit(context.run, fn)
+        future.add_done_callback(lambda f: waker.call_soon(lambda: callback(f)))
+        return future
+
+
+class PreloadedFS:
+    """
+    Proxy around a StorageFS whose calls were made ahead of time by a
+    worker thread.
+
+    preload() runs a StorageFS method and remembers its outcome; calling
+    the same method with the same arguments through the proxy afterwards
+    returns (or raises) that outcome once, without touching the storage.
+    Any other attribute is read from the wrapped filesystem.
+    """
+
+    def __init__(self, fs):
+        self._fs = fs
+        self._results = {}
+        self._names = set()
+
+    def preload(self, name, *args):
+        try:
+            value = getattr(self._fs, name)(*args)
+        except Exception as err:
+            self._results[(name, args)] = (False, err)
+            self._names.add(name)
+            raise
+        self._results[(name, args)] = (True, value)
+        self._names.add(name)
+        return value
+
+    def __getattr__(self, name):
+        attr = getattr(self._fs, name)
+        if name not in self._names:
+            return attr
+
+        def call(*args):
+            try:
+                ok, value = self._results.pop((name, args))
+            except KeyError:
+                return attr(*args)
+            if ok:
+                return value
+            raise value
+
+        return call
+
+    def discard(self):
+        """Close file objects that were opened but never used."""
+        for ok, value in self._results.values():
+            # uploads that never started must not store an empty file
+            close = getattr(value, "abort", None) or getattr(value, "close", None)
+            if ok and callable(close):
+                try:
+                    close()
+                except Exception:
+                    logger.debug("closing unused %r failed", value, exc_info=True)
+        self._results.clear()
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    """Return the process-wide StorageWorkerPool, or None when storage
+    calls run inline (FTPSERVER_STORAGE_WORKERS unset or 0)."""
+    global _worker_pool
+    max_workers = getattr(settings, "FTPSERVER_STORAGE_WORKERS", 0)
+    if not max_workers:
+        return None
+    if _worker_pool is None:
+        with _worker_pool_lock:
+            if _worker_pool is None:
+                _worker_pool = StorageWorkerPool(max_workers)
+    return _worker_pool
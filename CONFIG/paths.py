@@ -0,0 +1,111 @@
+"""CONFIG>paths.py"""
+
+import functools
+import os
+import threading
+
+from django.conf import settings
+
+# FTP paths and storage keys remembered per root (LRU)
+PATH_CACHE_SIZE = 65536
+
+
+class PathTranslator:
+    """
+    Converts the paths pyftpdlib hands to StorageFS into FTP-style paths
+    and storage keys.
+
+    Everything that only depends on the root directory and on settings
+    (the normalised root, the MEDIA_ROOT basename) is computed once, and
+    the results of both conversions are memoised, so the per-call cost of
+    StorageFS path handling is a dictionary lookup. The results are the
+    same as StorageFS._ensure_ftp_path() and _storage_name() used to give.
+    """
+
+    def __init__(self, root, media_root=None, cache_size=PATH_CACHE_SIZE):
+        self.root = root
+        self._norm_root = os.path.normpath(root) if root else ""
+        # normalised paths under an absolute root are converted by slicing;
+        # anything else goes through os.path.relpath() as before
+        if self._norm_root and os.path.isabs(self._norm_root):
+            self._root_prefix = self._norm_root.rstrip("/") + "/"
+        else:
+            self._root_prefix = None
+        self._media_root_base = None
+        if media_root:
+            self._media_root_base = os.path.basename(os.path.normpath(media_root))
+        self._ftp_path = functools.lru_cache(maxsize=cache_size)(self._translate)
+        self._storage_name = functools.lru_cache(maxsize=cache_size)(self._key)
+
+    def ftp_path(self, path, cwd):
+        """Return the FTP-style path of `path`: a filesystem path under the
+        root, an absolute FTP path, or a name relative to `cwd`."""
+        if path in (None, "", "/"):
+            return "/"
+        # only relative names depend on the current directory
+        return self._ftp_path(path, None if path.startswith("/") else cwd)
+
+    def storage_name(self, ftp_path):
+        """Return the storage key of the FTP-style path `ftp_path`."""
+        if ftp_path in (None, "", "/"):
+            return ""
+        return self._storage_name(ftp_path)
+
+    def _translate(self, path, cwd):
+        prefix = self._root_prefix
+        if prefix is not None:
+            if (path.startswith(prefix) and "//" not in path and "/." not in path
+                    and not path.endswith("/")):
+                return "/" + path[len(prefix):]
+            if path == self._norm_root:
+                return "/"
+        try:
+            if os.path.isabs(path) and self.root and os.path.normpath(path).startswith(self._norm_root):
+                rel = os.path.relpath(path, self.root)
+                if rel in (".", ""):
+                    return "/"
+                return "/" + rel.replace(os.sep, "/")
+        except Exception:
+            pass
+        if path.startswith("/"):
+            return path
+        base = cwd if cwd not in (None, "") else "/"
+        if base.endswith("/"):
+            return base + path.lstrip("/")
+        return base + "/" + path.lstrip("/")
+
+    def _key(self, ftp_path):
+        if not ftp_path.startswith("/"):
+            ftp_path = "/" + ftp_path
+        name = ftp_path.lstrip("/")
+        # If MEDIA_ROOT appears inside the name, strip up to MEDIA_ROOT so that
+        # keys are relative to media folder.
+        if self._media_root_base is not None:
+            parts = name.split("/")
+            if self._media_root_base in parts:
+                idx = parts.index(self._media_root_base)
+                name = "/".join(parts[idx + 1:]) or ""
+        return name
+
+    def cache_info(self):
+        return {
+            "ftp_path": self._ftp_path.cache_info(),
+            "storage_name": self._storage_name.cache_info(),
+        }
+
+
+_translators = {}
+_translators_lock = threading.Lock()
+
+
+def get_path_translator(root):
+    """Return the process-wide PathTranslator for the root directory
+    `root` (normally one per FTP home directory)."""
+    translator = _translators.get(root)
+    if translator is None:
+        with _translators_lock:
+            translator = _translators.get(root)
+            if translator is None:
+                translator = PathTranslator(root, getattr(settings, "MEDIA_ROOT", None))
+                _translators[root] = translator
+    return translator
@@ -0,0 +1,227 @@
+"""CONFIG>pipeline.py"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .offload import ProcessLocal
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UPLOAD_PIPELINE = {
+    # off by default: received files are not queued
+    "ENABLED": False,
+    # dotted paths of the callables run, in order, on every received file;
+    # each is called with the UploadJob and raises to have it retried
+    "STAGES": [],
+    # threads running the stages, per ftpserver process
+    "WORKERS": 2,
+    # jobs waiting to be processed beyond which STOR/APPE are refused with
+    # 450 until the queue drains
+    "MAX_QUEUED": 10000,
+    # attempts of a failing job before it is marked failed
+    "MAX_ATTEMPTS": 5,
+    # seconds before the first retry of a failed job, doubled at every retry
+    "RETRY_DELAY": 30,
+    # seconds a job may run before it is considered abandoned (its process
+    # died) and taken over by another worker
+    "LEASE": 600,
+    # seconds an idle worker waits before looking at the queue again
+    "POLL_INTERVAL": 1.0,
+    # keep jobs that went through every stage (status "done"); off: delete them
+    "KEEP_DONE": False,
+}
+
+# jobs written to the database by one INSERT
+RECORD_BATCH_SIZE = 500
+
+
+def get_pipeline_settings():
+    conf = dict(DEFAULT_UPLOAD_PIPELINE)
+    conf.update(getattr(settings, "FTPSERVER_UPLOAD_PIPELINE", None) or {})
+    return conf
+
+
+class UploadPipeline:
+    """
+    Post-upload processing of the files received over FTP, off the IOLoop.
+
+    enqueue() only appends the job to a memory buffer, so completing an
+    upload costs no more than before. A recorder thread writes buffered
+    jobs to the database (CONFIG.models.UploadJob) and WORKERS threads
+    claim due jobs and run the configured stages on them, retrying
+    failures with an exponential delay.
+
+    Jobs are claimed with a conditional UPDATE, so the ftpserver processes
+    started with --workers share one queue, and a running job whose lease
+    expires is taken over: jobs survive restarts and crashed processes,
+    which means a stage may run more than once on the same file and should
+    be idempotent. When more than MAX_QUEUED jobs are waiting, full() is
+    true and the handler refuses new uploads.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.stages = [(path, import_string(path)) for path in conf["STAGES"]]
+        self._buffer = deque()
+        # jobs in the database waiting or running, as last counted
+        self._queued = 0
+        self._recorded = threading.Event()
+        self._buffered = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        threads = [threading.Thread(target=self._record, name="pipeline-recorder", daemon=True)]
+        threads += [
+            threading.Thread(target=self._work, name="pipeline-%d" % i, daemon=True)
+            for i in range(self.conf["WORKERS"])
+        ]
+        for thread in threads:
+            thread.start()
+        self._threads = threads
+
+    def close(self, timeout=10):
+        """Stop the workers, after writing the buffered jobs to the queue."""
+        self._stopping.set()
+        self._buffered.set()
+        self._recorded.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def full(self):
+        return len(self._buffer) + self._queued >= self.conf["MAX_QUEUED"]
+
+    def enqueue(self, **fields):
+        """Queue a received file (UploadJob fields). Safe from any thread."""
+        fields.setdefault("received_at", timezone.now())
+        self._buffer.append(fields)
+        self._buffered.set()
+
+    # --------------------- recorder ---------------------
+
+    def _record(self):
+        from .models import UploadJob
+
+        interval = self.conf["POLL_INTERVAL"]
+        while True:
+            self._buffered.wait(interval)
+            self._buffered.clear()
+            try:
+                while self._buffer:
+                    batch = [self._buffer.popleft() for _ in range(min(len(self._buffer), RECORD_BATCH_SIZE))]
+                    try:
+                        UploadJob.objects.bulk_create(
+                            [UploadJob(run_after=fields["received_at"], **fields) for fields in batch]
+                        )
+                    except DatabaseError:
+                        self._buffer.extendleft(reversed(batch))
+                        raise
+                    self._recorded.set()
+                self._queued = UploadJob.objects.filter(
+                    status__in=(UploadJob.PENDING, UploadJob.RUNNING)
+                ).count()
+            except DatabaseError:
+                logger.exception("recording upload jobs failed (%d buffered)", len(self._buffer))
+                if not self._stopping.wait(interval):
+                    continue
+            if self._stopping.is_set() and not self._buffer:
+                break
+        connection.close()
+
+    # --------------------- workers ---------------------
+
+    def _work(self):
+        interval = self.conf["POLL_INTERVAL"]
+        while not self._stopping.is_set():
+            self._recorded.clear()
+            try:
+                job = self._claim()
+                if job is not None:
+                    self._run(job)
+            except DatabaseError:
+                # the job, if any, is taken over when its lease expires
+                logger.exception("upload pipeline worker failed")
+                job = None
+            finally:
+                close_old_connections()
+            if job is None:
+                self._recorded.wait(interval)
+        connection.close()
+
+    def _claim(self):
+        """Take the oldest due job, or return None if there is none."""
+        from .models import UploadJob
+
+        now = timezone.now()
+        due = UploadJob.objects.filter(status__in=(UploadJob.PENDING, UploadJob.RUNNING), run_after__lte=now)
+        for pk in due.order_by("run_after", "pk").values_list("pk", flat=True)[:self.conf["WORKERS"] + 1]:
+            claimed = due.filter(pk=pk).update(
+                status=UploadJob.RUNNING,
+                run_after=now + timedelta(seconds=self.conf["LEASE"]),
+                attempts=F("attempts") + 1,
+                updated_at=now,
+            )
+            if claimed:
+                return UploadJob.objects.get(pk=pk)
+        return None
+
+    def _run(self, job):
+        from .models import UploadJob
+
+        start = time.monotonic()
+        for index in range(job.stage, len(self.stages)):
+            name, stage = self.stages[index]
+            try:
+                stage(job)
+            except Exception as err:
+                job.last_error = "%s: %s" % (name, err)
+                if job.attempts >= self.conf["MAX_ATTEMPTS"]:
+                    job.status = UploadJob.FAILED
+                    logger.error("upload job %s for %r failed at %s, giving up: %s",
+                                 job.pk, job.path, name, err, exc_info=True)
+                else:
+                    delay = self.conf["RETRY_DELAY"] * 2 ** (job.attempts - 1)
+                    job.status = UploadJob.PENDING
+                    job.run_after = timezone.now() + timedelta(seconds=delay)
+                    logger.warning("upload job %s for %r failed at %s, retrying in %ds: %s",
+                                   job.pk, job.path, name, delay, err)
+                job.save(update_fields=["status", "run_after", "last_error", "updated_at"])
+                return
+            job.stage = index + 1
+            job.save(update_fields=["stage", "updated_at"])
+        logger.debug("upload job %s for %r done in %.3fs", job.pk, job.path, time.monotonic() - start)
+        if self.conf["KEEP_DONE"]:
+            job.status = UploadJob.DONE
+            job.save(update_fields=["status", "updated_at"])
+        else:
+            job.delete()
+
+
+def _start_pipeline():
+    conf = get_pipeline_settings()
+    if not conf["ENABLED"]:
+        return None
+    pipeline = UploadPipeline(conf)
+    pipeline.start()
+    atexit.register(pipeline.close)
+    return pipeline
+
+
+_pipeline = ProcessLocal(_start_pipeline)
+
+
+def get_upload_pipeline():
+    """Return this process's running UploadPipeline, or None when
+    FTPSERVER_UPLOAD_PIPELINE is not enabled."""
+    return _pipeline.get()
@@ -0,0 +1,387 @@
+"""CONFIG>qos.py"""
+
+import contextvars
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .offload import ProcessLocal
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QOS = {
+    # enforce the limits below; off: nothing is limited
+    "ENABLED": False,
+    # bytes per second sent to (READ) and received from (WRITE) all clients
+    # together; 0: unlimited. Shared between the users transferring in that
+    # direction in proportion to their WEIGHT.
+    "READ_LIMIT": 0,
+    "WRITE_LIMIT": 0,
+    # bytes per second per user; 0: unlimited
+    "USER_READ_LIMIT": 0,
+    "USER_WRITE_LIMIT": 0,
+    # seconds of its rate a user may transfer at once after being idle
+    "BURST": 1.0,
+    # concurrent file transfers (RETR, STOR, APPE, STOU) per user; 0: unlimited
+    "MAX_TRANSFERS": 0,
+    # share of the bandwidth and of the backend requests a user gets when
+    # they are contended
+    "WEIGHT": 1,
+    # per-user overrides of WEIGHT, BURST, MAX_TRANSFERS and of the user
+    # limits (as READ_LIMIT and WRITE_LIMIT), e.g.
+    # {"bulk": {"WEIGHT": 1, "READ_LIMIT": 10 * 1024 * 1024, "MAX_TRANSFERS": 2}}
+    "USERS": {},
+    # outstanding requests to a storage backend, by dotted path of the storage
+    # class (subclasses included), e.g.
+    # {"storages.backends.s3.S3Storage": {"MAX_REQUESTS": 32}}
+    "BACKENDS": {},
+}
+
+# commands whose data channel carries a file, counted by MAX_TRANSFERS
+TRANSFER_COMMANDS = frozenset(("RETR", "STOR", "APPE", "STOU"))
+# bandwidth directions: sent to clients, received from them
+READ = "READ"
+WRITE = "WRITE"
+
+# storage methods limited on backends other than S3 (whose requests are
+# limited one by one on the boto3 client)
+STORAGE_OPERATIONS = ("exists", "listdir", "size", "get_modified_time", "open", "save", "delete")
+
+# FTP user on whose behalf storage requests are made; copied to the
+# storage worker and S3 transfer threads with the context they run in
+current_user = contextvars.ContextVar("ftpserver_qos_user", default=None)
+
+
+def get_qos_settings():
+    conf = dict(DEFAULT_QOS)
+    conf.update(getattr(settings, "FTPSERVER_QOS", None) or {})
+    return conf
+
+
+class acting_for:
+    """Context manager making `user` the current_user."""
+
+    __slots__ = ("user", "_token")
+
+    def __init__(self, user):
+        self.user = user
+
+    def __enter__(self):
+        self._token = current_user.set(self.user)
+
+    def __exit__(self, exc_type, exc, tb):
+        current_user.reset(self._token)
+
+
+class TokenBucket:
+    """Bytes that may be transferred: `rate` per second, up to `burst`.
+    Transfers are never cut short; a bucket in debt tells how long to
+    wait instead."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, nbytes):
+        """Take `nbytes`; return the seconds to wait before the next transfer."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - nbytes
+        self.updated = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def full(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+
+def fair_shares(limit, users):
+    """Split `limit` between `users` ({user: (weight, cap or None)}) in
+    proportion to their weight, giving what capped users cannot use to
+    the others (weighted max-min fairness)."""
+    shares = {}
+    users = dict(users)
+    while users:
+        unit = limit / sum(weight for weight, cap in users.values())
+        capped = {user: cap for user, (weight, cap) in users.items() if cap is not None and cap <= weight * unit}
+        if not capped:
+            shares.update((user, weight * unit) for user, (weight, cap) in users.items())
+            break
+        for user, cap in capped.items():
+            shares[user] = cap
+            limit -= cap
+            del users[user]
+    return shares
+
+
+class RequestLimiter:
+    """
+    At most `max_requests` requests to one storage backend at a time.
+
+    Callers that have to wait are served in weighted fair order: each gets
+    a virtual finish time advanced by 1/weight per request of its user, so
+    a user with many waiting requests cannot starve one with few.
+    """
+
+    def __init__(self, name, max_requests):
+        self.name = name
+        self.max_requests = max_requests
+        self.active = 0
+        self._waiting = []
+        self._finish = {}
+        self._clock = 0.0
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+
+    def acquire(self, user, weight):
+        with self._cond:
+            if self.active < self.max_requests and not self._waiting:
+                self.active += 1
+                return
+            finish = max(self._clock, self._finish.get(user, 0.0)) + 1.0 / weight
+            self._finish[user] = finish
+            entry = (finish, next(self._order))
+            heapq.heappush(self._waiting, entry)
+            while self._waiting[0] is not entry or self.active >= self.max_requests:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self.active += 1
+            self._clock = finish
+            if not self._waiting:
+                self._finish.clear()
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+
+class QoS:
+    """
+    Bandwidth, transfer and backend request limits of one ftpserver
+    process (see DEFAULT_QOS).
+
+    Data channels report the bytes they move with charge() and pause for
+    the delay it returns. Every user transferring in a direction has a
+    token bucket whose rate is their fair share of the global limit, capped
+    by their own limit, recomputed whenever a user starts or stops
+    transferring. Storage requests are limited per storage class by a
+    RequestLimiter, on behalf of current_user.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self._transfers = {}
+        # direction -> {user: open data channels}
+        self._active = {READ: {}, WRITE: {}}
+        # (user, direction) -> TokenBucket
+        self._buckets = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _user_conf(self, user, name, default_name=None):
+        overrides = self.conf["USERS"].get(user) or {}
+        return overrides.get(name, self.conf[default_name or name])
+
+    def weight(self, user):
+        return self._user_conf(user, "WEIGHT")
+
+    # --------------------- transfers ---------------------
+
+    def take_transfer(self, user):
+        """Count a file transfer of `user`; return False if they already
+        have as many as allowed."""
+        limit = self._user_conf(user, "MAX_TRANSFERS")
+        with self._lock:
+            count = self._transfers.get(user, 0)
+            if limit and count >= limit:
+                return False
+            self._transfers[user] = count + 1
+            return True
+
+    def release_transfer(self, user):
+        with self._lock:
+            count = self._transfers.get(user, 0) - 1
+            if count > 0:
+                self._transfers[user] = count
+            else:
+                self._transfers.pop(user, None)
+
+    # --------------------- bandwidth ---------------------
+
+    def limited(self, user, direction):
+        return bool(self.conf[direction + "_LIMIT"]
+                    or self._user_conf(user, direction + "_LIMIT", "USER_" + direction + "_LIMIT"))
+
+    def start(self, user, direction):
+        """A data channel of `user` started transferring in `direction`;
+        return whether it is rate limited."""
+        if not self.limited(user, direction):
+            return False
+        with self._lock:
+            active = self._active[direction]
+            active[user] = active.get(user, 0) + 1
+            if active[user] == 1:
+                self._rebalance(direction)
+        return True
+
+    def end(self, user, direction):
+        with self._lock:
+            active = self._active[direction]
+            active[user] -= 1
+            if not active[user]:
+                # the bucket stays: a new transfer must not start with a
+                # full burst, only with what refilled in between
+                del active[user]
+                self._rebalance(direction)
+
+    def _rebalance(self, direction):
+        active = self._active[direction]
+        for key in [key for key in self._buckets if key[1] == direction and key[0] not in active]:
+            if self._buckets[key].full():
+                del self._buckets[key]
+        limit = self.conf[direction + "_LIMIT"]
+        users = {}
+        for user in self._active[direction]:
+            cap = self._user_conf(user, direction + "_LIMIT", "USER_" + direction + "_LIMIT") or None
+            users[user] = (self.weight(user), cap)
+        rates = fair_shares(limit, users) if limit else {user: cap for user, (weight, cap) in users.items()}
+        for user, rate in rates.items():
+            burst = rate * self._user_conf(user, "BURST")
+            bucket = self._buckets.get((user, direction))
+            if bucket is None:
+                self._buckets[(user, direction)] = TokenBucket(rate, burst)
+            else:
+                bucket.rate, bucket.burst = rate, burst
+                bucket.tokens = min(bucket.tokens, burst)
+
+    def charge(self, user, direction, nbytes):
+        """Record `nbytes` transferred by `user`; return the seconds its
+        data channels should wait before transferring again."""
+        with self._lock:
+            bucket = self._buckets.get((user, direction))
+            return bucket.consume(nbytes) if bucket is not None else 0
+
+    # --------------------- backend requests ---------------------
+
+    def limiter_for(self, storage_class):
+        """Return the RequestLimiter of `storage_class`, or None if its
+        requests are not limited."""
+        try:
+            return self._limiters[storage_class]
+        except KeyError:
+            pass
+        limiter = None
+        for cls in storage_class.__mro__:
+            name = "%s.%s" % (cls.__module__, cls.__qualname__)
+            backend = self.conf["BACKENDS"].get(name)
+            if backend and backend.get("MAX_REQUESTS"):
+                limiter = RequestLimiter(name, backend["MAX_REQUESTS"])
+                break
+        with self._lock:
+            return self._limiters.setdefault(storage_class, limiter)
+
+    def acquire(self, limiter):
+        """Take a request slot of `limiter` for current_user; return False
+        if this thread already holds one (nested storage calls)."""
+        held = getattr(self._local, "held", None)
+        if held is not None:
+            return False
+        user = current_user.get()
+        limiter.acquire(user, self.weight(user))
+        self._local.held = limiter
+        return True
+
+    def release(self, limiter):
+        self._local.held = None
+        limiter.release()
+
+    def limit_storage(self, storage):
+        """Limit the requests made by the storage instance `storage`: the
+        S3 requests of its boto3 client, or its STORAGE_OPERATIONS calls."""
+        limiter = self.limiter_for(type(storage))
+        if limiter is None:
+            return storage
+        if hasattr(storage, "client_config") and hasattr(storage, "_connections"):
+            self.limit_client(storage.connection.meta.client, limiter)
+        elif not getattr(storage, "_ftpserver_qos", False):
+            storage._ftpserver_qos = True
+            for operation in STORAGE_OPERATIONS:
+                method = getattr(storage, operation, None)
+                if method is not None:
+                    setattr(storage, operation, self._limited(method, limiter))
+        return storage
+
+    def _limited(self, method, limiter):
+        def limited(*args, **kwargs):
+            acquired = self.acquire(limiter)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                if acquired:
+                    self.release(limiter)
+
+        return limited
+
+    def limit_client(self, client, limiter):
+        """Limit the S3 requests made through the boto3 client `client`.
+        Registering again is a no-op."""
+        events = client.meta.events
+        events.register("before-call.s3", functools.partial(self._before_s3_call, limiter),
+                        unique_id="ftpserver-qos-before")
+        events.register("after-call.s3", self._s3_call_done, unique_id="ftpserver-qos-after")
+        events.register("after-call-error.s3", self._s3_call_done, unique_id="ftpserver-qos-error")
+        return client
+
+    def _before_s3_call(self, limiter, context, **kwargs):
+        if self.acquire(limiter):
+            context["ftpserver_qos"] = limiter
+
+    def _s3_call_done(self, context, **kwargs):
+        limiter = context.pop("ftpserver_qos", None)
+        if limiter is not None:
+            self.release(limiter)
+
+
+class backend_request:
+    """Context manager holding a request slot of the backend of `storage`
+    for current_user, e.g. while the body of an S3 response is read. No-op
+    when its requests are not limited."""
+
+    __slots__ = ("storage", "_qos", "_limiter")
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._qos = self._limiter = None
+
+    def __enter__(self):
+        qos = get_qos()
+        limiter = qos.limiter_for(type(self.storage)) if qos is not None else None
+        if limiter is not None and qos.acquire(limiter):
+            self._qos, self._limiter = qos, limiter
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._limiter is not None:
+            self._qos.release(self._limiter)
+
+
+def _create_qos():
+    conf = get_qos_settings()
+    return QoS(conf) if conf["ENABLED"] else None
+
+
+_qos = ProcessLocal(_create_qos)
+
+
+def get_qos():
+    """Return this process's QoS, or None when FTPSERVER_QOS is not enabled."""
+    return _qos.get()
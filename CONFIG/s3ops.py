@@ -0,0 +1,335 @@
+"""CONFIG>s3ops.py"""
+
+import errno
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_S3_COPY = {
+    # objects larger than this are copied with UploadPartCopy (S3 refuses a
+    # single CopyObject above 5 GB)
+    "MULTIPART_THRESHOLD": 1024 * 1024 * 1024,
+    # bytes copied by each UploadPartCopy
+    "PART_SIZE": 256 * 1024 * 1024,
+    # objects (or parts of one large object) copied at the same time
+    "CONCURRENCY": 8,
+}
+
+DEFAULT_S3_DELETE = {
+    # DeleteObjects requests (of up to DELETE_BATCH_SIZE keys) sent at the
+    # same time by a recursive directory removal
+    "CONCURRENCY": 4,
+}
+
+# DeleteObjects accepts at most this many keys per request
+DELETE_BATCH_SIZE = 1000
+
+# seconds between two progress messages of a long prefix copy
+PROGRESS_INTERVAL = 10
+
+# keys a probe_key() request asks for; keys that sort between "name" and
+# "name/" ("name.txt", "name-2", ...) come first and could hide the latter
+PROBE_MAX_KEYS = 100
+
+
+def get_copy_settings():
+    conf = dict(DEFAULT_S3_COPY)
+    conf.update(getattr(settings, "FTPSERVER_S3_COPY", None) or {})
+    return conf
+
+
+def get_delete_settings():
+    conf = dict(DEFAULT_S3_DELETE)
+    conf.update(getattr(settings, "FTPSERVER_S3_DELETE", None) or {})
+    conf["CONCURRENCY"] = max(int(conf["CONCURRENCY"]), 1)
+    return conf
+
+
+def _transfer_config(conf):
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=conf["MULTIPART_THRESHOLD"],
+        multipart_chunksize=conf["PART_SIZE"],
+        max_concurrency=conf["CONCURRENCY"],
+    )
+
+
+def s3_key(storage, name):
+    """Return the bucket key of the storage name `name`."""
+    from storages.utils import clean_name
+
+    return storage._normalize_name(clean_name(name))
+
+
+def get_client(storage):
+    """Return the boto3 client of `storage`, instrumented when metrics are
+    enabled and its requests limited when FTPSERVER_QOS is."""
+    from .metrics import get_metrics
+    from .qos import get_qos
+
+    client = storage.connection.meta.client
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.instrument_client(client)
+    qos = get_qos()
+    if qos is not None:
+        limiter = qos.limiter_for(type(storage))
+        if limiter is not None:
+            qos.limit_client(client, limiter)
+    return client
+
+
+def copy_object(storage, src_key, dst_key, conf=None):
+    """Copy one object server-side, keeping its metadata; objects above
+    MULTIPART_THRESHOLD are copied in parallel parts."""
+    conf = conf or get_copy_settings()
+    client = get_client(storage)
+    extra = {"ACL": storage.default_acl} if storage.default_acl else None
+    client.copy(
+        {"Bucket": storage.bucket_name, "Key": src_key},
+        storage.bucket_name,
+        dst_key,
+        ExtraArgs=extra,
+        Config=_transfer_config(conf),
+    )
+
+
+def _delete_batch(storage, batch):
+    """Send one DeleteObjects request; return [(key, message)] for the keys
+    S3 refused."""
+    response = get_client(storage).delete_objects(
+        Bucket=storage.bucket_name,
+        Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+    )
+    return [(error["Key"], error.get("Message")) for error in response.get("Errors", ())]
+
+
+def delete_objects(storage, keys):
+    """Delete `keys` with batched DeleteObjects requests; return the keys
+    that could not be deleted."""
+    keys = list(keys)
+    failed = []
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        for key, message in _delete_batch(storage, keys[start:start + DELETE_BATCH_SIZE]):
+            logger.warning("deleting %r failed: %s", key, message)
+            failed.append(key)
+    return failed
+
+
+def list_objects(storage, prefix):
+    """Yield (key, size) for every object under `prefix`, recursively."""
+    client = get_client(storage)
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=storage.bucket_name, Prefix=prefix):
+        for entry in page.get("Contents", ()):
+            yield entry["Key"], entry["Size"]
+
+
+def prefix_exists(storage, name):
+    """True if at least one object lives under the directory `name`."""
+    response = get_client(storage).list_objects_v2(
+        Bucket=storage.bucket_name, Prefix=s3_key(storage, name) + "/", MaxKeys=1
+    )
+    return response.get("KeyCount", 0) > 0
+
+
+def probe_key(storage, name):
+    """
+    Find out whether `name` is an object or a directory (a "name/" marker
+    or objects under it) with one delimited ListObjectsV2 request, instead
+    of a HEAD followed by a listing. Return (is_dir, size, mtime), or None
+    if it is neither; an object wins over a directory of the same name.
+    """
+    key = s3_key(storage, name)
+    response = get_client(storage).list_objects_v2(
+        Bucket=storage.bucket_name, Prefix=key, Delimiter="/", MaxKeys=PROBE_MAX_KEYS
+    )
+    contents = response.get("Contents", ())
+    # "name" itself sorts before every other key it prefixes
+    if contents and contents[0]["Key"] == key:
+        return False, contents[0]["Size"], int(contents[0]["LastModified"].timestamp())
+    if any(entry["Prefix"] == key + "/" for entry in response.get("CommonPrefixes", ())):
+        return True, 0, 0
+    if response.get("IsTruncated") and prefix_exists(storage, name):
+        return True, 0, 0
+    return None
+
+
+def stored_checksums(storage, name):
+    """
+    Return the checksums of the object `name` known without reading it:
+    those stored when it was uploaded through the FTP server (user
+    metadata, or tags after a multipart upload) and the MD5 that the ETag
+    of an unencrypted single-part object is.
+    """
+    from .checksums import STORED_PREFIX
+
+    client = get_client(storage)
+    key = s3_key(storage, name)
+    head = client.head_object(Bucket=storage.bucket_name, Key=key)
+    checksums = {
+        name[len(STORED_PREFIX):]: value
+        for name, value in head.get("Metadata", {}).items()
+        if name.startswith(STORED_PREFIX)
+    }
+    etag = head.get("ETag", "").strip('"')
+    if not checksums and "-" in etag:
+        tags = client.get_object_tagging(Bucket=storage.bucket_name, Key=key)["TagSet"]
+        checksums = {
+            tag["Key"][len(STORED_PREFIX):]: tag["Value"]
+            for tag in tags
+            if tag["Key"].startswith(STORED_PREFIX)
+        }
+    encrypted = head.get("SSECustomerAlgorithm") or head.get("ServerSideEncryption", "").startswith("aws:kms")
+    if "md5" not in checksums and "-" not in etag and not encrypted:
+        checksums["md5"] = etag
+    return checksums
+
+
+def create_marker(storage, name):
+    """Create the directory marker of `name`: the empty object "name/" that
+    S3 consoles and tools also use for folders."""
+    get_client(storage).put_object(Bucket=storage.bucket_name, Key=s3_key(storage, name) + "/", Body=b"")
+
+
+def rename_object(storage, src_name, dst_name):
+    """Move one object: server-side copy, then delete the source."""
+    src_key = s3_key(storage, src_name)
+    copy_object(storage, src_key, s3_key(storage, dst_name))
+    get_client(storage).delete_object(Bucket=storage.bucket_name, Key=src_key)
+
+
+def rename_prefix(storage, src_name, dst_name):
+    """
+    Move every object under the directory `src_name` to `dst_name`.
+
+    All objects are copied first, CONCURRENCY at a time. If any copy
+    fails, the copies already made are deleted and the sources are left
+    untouched, so the rename either happens completely or not at all.
+    Only once every copy exists are the sources deleted; keys that cannot
+    be deleted are logged and left in place (the data is never lost).
+    """
+    conf = get_copy_settings()
+    src_prefix = s3_key(storage, src_name) + "/"
+    dst_prefix = s3_key(storage, dst_name) + "/"
+    objects = list(list_objects(storage, src_prefix))
+    total_bytes = sum(size for key, size in objects)
+    logger.info(
+        "renaming %r to %r: %d objects, %d bytes",
+        src_prefix, dst_prefix, len(objects), total_bytes,
+    )
+    copied = []
+    copied_bytes = 0
+    last_report = time.monotonic()
+    error = None
+    with ThreadPoolExecutor(max_workers=conf["CONCURRENCY"], thread_name_prefix="s3-copy") as executor:
+        futures = {
+            executor.submit(copy_object, storage, key, dst_prefix + key[len(src_prefix):], conf): (key, size)
+            for key, size in objects
+        }
+        for future in as_completed(futures):
+            key, size = futures[future]
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                if error is None:
+                    error = future.exception()
+                    logger.error("copying %r failed: %s; cancelling the rename", key, error)
+                    for pending in futures:
+                        pending.cancel()
+                continue
+            copied.append(dst_prefix + key[len(src_prefix):])
+            copied_bytes += size
+            if time.monotonic() - last_report > PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                logger.info(
+                    "renaming %r to %r: %d/%d objects, %d/%d bytes copied",
+                    src_prefix, dst_prefix, len(copied), len(objects), copied_bytes, total_bytes,
+                )
+    if error is not None:
+        leftovers = delete_objects(storage, copied)
+        if leftovers:
+            logger.error("rolling back %r left %d copies behind", dst_prefix, len(leftovers))
+        raise OSError(errno.EIO, "Rename failed: %s" % error, src_prefix)
+    leftovers = delete_objects(storage, [key for key, size in objects])
+    if leftovers:
+        logger.error("renamed %r to %r but %d sources could not be deleted",
+                     src_prefix, dst_prefix, len(leftovers))
+    logger.info("renamed %r to %r: %d objects, %d bytes", src_prefix, dst_prefix, len(objects), total_bytes)
+
+
+def delete_prefix(storage, name):
+    """
+    Delete every object under the directory `name`, and its placeholder.
+
+    The listing is streamed: each page of up to DELETE_BATCH_SIZE keys is
+    handed to a DeleteObjects request as soon as it arrives, CONCURRENCY
+    requests at a time, so memory stays bounded whatever the size of the
+    directory. Every key S3 refuses is logged; if there are any, OSError
+    (EIO) is raised once all batches are done and the refused objects are
+    left in place. Return the number of objects deleted.
+    """
+    conf = get_delete_settings()
+    prefix = s3_key(storage, name) + "/"
+    client = get_client(storage)
+    paginator = client.get_paginator("list_objects_v2")
+    deleted = 0
+    failed = []
+    last_report = time.monotonic()
+    pending = set()
+
+    def delete(batch):
+        try:
+            return batch, _delete_batch(storage, batch), None
+        except Exception as err:
+            return batch, (), err
+
+    def collect(done):
+        nonlocal deleted
+        for future in done:
+            batch, errors, exception = future.result()
+            if exception is not None:
+                # the whole request failed: every key it carried is left
+                logger.warning("deleting %d keys from %r to %r failed: %s",
+                               len(batch), batch[0], batch[-1], exception)
+                failed.extend(batch)
+                continue
+            for key, message in errors:
+                logger.warning("deleting %r failed: %s", key, message)
+                failed.append(key)
+            deleted += len(batch) - len(errors)
+
+    logger.info("deleting %r", prefix)
+    with ThreadPoolExecutor(max_workers=conf["CONCURRENCY"], thread_name_prefix="s3-delete") as executor:
+        try:
+            pages = paginator.paginate(
+                Bucket=storage.bucket_name, Prefix=prefix,
+                PaginationConfig={"PageSize": DELETE_BATCH_SIZE},
+            )
+            for page in pages:
+                batch = [entry["Key"] for entry in page.get("Contents", ())]
+                if not batch:
+                    continue
+                if len(pending) >= conf["CONCURRENCY"]:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(delete, batch))
+                if time.monotonic() - last_report > PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    logger.info("deleting %r: %d objects deleted", prefix, deleted)
+        finally:
+            # let the batches already sent finish, even if listing failed
+            done, pending = wait(pending)
+            collect(done)
+    if failed:
+        logger.error("deleting %r left %d objects behind", prefix, len(failed))
+        raise OSError(
+            errno.EIO, "%d objects could not be deleted" % len(failed), prefix
+        )
+    logger.info("deleted %r: %d objects", prefix, deleted)
+    return deleted
@@ -0,0 +1,227 @@
+"""CONFIG>servers.py"""
+
+import errno
+import logging
+import os
+import signal
+import socket
+import time
+
+from django.db import connections
+from pyftpdlib.ioloop import IOLoop
+from pyftpdlib.servers import FTPServer
+
+from .cache import share_invalidations
+from .logqueue import stop_log_queue
+from .metrics import start_listener
+from .pipeline import get_upload_pipeline
+from .startup import log_ready, warm_up
+
+logger = logging.getLogger(__name__)
+
+
+class PreforkFTPServer:
+    """
+    Supervisor running `workers` FTPServer processes that accept on a
+    single listening socket bound by the parent.
+
+    Every worker gets its own IOLoop (epoll instance), its own storage
+    clients and database connections, and a disjoint slice of the passive
+    port range, so workers never race each other for a data port. With
+    FTPSERVER_METRICS enabled, worker N serves its metrics on PORT + N.
+    Their metadata caches are separate too, but share invalidations (see
+    CONFIG.cache.share_invalidations()), so a write made through one
+    worker is seen at once by sessions on the others.
+
+    Signals handled by the parent:
+
+    - SIGHUP: start a new set of workers, then let the old ones finish
+      their sessions and exit (rolling restart).
+    - SIGTERM / SIGINT: stop accepting, let workers finish their sessions
+      (up to `graceful_timeout` seconds) and exit.
+
+    A worker that dies on its own is restarted with the same slot.
+    """
+
+    # seconds a stopping worker waits for open sessions before closing them
+    graceful_timeout = 60
+    # a worker exiting sooner than this after start is restarted with a delay
+    min_uptime = 1.0
+
+    def __init__(self, address, handler, workers=None, backlog=100):
+        self.handler = handler
+        self.workers = workers if workers and workers > 0 else os.cpu_count() or 1
+        self.backlog = backlog
+        self.socket = self._bind(address, backlog)
+        share_invalidations()
+        self.children = {}  # pid -> (slot, generation, started)
+        self.generation = 0
+        self._reload = False
+        self._stop = False
+
+    @property
+    def address(self):
+        return self.socket.getsockname()[:2]
+
+    @staticmethod
+    def _bind(address, backlog):
+        host, port = address
+        err = None
+        for af, socktype, proto, _, sa in socket.getaddrinfo(
+            host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE
+        ):
+            sock = None
+            try:
+                sock = socket.socket(af, socktype, proto)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind(sa)
+                sock.listen(backlog)
+                sock.setblocking(False)
+                return sock
+            except OSError as e:
+                err = e
+                if sock is not None:
+                    sock.close()
+        raise err or OSError(errno.EADDRNOTAVAIL, "cannot bind %s:%s" % (host, port))
+
+    def passive_ports_for(self, slot):
+        """Return the passive ports worker `slot` may use."""
+        ports = self.handler.passive_ports
+        if not ports:
+            return ports
+        if len(ports) < self.workers:
+            logger.warning(
+                "%d passive ports for %d workers: sharing the whole range",
+                len(ports), self.workers,
+            )
+            return ports
+        return list(ports)[slot::self.workers]
+
+    # --------------------- parent ---------------------
+
+    def serve_forever(self, timeout=None, blocking=True, handle_exit=True):
+        logger.info(
+            ">>> starting FTP server on %s:%s with %d workers, pid=%i <<<",
+            self.address[0], self.address[1], self.workers, os.getpid(),
+        )
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        self._spawn_generation()
+        try:
+            self._supervise()
+        finally:
+            self.socket.close()
+            logger.info(">>> FTP server stopped, pid=%i <<<", os.getpid())
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stop = True
+
+    def _spawn_generation(self):
+        self.generation += 1
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self._run_worker(slot)
+                status = 0
+            except BaseException:
+                logger.exception("worker %d crashed", slot)
+            finally:
+                # os._exit() skips logging.shutdown()
+                stop_log_queue()
+                os._exit(status)
+        self.children[pid] = (slot, self.generation, time.monotonic())
+        logger.info("started worker %d (pid %d)", slot, pid)
+
+    def _signal_children(self, sig, generation=None):
+        for pid, (slot, gen, started) in list(self.children.items()):
+            if generation is None or gen == generation:
+                try:
+                    os.kill(pid, sig)
+                except ProcessLookupError:
+                    pass
+
+    def _supervise(self):
+        stopping = False
+        while self.children:
+            if self._stop and not stopping:
+                stopping = True
+                logger.info("stopping %d workers", len(self.children))
+                self._signal_children(signal.SIGTERM)
+            if self._reload and not stopping:
+                self._reload = False
+                old = self.generation
+                logger.info("reloading workers")
+                self._spawn_generation()
+                self._signal_children(signal.SIGTERM, generation=old)
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                time.sleep(0.2)
+                continue
+            slot, gen, started = self.children.pop(pid)
+            if stopping or gen != self.generation:
+                continue
+            if os.WIFSIGNALED(status):
+                logger.warning("worker %d (pid %d) killed by signal %d, restarting",
+                               slot, pid, os.WTERMSIG(status))
+            else:
+                logger.warning("worker %d (pid %d) exited with status %d, restarting",
+                               slot, pid, os.WEXITSTATUS(status))
+            if time.monotonic() - started < self.min_uptime:
+                time.sleep(self.min_uptime)
+            self._spawn(slot)
+
+    # --------------------- worker ---------------------
+
+    def _run_worker(self, slot):
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, signal.SIG_DFL)
+        # nothing opened by the parent is safe to share with a child
+        connections.close_all()
+
+        self.handler.passive_ports = self.passive_ports_for(slot)
+        ioloop = IOLoop()
+        server = FTPServer(self.socket, self.handler, ioloop=ioloop, backlog=self.backlog)
+        stop = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(time.monotonic()))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        metrics_listener = start_listener(offset=slot)
+        # works through jobs left in the queue even before the first upload
+        pipeline = get_upload_pipeline()
+        warm_up(self.handler)
+
+        def check():
+            if not stop:
+                return
+            if not server._closed:
+                # stop accepting; sessions already open keep running
+                server.close()
+                if metrics_listener is not None:
+                    # free the port for the worker replacing this one
+                    metrics_listener.close()
+            busy = [c for c in ioloop.socket_map.values() if not getattr(c, "daemon", False)]
+            if not busy or time.monotonic() - stop[0] > self.graceful_timeout:
+                ioloop.close()
+
+        ioloop.call_every(1, check)
+        logger.info(">>> worker %d serving, pid=%i <<<", slot, os.getpid())
+        log_ready("worker %d" % slot)
+        try:
+            ioloop.loop(timeout=1)
+        finally:
+            if ioloop.socket_map:
+                ioloop.close()
+            if pipeline is not None:
+                # os._exit() skips atexit handlers
+                pipeline.close()
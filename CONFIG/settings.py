@@ -45,6 +45,8 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    # CONFIG overrides django_ftpserver's ftpserver command, so it goes first
+    'CONFIG',
     'django_ftpserver',
     # Add storages to support S3-backed media storage
     'storages',
@@ -137,6 +139,18 @@ STATICFILES_DIRS = [STATICFILES_DIR]
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# LOGGING ---------------------------------------------------------------------
+
+# CONFIG/logging.py, when local_settings.py gives its LOGS_DIR. The handlers are
+# put behind the queue of FTPSERVER_LOG_QUEUE (CONFIG.logqueue.configure).
+try:
+    from .logging import LOGGING  # noqa: F401
+except ImportError:
+    pass
+
+LOGGING_CONFIG = 'CONFIG.logqueue.configure'
+
+
 # MEDIA / STORAGE -------------------------------------------------------------
 
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
@@ -179,3 +193,251 @@ FTPSERVER_PASSIVE_PORTS = FTPSERVER_PASSIVE_PORTS
 # for most deployments) you can set a custom handler where
 # `permit_foreign_addresses = True`. See CONFIG/ftp_handler.py for an example.
 FTPSERVER_HANDLER = 'CONFIG.ftp_handler.PermissiveFTPHandler'
+
+# Authorizer caching the FTP accounts it reads, so a login or a permission check
+# does not query the database and run the password hasher every time. Accounts
+# are re-read after TTL seconds; a login whose password was already verified
+# against the account's current password hash skips the hasher. Users, FTP
+# accounts and groups changed from another process (e.g. the admin site) take
+# effect within TTL seconds. last_login is written at most every
+# LAST_LOGIN_INTERVAL seconds.
+FTPSERVER_AUTHORIZER = 'CONFIG.authorizers.CachedAccountAuthorizer'
+
+FTPSERVER_AUTH_CACHE = {
+    'TTL': 60,
+    'MAX_ENTRIES': 10000,
+    'LAST_LOGIN_INTERVAL': 300,
+}
+
+# Per client IP: at most RATE password checks per second (BURST at once) go to
+# the password hasher, and after MAX_FAILURES failed logins within
+# FAILURE_WINDOW seconds logins are refused for BLOCK_TIME seconds. Logins
+# answered from the cache above are not limited.
+FTPSERVER_LOGIN_THROTTLE = {
+    'RATE': 5,
+    'BURST': 20,
+    'MAX_FAILURES': 20,
+    'FAILURE_WINDOW': 60,
+    'BLOCK_TIME': 300,
+    'MAX_ADDRESSES': 65536,
+}
+
+# Apps loaded by `manage.py ftpserver`, which runs with CONFIG.ftpserver_settings
+# (picked by manage.py unless DJANGO_SETTINGS_MODULE or --settings says
+# otherwise): these settings with only the apps FTP sessions use, so the server
+# and every --workers process start without the admin site, sessions, messages
+# and staticfiles. Add the apps your FTPSERVER_UPLOAD_PIPELINE stages need.
+FTPSERVER_INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'CONFIG',
+    'django_ftpserver',
+    'storages',
+]
+
+# Number of pre-forked ftpserver worker processes sharing the listening socket
+# (same as `manage.py ftpserver --workers N`). 1 runs a single process, 0 starts
+# one worker per CPU. Each worker uses its own slice of FTPSERVER_PASSIVE_PORTS,
+# so keep the range at least as large as the number of workers. Send SIGHUP to
+# the parent to replace workers gracefully.
+FTPSERVER_WORKERS = 1
+
+# Metadata cache shared by all FTP sessions of the ftpserver process. Stats and
+# listings learned from the storage are reused for TTL seconds; writes made
+# through the FTP server invalidate the affected entries immediately, in every
+# worker with --workers. Set NEGATIVE_TTL to 0 to stop caching "no such file"
+# results.
+FTPSERVER_METADATA_CACHE = {
+    'MAX_ENTRIES': 100000,
+    'TTL': 30,
+    'NEGATIVE_TTL': 5,
+    'MAX_LISTING_SIZE': 10000,
+}
+
+# Number of worker threads running blocking storage calls (S3 requests,
+# listings, opens) off the FTP event loop, so a slow backend only delays the
+# session waiting on it. 0 runs them inline on the event loop. Not compatible
+# with FTPSERVER_FILE_ACCESS_USER impersonation, which is per-thread.
+FTPSERVER_STORAGE_WORKERS = 0
+
+# Uploads (STOR) to S3 are streamed with a multipart upload while the client
+# sends data: PART_SIZE bytes per part (at least 5 MB), CONCURRENCY parts
+# uploaded at once per transfer. Memory used per upload is bounded by about
+# (CONCURRENCY + 1) * PART_SIZE; nothing is spooled to local disk.
+FTPSERVER_S3_UPLOAD = {
+    'PART_SIZE': 8 * 1024 * 1024,
+    'CONCURRENCY': 4,
+}
+
+# Downloads (RETR) from S3 are read with ranged GETs of CHUNK_SIZE bytes,
+# PREFETCH chunks ahead of the one being sent. A resumed transfer (REST) starts
+# reading at the requested offset instead of fetching the whole object.
+FTPSERVER_S3_DOWNLOAD = {
+    'CHUNK_SIZE': 1024 * 1024,
+    'PREFETCH': 4,
+}
+
+# Threads per process running the ranged GETs and multipart part uploads of all
+# S3 transfers. CONCURRENCY and PREFETCH above still cap what each transfer has
+# in flight; transfers beyond this many requests at once wait their turn.
+FTPSERVER_S3_TRANSFER_WORKERS = 32
+
+# Optional on-disk cache of objects downloaded from S3 (RETR). Set DIRECTORY to
+# a local path to enable it. Objects are cached per ETag in BLOCK_SIZE blocks;
+# each ftpserver process evicts least recently used objects beyond MAX_BYTES.
+# Fully cached objects are sent with sendfile(). Uploads, deletes and renames
+# made through the FTP server drop the affected objects.
+FTPSERVER_BLOCK_CACHE = {
+    'DIRECTORY': '',
+    'BLOCK_SIZE': 1024 * 1024,
+    'MAX_BYTES': 1024 * 1024 * 1024,
+}
+
+# Optional persistent index of the objects of S3 storages (keys, sizes, mtimes,
+# ETags), one SQLite file per bucket and location in DIRECTORY; empty disables
+# it. Once built by a background listing of the bucket, stats and directory
+# listings (LIST, NLST, MLSD, MLST, STAT, SIZE, MDTM) are answered from it
+# without S3 requests. Writes made through the FTP server update it at once; it
+# is reconciled with a full listing every RECONCILE_INTERVAL seconds, which is
+# also how long changes made by other S3 clients may take to show. It is not
+# used while its last reconciliation is older than MAX_AGE seconds. The file may
+# be shared by --workers processes; one of them reconciles it.
+FTPSERVER_NAMESPACE_INDEX = {
+    'DIRECTORY': '',
+    'RECONCILE_INTERVAL': 300,
+    'MAX_AGE': 3600,
+}
+
+# Renames (RNFR/RNTO) on S3 use server-side copies followed by deletes, so no
+# data goes through the FTP server. Objects above MULTIPART_THRESHOLD are copied
+# in PART_SIZE parts; directory renames copy CONCURRENCY objects at a time and
+# are rolled back if any copy fails. Enable FTPSERVER_STORAGE_WORKERS so long
+# renames do not hold up other sessions.
+FTPSERVER_S3_COPY = {
+    'MULTIPART_THRESHOLD': 1024 * 1024 * 1024,
+    'PART_SIZE': 256 * 1024 * 1024,
+    'CONCURRENCY': 8,
+}
+
+# RMD removes a directory together with everything under it. On S3 the keys are
+# listed page by page and deleted with DeleteObjects requests of up to 1000 keys,
+# CONCURRENCY requests at a time; keys that cannot be deleted are logged and the
+# command fails. Off by default: RMD then only removes empty directories
+# (FileSystemStorage) or the directory placeholder (S3).
+FTPSERVER_RECURSIVE_RMD = False
+
+FTPSERVER_S3_DELETE = {
+    'CONCURRENCY': 4,
+}
+
+# Prometheus-style metrics of the FTP server: sessions, commands, transfers,
+# storage and S3 calls (counts and latency histograms) and cache hit rates,
+# served as text at http://ADDRESS:PORT/metrics by the ftpserver process. With
+# --workers, worker N listens on PORT + N. Off by default, in which case nothing
+# is instrumented.
+FTPSERVER_METRICS = {
+    'ENABLED': False,
+    'ADDRESS': '127.0.0.1',
+    'PORT': 9121,
+}
+
+# FTP sessions share one storage instance per process (per worker with
+# --workers) instead of creating one at every login. On S3 that means one boto3
+# client: credentials are resolved once and up to MAX_POOL_CONNECTIONS
+# keep-alive connections are reused by every session and storage worker thread.
+# USER_OPTIONS gives storage constructor options for specific FTP users, e.g.
+# {'alice': {'bucket_name': 'alice-data'}}; users with the same options share an
+# instance. Set SHARED to False to go back to one instance per session.
+FTPSERVER_STORAGE_CLIENT = {
+    'SHARED': True,
+    'MAX_POOL_CONNECTIONS': 50,
+    'TCP_KEEPALIVE': True,
+    'USER_OPTIONS': {},
+}
+
+# Post-upload processing: every file received over FTP is queued in the database
+# (run `manage.py migrate`) and WORKERS threads per ftpserver process run STAGES
+# on it, in order, off the FTP event loop, so uploads complete as fast as before.
+# A stage is the dotted path of a callable taking the CONFIG.models.UploadJob
+# (job.path, job.key, job.open(), job.get_storage()); if it raises, the job is
+# retried after RETRY_DELAY seconds, doubled each time, up to MAX_ATTEMPTS.
+# Stages may run again on the same file after a crash, so make them idempotent.
+# While more than MAX_QUEUED jobs wait, STOR and APPE are answered with 450.
+FTPSERVER_UPLOAD_PIPELINE = {
+    'ENABLED': False,
+    'STAGES': [],
+    'WORKERS': 2,
+    'MAX_QUEUED': 10000,
+    'MAX_ATTEMPTS': 5,
+    'RETRY_DELAY': 30,
+    'LEASE': 600,
+    'POLL_INTERVAL': 1.0,
+    'KEEP_DONE': False,
+}
+
+# Checksums of S3 uploads (STOR), computed while the data streams to S3. Every
+# request carries a Content-MD5 so S3 rejects corrupted parts, and the ETag of
+# the completed object is checked: on a mismatch the upload fails (426) and is
+# logged, the object is kept. The checksums are stored with the object: as user metadata
+# (x-amz-meta-ftp-sha256, ...) when it fits in one PutObject, as object tags
+# after a multipart upload (needs s3:PutObjectTagging). XMD5 and HASH answer
+# from them without reading the object. "crc32c" needs the awscrt package. Off
+# by default: uploads are then streamed without Content-MD5 or ETag checks.
+FTPSERVER_CHECKSUMS = {
+    'ENABLED': False,
+    'ALGORITHMS': ['md5', 'sha256', 'crc32c'],
+}
+
+# Quality of service between FTP users. READ_LIMIT and WRITE_LIMIT cap the bytes
+# per second sent to and received from all clients together; users transferring
+# at the same time share them in proportion to their WEIGHT. USER_READ_LIMIT and
+# USER_WRITE_LIMIT cap each user, BURST is how many seconds of their rate a user
+# may send at once, and MAX_TRANSFERS caps a user's concurrent file transfers
+# (more are answered with 450). USERS overrides these per user, e.g.
+# {'bulk': {'WEIGHT': 1, 'READ_LIMIT': 10 * 1024 * 1024, 'MAX_TRANSFERS': 2}}.
+# BACKENDS caps the requests outstanding to a storage class, handed out fairly by
+# WEIGHT, e.g. {'storages.backends.s3.S3Storage': {'MAX_REQUESTS': 32}}; use it
+# with FTPSERVER_STORAGE_WORKERS. With --workers, limits apply per worker process.
+FTPSERVER_QOS = {
+    'ENABLED': False,
+    'READ_LIMIT': 0,
+    'WRITE_LIMIT': 0,
+    'USER_READ_LIMIT': 0,
+    'USER_WRITE_LIMIT': 0,
+    'BURST': 1.0,
+    'MAX_TRANSFERS': 0,
+    'WEIGHT': 1,
+    'USERS': {},
+    'BACKENDS': {},
+}
+
+# SITE MSTAT, SITE MDELE and SITE MCOPY stat, delete or copy many files with one
+# command: "SITE MDELE /in/*.csv", "SITE MCOPY /in/*.csv /archive", or
+# "SITE MSTAT @list.txt" for the paths listed (one per line) in an uploaded
+# manifest file. Files are handled CONCURRENCY at a time per command, on WORKERS
+# threads per process, and the reply has one line per file as it finishes. ABOR
+# stops a command after the files already started. Copies on S3 are server-side.
+FTPSERVER_SITE_BULK = {
+    'WORKERS': 16,
+    'CONCURRENCY': 8,
+    'MAX_ITEMS': 10000,
+    'MAX_MANIFEST_SIZE': 1024 * 1024,
+}
+
+# Log records are written out by a background thread (CONFIG.logqueue) instead
+# of by the thread that logs them, usually the FTP event loop, so a slow disk
+# never holds up sessions. At most MAX_RECORDS records wait in memory, each cut
+# to MAX_MESSAGE_SIZE characters. Once that many wait, new records below WARNING
+# are dropped; WARNING and above are still queued until RESERVE more wait. The
+# number of records dropped is logged as a warning as soon as the queue has
+# room again. DEBUG_SAMPLING keeps only a fraction of the DEBUG records of
+# chatty loggers, e.g. the per-call records of CONFIG.filesystems. Every file
+# transfer is also logged to LOGS_DIR/xferlog.jsonl, one JSON object per line
+# with the xferlog fields (see CONFIG/logging.py).
+FTPSERVER_LOG_QUEUE = {
+    'ENABLED': True,
+    'MAX_RECORDS': 10000,
+    'RESERVE': 1000,
+    'MAX_MESSAGE_SIZE': 8192,
+    'DEBUG_SAMPLING': {'CONFIG.filesystems': 0.01},
+}
@@ -0,0 +1,57 @@
+"""CONFIG>startup.py"""
+
+import logging
+import os
+import sys
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def process_uptime():
+    """Return the seconds since this process started (for a forked
+    worker: since the fork), or None where /proc is not available."""
+    try:
+        with open("/proc/self/stat") as stat:
+            # the fields after the command name, which may contain spaces;
+            # field 22 is the start time in clock ticks after boot
+            started = int(stat.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as uptime:
+            now = float(uptime.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(now - started / os.sysconf("SC_CLK_TCK"), 0.0)
+
+
+def warm_up(handler, full=True):
+    """
+    Get the storage of `handler`'s filesystem ready for the first login
+    (see StorageFS.warm_up()); with `full`, everything the sessions of
+    this process share, otherwise only what survives a fork(): the
+    imports and a storage client the workers will not use, but whose
+    creation imported what theirs need. Failures are logged, the
+    sessions will try again.
+    """
+    filesystem = getattr(handler, "abstracted_fs", None)
+    if not hasattr(filesystem, "warm_up"):
+        return
+    start = time.monotonic()
+    root = getattr(settings, "FTPSERVER_DIRECTORY", None) or settings.MEDIA_ROOT or os.sep
+    try:
+        filesystem.warm_up(root if full else None)
+    except Exception:
+        logger.warning("could not get the storage ready before the first login", exc_info=True)
+        return
+    logger.debug("storage ready in %.3fs", time.monotonic() - start)
+
+
+def log_ready(name="ftpserver"):
+    """Log how long this process took to be ready to serve, to follow
+    startup times (benchmarks/bench_startup.py breaks them down)."""
+    uptime = process_uptime()
+    if uptime is None:
+        logger.info("%s ready, %d modules loaded", name, len(sys.modules))
+    else:
+        logger.info("%s ready %.2fs after start, %d modules loaded", name, uptime, len(sys.modules))
@@ -0,0 +1,555 @@
+"""CONFIG>streams.py"""
+
+import base64
+import contextvars
+import errno
+import hashlib
+import io
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import parse_qsl
+
+from django.conf import settings
+
+from .checksums import STORED_PREFIX, StreamChecksums, get_checksum_settings
+from .offload import ProcessLocal
+from .qos import backend_request
+from .s3ops import get_client
+
+logger = logging.getLogger(__name__)
+
+# S3 rejects multipart parts smaller than this (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+DEFAULT_S3_UPLOAD = {
+    # size of each multipart part; 10,000 parts of 8 MB allow ~80 GB files
+    "PART_SIZE": 8 * 1024 * 1024,
+    # parts uploaded at the same time by one transfer
+    "CONCURRENCY": 4,
+}
+
+
+DEFAULT_S3_DOWNLOAD = {
+    # bytes fetched by each ranged GET
+    "CHUNK_SIZE": 1024 * 1024,
+    # chunks requested ahead of the one being sent
+    "PREFETCH": 4,
+}
+
+# threads per process running the part uploads and ranged GETs of every
+# transfer (FTPSERVER_S3_TRANSFER_WORKERS)
+DEFAULT_TRANSFER_WORKERS = 32
+
+
+def get_upload_settings():
+    conf = dict(DEFAULT_S3_UPLOAD)
+    conf.update(getattr(settings, "FTPSERVER_S3_UPLOAD", None) or {})
+    conf["PART_SIZE"] = max(int(conf["PART_SIZE"]), MIN_PART_SIZE)
+    conf["CONCURRENCY"] = max(int(conf["CONCURRENCY"]), 1)
+    return conf
+
+
+def get_download_settings():
+    conf = dict(DEFAULT_S3_DOWNLOAD)
+    conf.update(getattr(settings, "FTPSERVER_S3_DOWNLOAD", None) or {})
+    conf["CHUNK_SIZE"] = max(int(conf["CHUNK_SIZE"]), 64 * 1024)
+    conf["PREFETCH"] = max(int(conf["PREFETCH"]), 0)
+    return conf
+
+
+def _create_transfer_executor():
+    workers = getattr(settings, "FTPSERVER_S3_TRANSFER_WORKERS", None) or DEFAULT_TRANSFER_WORKERS
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="s3-transfer")
+
+
+_transfer_executor = ProcessLocal(_create_transfer_executor)
+
+
+def get_transfer_executor():
+    """Return the executor shared by the transfers of this process. It
+    bounds their threads; each transfer bounds its own requests."""
+    return _transfer_executor.get()
+
+
+class S3MultipartWriter:
+    """
+    Write-only file object streaming to an S3 key with a multipart upload.
+
+    Data is cut into parts of `part_size` bytes as it arrives and every
+    full part is uploaded right away, up to `concurrency` parts at a
+    time, on the executor shared by all transfers
+    (get_transfer_executor()), so the object is complete shortly after
+    the last byte is written. At most about (concurrency + 1) * part_size bytes are held
+    in memory and nothing is written to local disk.
+
+    close() uploads the remaining bytes and completes the upload (a file
+    smaller than one part is sent with a single PutObject). abort()
+    throws everything away and aborts the multipart upload without
+    waiting for the parts already being sent; it is also what close()
+    does if any part failed. Both make blocking requests: callers on the
+    IOLoop run them on the storage worker pool. Once the object is stored,
+    close() calls `on_complete(writer)`, if given; `etag` is then set.
+
+    With FTPSERVER_CHECKSUMS enabled, the checksums of the whole object
+    are computed part by part, in order, one part at a time on the
+    shared executor, and stored with the object: in its user metadata
+    when it is sent with a PutObject, in its tags after a multipart
+    upload (whose metadata is fixed before the first byte is known).
+    Every request carries the Content-MD5 of its body, so S3 rejects
+    corrupted parts, and the ETag of the completed object is compared
+    with the MD5s. A mismatch is logged and close() fails once the
+    object is stored; the object is kept, since an ETag computed
+    differently (by an S3-compatible store or a proxy) is not proof of
+    corruption, and deleting it would lose the only copy of an
+    overwritten file.
+    """
+
+    def __init__(self, storage, name, part_size=None, concurrency=None, on_complete=None):
+        from storages.utils import clean_name
+
+        conf = get_upload_settings()
+        self.part_size = max(part_size or conf["PART_SIZE"], MIN_PART_SIZE)
+        self.concurrency = concurrency or conf["CONCURRENCY"]
+        self.storage = storage
+        self.key = storage._normalize_name(clean_name(name))
+        self.name = self.key[len(storage.location):].lstrip("/")
+        self.mode = "wb"
+        self.on_complete = on_complete
+        self.etag = None
+        # boto3 clients (unlike resources) may be shared between threads
+        self._client = get_client(storage)
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []  # futures of {PartNumber, ETag} dicts
+        self._error = None
+        self._written = 0
+        self._closed = False
+        conf = get_checksum_settings()
+        self.checksums = None
+        self._checksums = StreamChecksums(conf["ALGORITHMS"]) if conf["ENABLED"] else None
+        self._unhashed = deque()
+        self._hasher = None  # future hashing self._unhashed, while it runs
+        self._hash_lock = threading.Lock()
+        self._part_md5s = {}
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self._written
+
+    # --------------------- writing ---------------------
+
+    def write(self, data):
+        if self._closed:
+            raise ValueError("I/O operation on closed file.")
+        self._raise_failed()
+        self._buffer += data
+        self._written += len(data)
+        while len(self._buffer) >= self.part_size:
+            if self.full():
+                # a caller that cannot pause itself waits for a slot
+                self._wait(self._in_flight()[0])
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(data)
+
+    def full(self):
+        """True when a complete part is buffered and cannot start yet.
+
+        Callers able to stop producing (the data channel) check this after
+        each write and wait until it turns False again.
+        """
+        self._raise_failed()
+        return len(self._buffer) >= self.part_size and len(self._in_flight()) >= self.concurrency
+
+    def _in_flight(self):
+        return [f for f in self._parts if not f.done()]
+
+    def _raise_failed(self):
+        if self._error is None:
+            for future in self._parts:
+                if future.done() and future.exception() is not None:
+                    self._error = future.exception()
+                    break
+        if self._error is not None:
+            raise OSError(errno.EIO, "Upload to storage failed: %s" % self._error, self.name)
+
+    def _wait(self, future):
+        try:
+            future.result()
+        except Exception:
+            self._raise_failed()
+
+    def _upload_part(self, body):
+        if self._upload_id is None:
+            response = self._client.create_multipart_upload(
+                Bucket=self.storage.bucket_name,
+                Key=self.key,
+                **self.storage._get_write_parameters(self.key)
+            )
+            self._upload_id = response["UploadId"]
+        executor = get_transfer_executor()
+        if self._checksums is not None:
+            with self._hash_lock:
+                self._unhashed.append(body)
+                if self._hasher is None:
+                    self._hasher = executor.submit(self._hash_parts)
+        number = len(self._parts) + 1
+        # in the context of the data channel, for FTPSERVER_QOS
+        context = contextvars.copy_context()
+        self._parts.append(executor.submit(context.run, self._send_part, number, body))
+
+    def _hash_parts(self):
+        # a single task at a time, so parts are hashed in order
+        while True:
+            with self._hash_lock:
+                if not self._unhashed:
+                    self._hasher = None
+                    return
+                body = self._unhashed.popleft()
+            self._checksums.update(body)
+
+    def _wait_hashed(self):
+        with self._hash_lock:
+            hasher = self._hasher
+        if hasher is not None:
+            hasher.result()
+
+    def _send_part(self, number, body):
+        extra = {}
+        if self._checksums is not None:
+            md5 = hashlib.md5(body).digest()
+            self._part_md5s[number] = md5
+            extra["ContentMD5"] = base64.b64encode(md5).decode()
+        response = self._client.upload_part(
+            Bucket=self.storage.bucket_name,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=number,
+            Body=body,
+            **extra
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    # --------------------- finishing ---------------------
+
+    def close(self):
+        """Upload what is left and complete the object."""
+        if self._closed:
+            return
+        matches = True
+        try:
+            if self._upload_id is None:
+                matches = self._put_object(bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                for future in self._parts:
+                    self._wait(future)
+                response = self._client.complete_multipart_upload(
+                    Bucket=self.storage.bucket_name,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": [f.result() for f in self._parts]},
+                )
+                # completed: nothing left to abort
+                self._upload_id = None
+                self.etag = response.get("ETag", "").strip('"')
+                if self._checksums is not None:
+                    md5s = b"".join(self._part_md5s[number] for number in range(1, len(self._parts) + 1))
+                    matches = self._verify(response, "%s-%d" % (hashlib.md5(md5s).hexdigest(), len(self._parts)))
+                    self._wait_hashed()
+                    self.checksums = self._checksums.hexdigests()
+                    if matches:
+                        self._tag_checksums()
+        except Exception:
+            self.abort()
+            raise
+        self._release()
+        if self.on_complete is not None:
+            # the object is stored, whether it matches or not
+            self.on_complete(self)
+        if not matches:
+            raise OSError(errno.EIO, "Stored object does not match the uploaded data", self.name)
+
+    def _put_object(self, body):
+        params = self.storage._get_write_parameters(self.key)
+        if self._checksums is not None:
+            self._checksums.update(body)
+            self.checksums = self._checksums.hexdigests()
+            metadata = dict(params.get("Metadata") or {})
+            metadata.update((STORED_PREFIX + name, value) for name, value in self.checksums.items())
+            params["Metadata"] = metadata
+            params["ContentMD5"] = base64.b64encode(hashlib.md5(body).digest()).decode()
+        response = self._client.put_object(Bucket=self.storage.bucket_name, Key=self.key, Body=body, **params)
+        self.etag = response.get("ETag", "").strip('"')
+        if self._checksums is not None:
+            return self._verify(response, hashlib.md5(body).hexdigest())
+        return True
+
+    def _verify(self, response, expected_etag):
+        """Return whether the ETag of the stored object is `expected_etag`,
+        logging a mismatch. ETags of objects encrypted with SSE-KMS or
+        SSE-C are not MD5s and are not checked."""
+        if response.get("SSECustomerAlgorithm") or response.get("ServerSideEncryption", "").startswith("aws:kms"):
+            return True
+        etag = response.get("ETag", "").strip('"')
+        if etag == expected_etag:
+            return True
+        logger.error("%r stored with ETag %s instead of %s; the upload fails, the object is kept",
+                     self.key, etag, expected_etag)
+        return False
+
+    def _tag_checksums(self):
+        # tags replace the whole tag set: keep those the storage sets
+        tags = parse_qsl(self.storage._get_write_parameters(self.key).get("Tagging") or "")
+        tags += [(STORED_PREFIX + name, value) for name, value in self.checksums.items()]
+        try:
+            self._client.put_object_tagging(
+                Bucket=self.storage.bucket_name,
+                Key=self.key,
+                Tagging={"TagSet": [{"Key": key, "Value": value} for key, value in tags]},
+            )
+        except Exception as e:
+            # the object is fine; XMD5/HASH will have to read it
+            logger.warning("storing the checksums of %r failed: %s", self.key, e)
+
+    def abort(self):
+        """Discard the transfer; nothing is stored under the key. Parts not
+        started yet are cancelled; those being sent are not waited for,
+        the upload is aborted again in the background once they are done
+        (S3 may still store a part sent while it was aborted)."""
+        if self._closed:
+            return
+        sending = [future for future in self._parts if not future.cancel() and not future.done()]
+        with self._hash_lock:
+            self._unhashed.clear()
+        if self._upload_id is not None:
+            self._abort_upload(self._upload_id)
+            if sending:
+                get_transfer_executor().submit(self._abort_after, sending, self._upload_id)
+        self._release()
+
+    def _abort_upload(self, upload_id, again=False):
+        try:
+            self._client.abort_multipart_upload(Bucket=self.storage.bucket_name, Key=self.key, UploadId=upload_id)
+        except self._client.exceptions.NoSuchUpload:
+            if not again:
+                logger.warning("aborting multipart upload of %r failed: no such upload", self.key)
+        except Exception:
+            logger.warning("aborting multipart upload of %r failed", self.key, exc_info=True)
+
+    def _abort_after(self, futures, upload_id):
+        # the futures are running, not queued behind this task
+        wait(futures)
+        self._abort_upload(upload_id, again=True)
+
+    def _release(self):
+        self._buffer = bytearray()
+        self._parts = []
+        self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class S3RangeReader:
+    """
+    Read-only, seekable file object reading an S3 object with ranged GETs.
+
+    Nothing is downloaded until the first read(); from then on the chunk
+    holding the current position and the `prefetch` chunks after it are
+    fetched in the background, `chunk_size` bytes each. seek() only moves
+    the position, so resuming a transfer (REST) costs nothing, and the
+    first byte is available after a single small GET whatever the size
+    of the object. The GETs run on the executor shared by all transfers
+    (get_transfer_executor()).
+
+    Every GET is conditional on the ETag seen when the reader was opened:
+    if the object is replaced mid-transfer, read() fails instead of
+    mixing two versions.
+
+    With a `cache` (CONFIG.blockcache.BlockCache), chunks are the cache's
+    blocks: cached ones are read locally and downloaded ones are kept.
+    Once the whole object is cached, fileno() returns the local file so
+    the data channel can use sendfile().
+    """
+
+    def __init__(self, storage, name, chunk_size=None, prefetch=None, size=None, etag=None,
+                 cache=None, cache_key=None):
+        from storages.utils import clean_name
+
+        conf = get_download_settings()
+        self.chunk_size = chunk_size or conf["CHUNK_SIZE"]
+        if cache is not None:
+            self.chunk_size = cache.block_size
+        self.prefetch = conf["PREFETCH"] if prefetch is None else prefetch
+        self.storage = storage
+        self.key = storage._normalize_name(clean_name(name))
+        self.name = self.key[len(storage.location):].lstrip("/")
+        self.mode = "rb"
+        self._client = get_client(storage)
+        if size is None or etag is None:
+            try:
+                head = self._client.head_object(Bucket=storage.bucket_name, Key=self.key)
+            except self._client.exceptions.ClientError as err:
+                if err.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                    raise OSError(errno.ENOENT, "No such file or directory", self.name)
+                raise
+            size, etag = head["ContentLength"], head["ETag"]
+        self.size = size
+        self.etag = etag
+        self._cache = cache
+        self._cached = cache.open(cache_key, etag, size) if cache is not None else None
+        self._hits_counted = False
+        self._pos = 0
+        self._chunks = {}  # chunk index -> future of bytes
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise OSError(errno.EINVAL, "Invalid argument", self.name)
+        self._pos = offset
+        return self._pos
+
+    # --------------------- chunks ---------------------
+
+    def fileno(self):
+        if self._cached is None or not self._cached.complete:
+            raise io.UnsupportedOperation("fileno")
+        if not self._hits_counted:
+            # from here on the data may be sent without going through read()
+            self._hits_counted = True
+            remaining = max(self.size - self._pos, 0)
+            self._cache.count_hits(-(-remaining // self.chunk_size), remaining)
+        return self._cached.fileno()
+
+    def _fetch(self, index):
+        if self._cached is not None:
+            data = self._cache.read(self._cached, index, count=not self._hits_counted)
+            if data is not None:
+                return data
+        data = self._download(index)
+        if self._cached is not None:
+            self._cache.write(self._cached, index, data)
+        return data
+
+    def _download(self, index):
+        start = index * self.chunk_size
+        end = min(start + self.chunk_size, self.size) - 1
+        # the request lasts until the body is read
+        with backend_request(self.storage):
+            response = self._client.get_object(
+                Bucket=self.storage.bucket_name,
+                Key=self.key,
+                Range="bytes=%d-%d" % (start, end),
+                IfMatch=self.etag,
+            )
+            return response["Body"].read()
+
+    def _schedule(self):
+        """Request the current chunk and the read-ahead window, and drop
+        chunks the position has moved away from."""
+        executor = get_transfer_executor()
+        first = self._pos // self.chunk_size
+        last = min(first + self.prefetch, (self.size - 1) // self.chunk_size)
+        for index in list(self._chunks):
+            if not first <= index <= last:
+                self._chunks.pop(index).cancel()
+        for index in range(first, last + 1):
+            if index not in self._chunks:
+                # in the context of the data channel, for FTPSERVER_QOS
+                context = contextvars.copy_context()
+                self._chunks[index] = executor.submit(context.run, self._fetch, index)
+        return self._chunks[first]
+
+    def ready(self):
+        """True when read() can return without waiting for S3."""
+        if self._closed or self._pos >= self.size:
+            return True
+        future = self._schedule()
+        if future.done() and future.exception() is not None:
+            self._raise_failed(future)
+        return future.done()
+
+    def _raise_failed(self, future):
+        raise OSError(errno.EIO, "Download from storage failed: %s" % future.exception(), self.name)
+
+    def read(self, size=-1):
+        if self._closed:
+            raise ValueError("I/O operation on closed file.")
+        if size is None or size < 0:
+            size = self.size - self._pos
+        data = []
+        while size > 0 and self._pos < self.size:
+            future = self._schedule()
+            try:
+                chunk = future.result()
+            except Exception:
+                self._raise_failed(future)
+            offset = self._pos % self.chunk_size
+            piece = chunk[offset:offset + size]
+            if not piece:
+                break
+            data.append(piece)
+            self._pos += len(piece)
+            size -= len(piece)
+        if self._pos < self.size:
+            self._schedule()
+        return b"".join(data)
+
+    def close(self):
+        if self._closed:
+            return
+        for future in self._chunks.values():
+            future.cancel()
+        self._chunks = {}
+        if self._cached is not None:
+            self._cache.release(self._cached)
+            self._cached = None
+        self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,121 @@
+"""
+Micro-benchmark of LIST and MLSD formatting (CONFIG.listing.ListingFormatter).
+
+Formats a directory of --entries entries whose metadata is in the
+metadata cache, as after a listing from S3, once with pyftpdlib's
+format_list() / format_mlsx() (a stat() per entry, as before) and once
+with the ListingFormatter, checks that both produce the same bytes and
+prints the CPU time of each. No storage request is made;
+benchmarks/check_listing.py compares what the server actually sends.
+
+    python benchmarks/bench_listing.py [--entries 100000] [--repeat 3]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings  # noqa: E402
+
+ROOT = "/srv/ftp/home"
+PERMS = "elradfmwMT"
+FACTS = ["type", "perm", "size", "modify", "unique"]
+
+
+def make_entries(count, now, seed=1):
+    from CONFIG.filesystems import ListingEntry
+
+    rnd = random.Random(seed)
+    entries = []
+    for i in range(count):
+        if i % 20 == 0:
+            entries.append(ListingEntry("dir-%06d" % i, True, 0, 0))
+        else:
+            # a year of modification times, so both LIST date formats occur
+            mtime = now - rnd.randrange(365 * 24 * 3600) + rnd.random()
+            entries.append(ListingEntry("file-%06d.dat" % i, False, rnd.randrange(10 ** 9), mtime))
+    return entries
+
+
+def make_fs(gmt):
+    from CONFIG.filesystems import StorageFS
+
+    cmd_channel = types.SimpleNamespace(
+        encoding="utf8", unicode_errors="replace", use_gmt_times=gmt, username="bench"
+    )
+    return StorageFS(ROOT, cmd_channel)
+
+
+def cpu_time(fn, *args):
+    start = time.process_time()
+    result = fn(*args)
+    return time.process_time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--localtime", action="store_true", help="format times as local times")
+    options = parser.parse_args()
+
+    settings.configure(
+        MEDIA_ROOT=ROOT,
+        DEFAULT_FILE_STORAGE="storages.backends.s3boto3.S3Boto3Storage",
+        STORAGES={"default": {"BACKEND": "storages.backends.s3boto3.S3Boto3Storage"}},
+        AWS_STORAGE_BUCKET_NAME="bench",
+        AWS_S3_REGION_NAME="us-east-1",
+        AWS_ACCESS_KEY_ID="bench",
+        AWS_SECRET_ACCESS_KEY="bench",
+        FTPSERVER_METADATA_CACHE={"MAX_ENTRIES": options.entries * 2, "MAX_LISTING_SIZE": 0},
+    )
+    import django
+
+    django.setup()
+    from CONFIG.listing import ListingFormatter
+
+    fs = make_fs(gmt=not options.localtime)
+    basedir = os.path.join(ROOT, "big")
+    entries = make_entries(options.entries, time.time())
+    names = [entry.name for entry in entries]
+    fs._remember_entries("big/", entries)
+
+    def pyftpdlib_list():
+        return b"".join(fs.format_list(basedir, names))
+
+    def pyftpdlib_mlsd():
+        return b"".join(fs.format_mlsx(basedir, names, PERMS, FACTS))
+
+    def batched(render):
+        def run():
+            return b"".join(render(entries[i:i + 512]) for i in range(0, len(entries), 512))
+        return run
+
+    results = {}
+    for name, old, new in (
+        ("LIST", pyftpdlib_list, lambda: batched(ListingFormatter(fs, basedir).format_list)()),
+        ("MLSD", pyftpdlib_mlsd, lambda: batched(ListingFormatter(fs, basedir, PERMS, FACTS).format_mlsx)()),
+    ):
+        old_times, new_times = [], []
+        for _ in range(options.repeat):
+            old_time, expected = cpu_time(old)
+            new_time, output = cpu_time(new)
+            if output != expected:
+                raise SystemExit("%s output differs" % name)
+            old_times.append(old_time)
+            new_times.append(new_time)
+        results[name] = (min(old_times), min(new_times), len(expected))
+
+    print("%d entries, identical output (best of %d, CPU time)" % (options.entries, options.repeat))
+    for name, (old_time, new_time, size) in results.items():
+        print("  %-4s %8d bytes  pyftpdlib %8.1f ms  formatter %8.1f ms  x%.1f"
+              % (name, size, old_time * 1000, new_time * 1000, old_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Micro-benchmark of StorageFS path handling (CONFIG.paths.PathTranslator).
+
+Listing a directory makes pyftpdlib stat() every entry, and each stat()
+converts the entry's path to an FTP path and a storage key several
+times. This times those conversions for a 10k-entry listing with the
+previous StorageFS implementation (copied below) and with the
+PathTranslator, for the first listing and for a repeated one, and checks
+that both give the same results.
+
+    python benchmarks/bench_paths.py [--entries 10000] [--repeat 5]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings  # noqa: E402
+
+ROOT = "/srv/ftp/home"
+MEDIA_ROOT = "/srv/ftp/media"
+# conversions made by StorageFS.stat() for an entry that is not cached yet
+CONVERSIONS_PER_STAT = 4
+
+
+class LegacyPaths:
+    """StorageFS._ensure_ftp_path() and _storage_name() before the
+    PathTranslator."""
+
+    def __init__(self, root, cwd="/"):
+        self.root = root
+        self._cwd = cwd
+
+    def _make_ftp_path(self, path):
+        if path is None or path == "":
+            return "/"
+        if path.startswith("/"):
+            return path if path != "" else "/"
+        base = self._cwd if self._cwd not in (None, "") else "/"
+        if base.endswith("/"):
+            return base + path.lstrip("/")
+        return base + "/" + path.lstrip("/")
+
+    def _ensure_ftp_path(self, path):
+        if path in (None, "", "/"):
+            return "/"
+        try:
+            if os.path.isabs(path) and self.root and os.path.normpath(path).startswith(os.path.normpath(self.root)):
+                rel = os.path.relpath(path, self.root)
+                if rel in ('.', ''):
+                    return "/"
+                return "/" + rel.replace(os.sep, "/")
+        except Exception:
+            pass
+        return self._make_ftp_path(path)
+
+    def _storage_name(self, ftp_path):
+        if ftp_path in (None, "", "/"):
+            return ""
+        if not ftp_path.startswith("/"):
+            ftp_path = "/" + ftp_path
+        name = ftp_path.lstrip("/")
+        try:
+            media_root = getattr(settings, "MEDIA_ROOT", None)
+            if media_root:
+                media_root_base = os.path.basename(os.path.normpath(media_root))
+                parts = name.split("/")
+                if media_root_base in parts:
+                    idx = parts.index(media_root_base)
+                    name = "/".join(parts[idx + 1:]) or ""
+        except Exception:
+            pass
+        return name
+
+
+def listing_paths(entries):
+    # pyftpdlib joins the real directory path and each listed name
+    return [os.path.join(ROOT, "incoming", "batch", "file-%06d.dat" % i) for i in range(entries)]
+
+
+def run_legacy(paths):
+    fs = LegacyPaths(ROOT)
+    for path in paths:
+        for _ in range(CONVERSIONS_PER_STAT):
+            fs._storage_name(fs._ensure_ftp_path(path))
+
+
+def run_translator(translator, paths):
+    for path in paths:
+        for _ in range(CONVERSIONS_PER_STAT):
+            translator.storage_name(translator.ftp_path(path, "/"))
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entries", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args()
+
+    settings.configure(MEDIA_ROOT=MEDIA_ROOT)
+    from CONFIG.paths import PathTranslator
+
+    paths = listing_paths(options.entries)
+    legacy = LegacyPaths(ROOT)
+    check = PathTranslator(ROOT, MEDIA_ROOT)
+    for path in paths + [ROOT, ROOT + "/", ROOT + "/a/../b", "relative/name", "/other/root"]:
+        expected = legacy._storage_name(legacy._ensure_ftp_path(path))
+        if check.storage_name(check.ftp_path(path, "/")) != expected:
+            raise SystemExit("result mismatch for %r" % path)
+
+    calls = options.entries * CONVERSIONS_PER_STAT
+    results = {"legacy": [], "first listing": [], "repeated listing": []}
+    for _ in range(options.repeat):
+        results["legacy"].append(timed(run_legacy, paths))
+        translator = PathTranslator(ROOT, MEDIA_ROOT)
+        results["first listing"].append(timed(run_translator, translator, paths))
+        results["repeated listing"].append(timed(run_translator, translator, paths))
+
+    print("%d entries, %d path conversions per listing (best of %d)"
+          % (options.entries, calls, options.repeat))
+    baseline = min(results["legacy"])
+    for name, times in results.items():
+        best = min(times)
+        print("  %-17s %8.2f ms  %7.0f ns/call  x%.1f"
+              % (name, best * 1000, best / calls * 1e9, baseline / best))
+
+
+if __name__ == "__main__":
+    main()
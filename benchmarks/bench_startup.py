@@ -0,0 +1,120 @@
+"""
+Cold start of `manage.py ftpserver`: seconds from launching the process
+until it serves (the "Quit the server" line), and an import-time report.
+
+Each settings module given with --settings (by default the slim profile
+the ftpserver command runs with and the full project settings) is
+started --repeat times on a free port and stopped; the fastest start is
+reported. The time includes getting the storage ready (on S3, importing
+boto3 and building the client), which the server does before serving.
+A run under `python -X importtime` then lists the top-level imports that
+took the longest, cumulatively, what they added up to and how many
+modules were imported. Run it from a configured checkout
+(CONFIG/local_settings.py); results can be saved as JSON, and
+--max-seconds fails the run when a start is slower, to catch startup
+regressions.
+
+    python benchmarks/bench_startup.py [--repeat 5] [--top 20] [--output startup.json]
+    python benchmarks/bench_startup.py --settings CONFIG.ftpserver_settings --max-seconds 1.5
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MANAGE = os.path.join(ROOT, "manage.py")
+READY = "Quit the server"
+SETTINGS = ["CONFIG.ftpserver_settings", "CONFIG.settings"]
+
+
+def start(settings_module, importtime=False, timeout=60):
+    """Start the server, wait until it serves and stop it; return the
+    seconds it took and what it wrote to stderr."""
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module, PYTHONUNBUFFERED="1")
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += [MANAGE, "ftpserver", "127.0.0.1:0", "--workers", "1"]
+    with tempfile.TemporaryFile("w+") as stderr:
+        started = time.perf_counter()
+        process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=stderr, text=True)
+        elapsed = None
+        try:
+            for line in process.stdout:
+                if READY in line:
+                    elapsed = time.perf_counter() - started
+                    break
+                if time.perf_counter() - started > timeout:
+                    break
+        finally:
+            process.send_signal(signal.SIGINT)
+        process.communicate(timeout=timeout)
+        stderr.seek(0)
+        errors = stderr.read()
+    if elapsed is None:
+        raise SystemExit("%s: the server did not start:\n%s" % (settings_module, errors[-2000:]))
+    return elapsed, errors
+
+
+def import_report(output):
+    """Return the number of modules imported according to -X importtime
+    output, and [(cumulative seconds, module)] of the top-level imports,
+    slowest first."""
+    modules = 0
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+        modules += 1
+        if name[1:2] != " ":
+            # not imported by another module
+            imports.append((int(cumulative) / 1e6, name.strip()))
+    imports.sort(reverse=True)
+    return modules, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--settings", action="append", help="settings module (repeatable)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=20, help="slowest imports listed")
+    parser.add_argument("--max-seconds", type=float, help="fail if a start takes longer")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    options = parser.parse_args()
+
+    results = {}
+    for settings_module in options.settings or SETTINGS:
+        best = min(start(settings_module)[0] for _ in range(options.repeat))
+        modules, imports = import_report(start(settings_module, importtime=True)[1])
+        total = sum(seconds for seconds, _ in imports)
+        results[settings_module] = {
+            "seconds": best,
+            "modules": modules,
+            "import_seconds": total,
+            "imports": [{"module": name, "seconds": seconds} for seconds, name in imports[:options.top]],
+        }
+        print("%s: ready in %.3f s (best of %d), %d modules, %.3f s in top-level imports (-X importtime)"
+              % (settings_module, best, options.repeat, modules, total))
+        for seconds, name in imports[:options.top]:
+            print("  %8.1f ms  %s" % (seconds * 1000, name))
+
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if options.max_seconds is not None:
+        slow = [name for name, result in results.items() if result["seconds"] > options.max_seconds]
+        if slow:
+            raise SystemExit("slower than %.3f s: %s" % (options.max_seconds, ", ".join(slow)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+End-to-end check of the LIST, NLST and MLSD output of the FTP server.
+
+Serves the same directory through the project's handler, which streams
+listings page by page and renders them with CONFIG.listing, and through
+pyftpdlib's own FTPHandler on a StorageFS that lists directories the way
+the original one did (copied below), then compares the bytes each sends,
+with a cold metadata cache and again with a warm one.
+
+The directory holds names whose order differs by name and by storage
+key ("data", "data.csv", "data-2", "data_3": S3 lists "data/" after the
+others) and --entries files "f.NNNN" followed by the directory "f", which
+S3 lists on a later page when there are more than 1000 of them.
+
+    python benchmarks/check_listing.py [--backend s3|fs] [--entries 1100]
+
+The s3 backend needs moto (pip install "moto[server]") unless
+--endpoint-url points at another S3-compatible server.
+"""
+
+import argparse
+import errno
+import ftplib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from ftpbench import BUCKET, PASSWORD, USER, configure, start_s3
+
+DIRECTORY = "check"
+COMMANDS = ("LIST", "NLST", "MLSD")
+DIRECTORIES = ("data", "b dir", "zdir")
+FILES = ("data.csv", "data-2", "data_3", "a.txt", "g")
+
+
+def legacy_fs_class():
+    from CONFIG.filesystems import StorageFS
+
+    class LegacyStorageFS(StorageFS):
+        """StorageFS listing directories as before streamed listings."""
+
+        def listdir(self, path):
+            assert isinstance(path, str), path
+            ftp_path = self._ensure_ftp_path(path)
+            key = self._storage_name(ftp_path)
+            # many storages expect '' for root
+            if key != "" and not key.endswith("/"):
+                key = key + "/"
+            try:
+                directories, files = self.storage.listdir(key)
+                # Return directory names WITHOUT trailing slash - pyftpdlib identifies
+                # directories through stat() st_mode, not through trailing slashes
+                dirs = [d.rstrip("/") for d in directories if d]
+                files = [f for f in files if f]
+                # not in the original: moto repeats the directories on every
+                # ListObjects page, S3 lists each of them once
+                dirs = list(dict.fromkeys(dirs))
+                return dirs + files
+            except FileNotFoundError:
+                raise OSError(errno.ENOENT, "No such directory", path)
+
+    return LegacyStorageFS
+
+
+def make_server(home, handler_class, fs_class):
+    """Return an FTPServer on the shared IOLoop, not serving yet."""
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.servers import FTPServer
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USER, PASSWORD, home, perm="elradfmwMT")
+    handler = type("Check" + handler_class.__name__, (handler_class,), {
+        "authorizer": authorizer,
+        "abstracted_fs": fs_class,
+    })
+    return FTPServer(("127.0.0.1", 0), handler)
+
+
+def make_tree(options, home, conf):
+    names = ["f.%04d" % i for i in range(options.entries)] + list(FILES)
+    dirs = list(DIRECTORIES) + ["f"]
+    if options.backend == "fs":
+        base = os.path.join(home, DIRECTORY)
+        for name in dirs:
+            os.makedirs(os.path.join(base, name))
+            open(os.path.join(base, name, "x"), "wb").close()
+        for name in names:
+            with open(os.path.join(base, name), "wb") as fp:
+                fp.write(name.encode())
+        return
+    import boto3
+
+    client = boto3.client(
+        "s3", endpoint_url=conf["AWS_S3_ENDPOINT_URL"], region_name="us-east-1",
+        aws_access_key_id=conf["AWS_ACCESS_KEY_ID"], aws_secret_access_key=conf["AWS_SECRET_ACCESS_KEY"],
+    )
+    client.create_bucket(Bucket=options.bucket)
+    prefix = "%s/%s/" % (conf["AWS_LOCATION"], DIRECTORY)
+    for name in dirs:
+        client.put_object(Bucket=options.bucket, Key=prefix + name + "/x", Body=b"")
+    for name in names:
+        client.put_object(Bucket=options.bucket, Key=prefix + name, Body=name.encode())
+
+
+def fetch(port, command):
+    ftp = ftplib.FTP()
+    ftp.connect("127.0.0.1", port)
+    ftp.login(USER, PASSWORD)
+    chunks = []
+    try:
+        ftp.retrbinary("%s %s" % (command, DIRECTORY), chunks.append)
+    finally:
+        ftp.quit()
+    return b"".join(chunks)
+
+
+def first_difference(expected, output):
+    for number, (old, new) in enumerate(zip(expected.splitlines(), output.splitlines()), 1):
+        if old != new:
+            return "line %d: %r != %r" % (number, old, new)
+    return "%d lines != %d lines" % (len(expected.splitlines()), len(output.splitlines()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=("s3", "fs"), default="s3")
+    parser.add_argument("--entries", type=int, default=1100, help='files "f.NNNN" listed before "f/"')
+    parser.add_argument("--setting", action="append", default=[], metavar="NAME=JSON",
+                        help="Django setting override, e.g. FTPSERVER_STORAGE_WORKERS=4")
+    parser.add_argument("--endpoint-url", help="existing S3-compatible server instead of moto")
+    parser.add_argument("--bucket", default=BUCKET)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    home = tempfile.mkdtemp(prefix="check-listing-")
+    moto = None
+    try:
+        endpoint_url = None
+        if options.backend == "s3":
+            endpoint_url, moto = start_s3(options)
+        conf = configure(options, home, endpoint_url)
+        make_tree(options, home, conf)
+
+        from pyftpdlib.handlers import FTPHandler
+
+        from CONFIG.cache import get_metadata_cache
+        from CONFIG.filesystems import StorageFS
+        from CONFIG.ftp_handler import PermissiveFTPHandler
+
+        legacy = make_server(home, FTPHandler, legacy_fs_class())
+        server = make_server(home, PermissiveFTPHandler, StorageFS)
+        # both servers are on pyftpdlib's IOLoop, run by one thread
+        threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True).start()
+        failed = False
+        try:
+            for state in ("cold", "cached"):
+                for command in COMMANDS:
+                    expected = fetch(legacy.address[1], command)
+                    if state == "cold":
+                        get_metadata_cache().clear()
+                    output = fetch(server.address[1], command)
+                    if output == expected:
+                        print("%-6s %-4s identical (%d bytes)" % (state, command, len(output)))
+                    else:
+                        failed = True
+                        print("%-6s %-4s DIFFERS: %s" % (state, command, first_difference(expected, output)))
+        finally:
+            legacy.close_all()
+            server.close_all()
+        if failed:
+            raise SystemExit(1)
+    finally:
+        if moto is not None:
+            moto.stop()
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
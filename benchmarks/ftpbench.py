@@ -0,0 +1,512 @@
+"""
+Benchmark the FTP server (pyftpdlib + CONFIG.filesystems.StorageFS)
+against a local S3 stand-in or a FileSystemStorage directory.
+
+The real server runs in this process with the project's handler. Every
+workload (STOR, LIST, MLSD, SIZE, MDTM, RETR, REST, DELE) runs on its
+own, spread over --concurrency client sessions, so the storage calls it
+causes can be attributed to it. For each one the run reports throughput,
+p50/p95/p99 latency and the backend calls per FTP command: S3 API
+requests for the s3 backend, storage method calls for both. Results can
+be saved as JSON and compared with an earlier run.
+
+    python benchmarks/ftpbench.py --backend s3 --objects 200 --concurrency 8 --output new.json
+    python benchmarks/ftpbench.py --backend fs --compare old.json
+
+MIXED runs the RETR workload while --bulk-sessions sessions of another
+user download the same objects over and over (reported as MIXED-BULK),
+to show how FTPSERVER_QOS shares the server between them:
+
+    python benchmarks/ftpbench.py --workloads STOR,MIXED --bulk-sessions 8 \
+        --setting 'FTPSERVER_QOS={"ENABLED": true, "READ_LIMIT": 20000000}'
+
+The s3 backend starts a moto server (pip install "moto[server]") unless
+--endpoint-url points at another S3-compatible server. moto runs in this
+process too, so absolute numbers include its own overhead: compare runs
+made on the same machine with the same options.
+"""
+
+import argparse
+import ftplib
+import io
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+WORKLOADS = ("STOR", "LIST", "MLSD", "SIZE", "MDTM", "RETR", "REST", "MIXED", "DELE")
+USER = "bench"
+PASSWORD = "bench"
+# user of the background sessions of MIXED
+BULK_USER = "bulk"
+BUCKET = "ftpbench"
+DIRECTORY = "bench"
+
+# storage methods counted as backend calls
+STORAGE_METHODS = ("exists", "listdir", "size", "get_modified_time", "open", "save", "delete")
+
+
+class CallCounter:
+    """Thread-safe counts of backend calls, read before and after each
+    workload."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.counts)
+
+    def count_s3_requests(self):
+        from botocore.client import BaseClient
+
+        make_api_call = BaseClient._make_api_call
+        counter = self
+
+        def counted(client, operation_name, api_params):
+            counter.add("s3." + operation_name)
+            return make_api_call(client, operation_name, api_params)
+
+        BaseClient._make_api_call = counted
+
+    def count_storage_calls(self, storage_class):
+        for name in STORAGE_METHODS:
+            method = getattr(storage_class, name)
+
+            def counted(storage, *args, _method=method, _name=name, **kwargs):
+                self.add("storage." + _name)
+                return _method(storage, *args, **kwargs)
+
+            setattr(storage_class, name, counted)
+
+
+# --------------------- environment ---------------------
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def parse_setting(text):
+    name, _, value = text.partition("=")
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def start_s3(options):
+    """Return the endpoint URL of the S3 stand-in, starting moto if needed."""
+    if options.endpoint_url:
+        return options.endpoint_url, None
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        raise SystemExit('the s3 backend needs moto: pip install "moto[server]"')
+    port = free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    return "http://127.0.0.1:%d" % port, server
+
+
+def configure(options, media_root, endpoint_url):
+    from django.conf import settings
+
+    conf = {
+        "SECRET_KEY": "ftpbench",
+        "INSTALLED_APPS": ["storages"],
+        "USE_TZ": True,
+        "TIME_ZONE": "UTC",
+        "MEDIA_ROOT": media_root,
+        "LOGGING_CONFIG": None,
+    }
+    if options.backend == "s3":
+        conf.update(
+            DEFAULT_FILE_STORAGE="CONFIG.storages.MediaStorage",
+            AWS_ACCESS_KEY_ID=os.environ.get("AWS_ACCESS_KEY_ID", "testing"),
+            AWS_SECRET_ACCESS_KEY=os.environ.get("AWS_SECRET_ACCESS_KEY", "testing"),
+            AWS_STORAGE_BUCKET_NAME=options.bucket,
+            AWS_S3_REGION_NAME="us-east-1",
+            AWS_S3_ENDPOINT_URL=endpoint_url,
+            AWS_LOCATION="ftpbench",
+            AWS_QUERYSTRING_AUTH=False,
+            AWS_DEFAULT_ACL=None,
+        )
+    else:
+        conf["DEFAULT_FILE_STORAGE"] = "django.core.files.storage.FileSystemStorage"
+    conf.update(dict(parse_setting(text) for text in options.setting))
+    settings.configure(**conf)
+
+    import django
+
+    django.setup()
+    return conf
+
+
+def start_server(home):
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.servers import FTPServer
+
+    from CONFIG.filesystems import StorageFS
+    from CONFIG.ftp_handler import PermissiveFTPHandler
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USER, PASSWORD, home, perm="elradfmwMT")
+    authorizer.add_user(BULK_USER, PASSWORD, home, perm="elradfmwMT")
+    handler = type("BenchFTPHandler", (PermissiveFTPHandler,), {
+        "authorizer": authorizer,
+        "abstracted_fs": StorageFS,
+    })
+    server = FTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True)
+    thread.start()
+    return server
+
+
+# --------------------- workloads ---------------------
+
+def connect(port, user=USER):
+    ftp = ftplib.FTP()
+    ftp.connect("127.0.0.1", port)
+    ftp.login(user, PASSWORD)
+    ftp.voidcmd("TYPE I")
+    return ftp
+
+
+def discard(data):
+    pass
+
+
+def operations(workload, options, payload):
+    """Return (function, bytes transferred) for every operation of a
+    workload; each function takes an ftplib session."""
+    names = ["%s/obj-%06d.bin" % (DIRECTORY, i) for i in range(options.objects)]
+    size = len(payload)
+    if workload == "STOR":
+        return [(lambda ftp, n=n: ftp.storbinary("STOR " + n, io.BytesIO(payload)), size) for n in names]
+    if workload == "LIST":
+        return [(lambda ftp: ftp.retrlines("LIST " + DIRECTORY, discard), 0)] * options.listings
+    if workload == "MLSD":
+        return [(lambda ftp: list(ftp.mlsd(DIRECTORY)), 0)] * options.listings
+    if workload == "SIZE":
+        return [(lambda ftp, n=n: ftp.size(n), 0) for n in names]
+    if workload == "MDTM":
+        return [(lambda ftp, n=n: ftp.voidcmd("MDTM " + n), 0) for n in names]
+    if workload in ("RETR", "MIXED"):
+        return [(lambda ftp, n=n: ftp.retrbinary("RETR " + n, discard), size) for n in names]
+    if workload == "REST":
+        offset = size // 2
+        return [(lambda ftp, n=n: ftp.retrbinary("RETR " + n, discard, rest=offset), size - offset)
+                for n in names]
+    if workload == "DELE":
+        return [(lambda ftp, n=n: ftp.delete(n), 0) for n in names]
+    raise ValueError(workload)
+
+
+def run_workload(sessions, ops):
+    """Run `ops` over the sessions; return (wall time, latencies, errors)."""
+    queue = list(reversed(ops))
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def worker(ftp):
+        while True:
+            with lock:
+                if not queue:
+                    return
+                fn, nbytes = queue.pop()
+            start = time.perf_counter()
+            try:
+                fn(ftp)
+            except ftplib.all_errors as err:
+                with lock:
+                    errors.append(str(err))
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker, args=(ftp,)) for ftp in sessions]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, errors
+
+
+def run_background(sessions, ops, stop):
+    """Run `ops` over the sessions, over and over, until `stop` is set.
+    Return the threads and the (latencies, errors) they fill."""
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def worker(ftp, offset):
+        index = offset
+        while not stop.is_set():
+            fn, nbytes = ops[index % len(ops)]
+            index += 1
+            start = time.perf_counter()
+            try:
+                fn(ftp)
+            except ftplib.all_errors as err:
+                with lock:
+                    errors.append(str(err))
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker, args=(ftp, i * len(ops) // len(sessions)))
+               for i, ftp in enumerate(sessions)]
+    for thread in threads:
+        thread.start()
+    return threads, (latencies, errors)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    # nearest rank
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100.0 * len(values)) - 1)]
+
+
+def summarise(ops, wall, latencies, errors, calls):
+    done = len(latencies)
+    transferred = sum(nbytes for fn, nbytes in ops) * done // max(len(ops), 1)
+    total_calls = sum(calls.values())
+    return {
+        "operations": done,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "seconds": round(wall, 4),
+        "ops_per_second": round(done / wall, 2) if wall else None,
+        "mb_per_second": round(transferred / wall / 1e6, 2) if wall and transferred else None,
+        "latency_ms": {
+            "p50": _ms(percentile(latencies, 50)),
+            "p95": _ms(percentile(latencies, 95)),
+            "p99": _ms(percentile(latencies, 99)),
+            "mean": _ms(sum(latencies) / done) if done else None,
+            "max": _ms(max(latencies)) if done else None,
+        },
+        "backend_calls_per_op": round(total_calls / done, 2) if done else None,
+        "backend_calls": dict(sorted(calls.items())),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def backend_calls(delta, backend):
+    """The calls that count as backend calls: S3 requests on s3, storage
+    method calls on fs."""
+    prefix = "s3." if backend == "s3" else "storage."
+    return Counter({name: n for name, n in delta.items() if name.startswith(prefix)})
+
+
+# --------------------- reporting ---------------------
+
+def print_results(report):
+    print("%s backend, %d objects of %d bytes, concurrency %d"
+          % (report["options"]["backend"], report["options"]["objects"],
+             report["options"]["size"], report["options"]["concurrency"]))
+    print("%-10s %7s %9s %8s %9s %9s %9s %10s" % (
+        "cmd", "ops", "ops/s", "MB/s", "p50 ms", "p95 ms", "p99 ms", "calls/op"))
+    for workload, result in report["results"].items():
+        latency = result["latency_ms"]
+        print("%-10s %7d %9s %8s %9s %9s %9s %10s%s" % (
+            workload, result["operations"], _fmt(result["ops_per_second"]),
+            _fmt(result["mb_per_second"]), _fmt(latency["p50"]), _fmt(latency["p95"]),
+            _fmt(latency["p99"]), _fmt(result["backend_calls_per_op"]),
+            "  (%d errors: %s)" % (result["errors"], result["first_error"]) if result["errors"] else ""))
+
+
+def print_comparison(old, new):
+    print("\nchange against %s" % (old.get("label") or "baseline"))
+    print("%-10s %12s %12s %12s" % ("cmd", "ops/s", "p95 ms", "calls/op"))
+    for workload, result in new["results"].items():
+        before = old["results"].get(workload)
+        if before is None:
+            continue
+        print("%-10s %12s %12s %12s" % (
+            workload,
+            _delta(before["ops_per_second"], result["ops_per_second"]),
+            _delta(before["latency_ms"]["p95"], result["latency_ms"]["p95"]),
+            _delta(before["backend_calls_per_op"], result["backend_calls_per_op"]),
+        ))
+
+
+def _fmt(value):
+    return "-" if value is None else "%.2f" % value
+
+
+def _delta(before, after):
+    if not before or after is None:
+        return "-"
+    return "%+.1f%%" % ((after - before) * 100.0 / before)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --------------------- main ---------------------
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=("s3", "fs"), default="s3")
+    parser.add_argument("--objects", type=int, default=100, help="objects stored, read and deleted")
+    parser.add_argument("--size", type=int, default=256 * 1024, help="bytes per object")
+    parser.add_argument("--concurrency", type=int, default=4, help="client sessions per workload")
+    parser.add_argument("--listings", type=int, default=20, help="LIST and MLSD commands per workload")
+    parser.add_argument("--bulk-sessions", type=int, default=4,
+                        help="sessions of the background user during MIXED")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="comma-separated subset of %s" % ",".join(WORKLOADS))
+    parser.add_argument("--warm", action="store_true",
+                        help="keep the metadata cache between workloads (cleared by default)")
+    parser.add_argument("--setting", action="append", default=[], metavar="NAME=JSON",
+                        help="Django setting override, e.g. FTPSERVER_STORAGE_WORKERS=4")
+    parser.add_argument("--endpoint-url", help="existing S3-compatible server instead of moto")
+    parser.add_argument("--bucket", default=BUCKET)
+    parser.add_argument("--label", help="name of this run in comparisons")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    options = parser.parse_args()
+    workloads = [w.strip().upper() for w in options.workloads.split(",") if w.strip()]
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            parser.error("unknown workload %r" % workload)
+
+    logging.basicConfig(level=logging.WARNING)
+    home = tempfile.mkdtemp(prefix="ftpbench-")
+    moto = None
+    try:
+        endpoint_url = None
+        if options.backend == "s3":
+            endpoint_url, moto = start_s3(options)
+        conf = configure(options, home, endpoint_url)
+        os.makedirs(os.path.join(home, DIRECTORY), exist_ok=True)
+
+        counter = CallCounter()
+        from CONFIG.cache import get_metadata_cache
+
+        if options.backend == "s3":
+            import boto3
+
+            client = boto3.client(
+                "s3", endpoint_url=endpoint_url, region_name="us-east-1",
+                aws_access_key_id=conf["AWS_ACCESS_KEY_ID"],
+                aws_secret_access_key=conf["AWS_SECRET_ACCESS_KEY"],
+            )
+            if moto is not None:
+                client.create_bucket(Bucket=options.bucket)
+            from storages.backends.s3 import S3Storage
+
+            counter.count_s3_requests()
+            counter.count_storage_calls(S3Storage)
+        else:
+            from django.core.files.storage import FileSystemStorage
+
+            counter.count_storage_calls(FileSystemStorage)
+
+        server = start_server(home)
+        port = server.address[1]
+        payload = os.urandom(options.size)
+        sessions = [connect(port) for _ in range(options.concurrency)]
+        results = {}
+        try:
+            for workload in workloads:
+                if not options.warm:
+                    get_metadata_cache().clear()
+                for ftp in sessions:
+                    ftp.voidcmd("TYPE I")  # retrlines() leaves sessions in ASCII
+                ops = operations(workload, options, payload)
+                before = counter.snapshot()
+                if workload == "MIXED":
+                    bulk = [connect(port, BULK_USER) for _ in range(options.bulk_sessions)]
+                    stop = threading.Event()
+                    bulk_start = time.perf_counter()
+                    threads, (bulk_latencies, bulk_errors) = run_background(bulk, ops, stop)
+                    time.sleep(0.5)  # let the bulk transfers ramp up
+                wall, latencies, errors = run_workload(sessions, ops)
+                calls = backend_calls(counter.snapshot() - before, options.backend)
+                results[workload] = summarise(ops, wall, latencies, errors, calls)
+                if workload == "MIXED":
+                    stop.set()
+                    for thread in threads:
+                        thread.join()
+                    bulk_wall = time.perf_counter() - bulk_start
+                    for ftp in bulk:
+                        ftp.quit()
+                    # backend calls are not attributed between the two users
+                    results["MIXED-BULK"] = summarise(ops, bulk_wall, bulk_latencies, bulk_errors, Counter())
+        finally:
+            for ftp in sessions:
+                try:
+                    ftp.quit()
+                except ftplib.all_errors:
+                    pass
+            server.close_all()
+
+        report = {
+            "label": options.label or "%s@%s" % (options.backend, git_revision() or "unknown"),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "options": {
+                "backend": options.backend,
+                "objects": options.objects,
+                "size": options.size,
+                "concurrency": options.concurrency,
+                "listings": options.listings,
+                "bulk_sessions": options.bulk_sessions,
+                "warm": options.warm,
+                "settings": dict(parse_setting(text) for text in options.setting),
+                "endpoint": options.endpoint_url or ("moto" if options.backend == "s3" else None),
+            },
+            "results": results,
+        }
+        print_results(report)
+        if options.output:
+            with open(options.output, "w") as out:
+                json.dump(report, out, indent=2)
+            print("\nresults written to %s" % options.output)
+        if options.compare:
+            with open(options.compare) as fp:
+                print_comparison(json.load(fp), report)
+    finally:
+        if moto is not None:
+            moto.stop()
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,9 @@ import sys
 
 def main():
     """Run administrative tasks."""
+    if sys.argv[1:2] == ['ftpserver']:
+        # only the apps the FTP server needs (CONFIG/ftpserver_settings.py)
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'CONFIG.ftpserver_settings')
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'CONFIG.settings')
     try:
         from django.core.management import execute_from_command_line
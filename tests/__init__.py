@@ -0,0 +1,9 @@
+"""
+Unit tests of the CONFIG package, run with Django's test runner from the
+project directory:
+
+    python manage.py test --settings tests.settings
+
+Tests of the S3 code paths run against moto (pip install moto) and are
+skipped when it is not installed.
+"""
@@ -0,0 +1,42 @@
+"""tests>settings.py"""
+
+# Settings of the test suite: the apps of the FTP server on an in-memory
+# SQLite database. CONFIG.settings is not used, as it needs the
+# local_settings.py of a deployment.
+
+SECRET_KEY = "tests"
+
+DEBUG = False
+
+ALLOWED_HOSTS = []
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'CONFIG',
+    'django_ftpserver',
+    'storages',
+]
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+# the hasher does not matter to the tests, only whether it is called
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+TIME_ZONE = 'UTC'
+
+USE_TZ = True
+
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# S3 storages created by the tests (see tests.utils.S3TestCase)
+AWS_ACCESS_KEY_ID = 'testing'
+AWS_SECRET_ACCESS_KEY = 'testing'
+AWS_STORAGE_BUCKET_NAME = 'tests'
+AWS_S3_REGION_NAME = 'us-east-1'
+AWS_LOCATION = 'ftp'
@@ -0,0 +1,171 @@
+"""tests>test_authorizers.py"""
+
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth import authenticate, get_user_model
+from django.test import TestCase, override_settings
+from django_ftpserver.models import FTPUserAccount, FTPUserGroup
+from pyftpdlib.authorizers import AuthenticationFailed
+
+from CONFIG.authorizers import THROTTLED_MESSAGE, CachedAccountAuthorizer, LoginThrottle
+
+
+class ClockMixin:
+
+    def start_clock(self):
+        self.now = 1000.0
+        patcher = mock.patch("CONFIG.authorizers.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class LoginThrottleTests(ClockMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.start_clock()
+
+    def test_burst_and_rate(self):
+        throttle = LoginThrottle(rate=2, burst=3)
+        self.assertEqual([throttle.take("a") for i in range(4)], [True, True, True, False])
+        # other addresses have their own bucket
+        self.assertTrue(throttle.take("b"))
+        self.now += 0.5
+        self.assertEqual([throttle.take("a") for i in range(2)], [True, False])
+        self.now += 10
+        self.assertEqual([throttle.take("a") for i in range(4)], [True, True, True, False])
+
+    def test_unlimited(self):
+        throttle = LoginThrottle(rate=0, burst=1)
+        self.assertTrue(all(throttle.take("a") for i in range(10)))
+        self.assertTrue(LoginThrottle(rate=1, burst=1).take(None))
+
+    def test_failures_block(self):
+        throttle = LoginThrottle(max_failures=3, failure_window=60, block_time=300)
+        for i in range(2):
+            throttle.failed("a")
+        self.assertFalse(throttle.blocked("a"))
+        with self.assertLogs("CONFIG.authorizers", "WARNING"):
+            throttle.failed("a")
+        self.assertTrue(throttle.blocked("a"))
+        self.assertFalse(throttle.blocked("b"))
+        self.now += 301
+        self.assertFalse(throttle.blocked("a"))
+
+    def test_failure_window(self):
+        throttle = LoginThrottle(max_failures=3, failure_window=60, block_time=300)
+        throttle.failed("a")
+        throttle.failed("a")
+        # the window started with the first failure
+        self.now += 61
+        throttle.failed("a")
+        throttle.failed("a")
+        self.assertFalse(throttle.blocked("a"))
+        with self.assertLogs("CONFIG.authorizers", "WARNING"):
+            throttle.failed("a")
+        self.assertTrue(throttle.blocked("a"))
+
+    def test_addresses_are_forgotten(self):
+        throttle = LoginThrottle(max_failures=1, max_addresses=2)
+        with self.assertLogs("CONFIG.authorizers", "WARNING"):
+            throttle.failed("a")
+            throttle.failed("b")
+            throttle.take("a")
+            throttle.failed("c")
+        self.assertTrue(throttle.blocked("a"))
+        self.assertFalse(throttle.blocked("b"))
+        self.assertTrue(throttle.blocked("c"))
+
+
+@override_settings(
+    FTPSERVER_AUTH_CACHE={"TTL": 60},
+    FTPSERVER_LOGIN_THROTTLE={"RATE": 100, "BURST": 100, "MAX_FAILURES": 3},
+)
+class CachedAccountAuthorizerTests(ClockMixin, TestCase):
+
+    def setUp(self):
+        self.start_clock()
+        self.group = FTPUserGroup.objects.create(name="users", permission="elr", home_dir="/srv/{username}")
+        self.user = get_user_model().objects.create_user("alice", password="secret")
+        self.account = FTPUserAccount.objects.create(user=self.user, group=self.group)
+        self.authorizer = CachedAccountAuthorizer()
+        self.handler = SimpleNamespace(remote_ip="10.0.0.1")
+        patcher = mock.patch("django_ftpserver.authorizers.authenticate", side_effect=authenticate)
+        self.authenticate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def login(self, password, username="alice"):
+        self.authorizer.validate_authentication(username, password, self.handler)
+
+    def test_cached_password(self):
+        self.login("secret")
+        with self.assertNumQueries(0):
+            self.login("secret")
+            self.assertEqual(self.authorizer.get_home_dir("alice"), "/srv/alice")
+            self.assertTrue(self.authorizer.has_perm("alice", "r"))
+            self.assertFalse(self.authorizer.has_perm("alice", "w"))
+        self.assertEqual(self.authenticate.call_count, 1)
+
+    def test_wrong_password(self):
+        self.login("secret")
+        with self.assertRaises(AuthenticationFailed):
+            self.login("wrong")
+        with self.assertRaises(AuthenticationFailed):
+            self.login("wrong")
+        # wrong passwords are checked every time, and do not replace the digest
+        self.assertEqual(self.authenticate.call_count, 3)
+        self.login("secret")
+        self.assertEqual(self.authenticate.call_count, 3)
+
+    def test_unknown_user(self):
+        with self.assertRaises(AuthenticationFailed):
+            self.login("secret", username="bob")
+        self.assertFalse(self.authorizer.has_user("bob"))
+        self.assertEqual(self.authorizer.get_home_dir("bob"), "")
+
+    def test_password_change(self):
+        self.login("secret")
+        self.user.set_password("changed")
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.login("secret")
+        self.login("changed")
+
+    def test_password_changed_elsewhere(self):
+        self.login("secret")
+        self.user.set_password("changed")
+        # an update without signals, as made by another process
+        get_user_model().objects.filter(pk=self.user.pk).update(password=self.user.password)
+        self.login("secret")
+        self.now += 61
+        with self.assertRaises(AuthenticationFailed):
+            self.login("secret")
+        self.login("changed")
+
+    def test_deactivated_user(self):
+        self.login("secret")
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.login("secret")
+
+    def test_group_change(self):
+        self.assertFalse(self.authorizer.has_perm("alice", "w"))
+        self.group.permission = "elradfmw"
+        self.group.save()
+        self.assertTrue(self.authorizer.has_perm("alice", "w"))
+
+    def test_account_deleted(self):
+        self.assertTrue(self.authorizer.has_user("alice"))
+        self.account.delete()
+        self.assertFalse(self.authorizer.has_user("alice"))
+
+    def test_blocked_after_failures(self):
+        with self.assertLogs("CONFIG.authorizers", "WARNING"):
+            for i in range(3):
+                with self.assertRaises(AuthenticationFailed):
+                    self.login("wrong")
+        with self.assertRaisesMessage(AuthenticationFailed, THROTTLED_MESSAGE):
+            self.login("secret")
+        self.assertEqual(self.authenticate.call_count, 3)
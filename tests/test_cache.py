@@ -0,0 +1,162 @@
+"""tests>test_cache.py"""
+
+import unittest
+from collections import namedtuple
+from unittest import mock
+
+from CONFIG.cache import NEGATIVE, MetadataCache
+
+Entry = namedtuple("Entry", "name")
+
+
+class MetadataCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("CONFIG.cache.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_cache(self, **kwargs):
+        kwargs.setdefault("ttl", 30)
+        kwargs.setdefault("negative_ttl", 5)
+        return MetadataCache(**kwargs)
+
+
+class TTLTests(MetadataCacheTestCase):
+
+    def test_stat_expires(self):
+        cache = self.make_cache()
+        cache.set_stat("a", "stat")
+        self.now += 29
+        self.assertEqual(cache.get_stat("a"), "stat")
+        self.now += 2
+        self.assertIsNone(cache.get_stat("a"))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "entries": 0})
+
+    def test_listing_expires(self):
+        cache = self.make_cache()
+        cache.set_listing("d", [Entry("x")])
+        self.assertEqual(cache.get_listing("d"), [Entry("x")])
+        self.now += 31
+        self.assertIsNone(cache.get_listing("d"))
+
+    def test_disabled(self):
+        for kwargs in ({"max_entries": 0}, {"ttl": 0}):
+            cache = self.make_cache(**kwargs)
+            self.assertFalse(cache.enabled)
+            cache.set_stat("a", "stat")
+            self.assertIsNone(cache.get_stat("a"))
+
+
+class LRUTests(MetadataCacheTestCase):
+
+    def test_oldest_entry_is_evicted(self):
+        cache = self.make_cache(max_entries=2)
+        cache.set_stat("a", 1)
+        cache.set_stat("b", 2)
+        cache.set_stat("c", 3)
+        self.assertIsNone(cache.get_stat("a"))
+        self.assertEqual(cache.get_stat("b"), 2)
+        self.assertEqual(cache.get_stat("c"), 3)
+
+    def test_lookup_keeps_an_entry(self):
+        cache = self.make_cache(max_entries=2)
+        cache.set_stat("a", 1)
+        cache.set_stat("b", 2)
+        cache.get_stat("a")
+        cache.set_listing("c", [])
+        self.assertEqual(cache.get_stat("a"), 1)
+        self.assertIsNone(cache.get_stat("b"))
+        self.assertEqual(cache.get_listing("c"), [])
+
+    def test_large_listing_is_not_cached(self):
+        cache = self.make_cache(max_listing_size=2)
+        cache.set_listing("small", [Entry("x"), Entry("y")])
+        cache.set_listing("large", [Entry("x"), Entry("y"), Entry("z")])
+        self.assertEqual(len(cache.get_listing("small")), 2)
+        self.assertIsNone(cache.get_listing("large"))
+
+
+class NegativeEntryTests(MetadataCacheTestCase):
+
+    def test_missing_key(self):
+        cache = self.make_cache()
+        cache.set_missing("a")
+        self.assertIs(cache.get_stat("a"), NEGATIVE)
+        # the negative TTL, not the TTL, applies
+        self.now += 6
+        self.assertIsNone(cache.get_stat("a"))
+
+    def test_disabled(self):
+        cache = self.make_cache(negative_ttl=0)
+        cache.set_missing("a")
+        self.assertIsNone(cache.get_stat("a"))
+
+    def test_stat_replaces_missing(self):
+        cache = self.make_cache()
+        cache.set_missing("a")
+        cache.set_stat("a", "stat")
+        self.assertEqual(cache.get_stat("a"), "stat")
+
+
+class InvalidationTests(MetadataCacheTestCase):
+
+    def test_invalidate_with_parents(self):
+        cache = self.make_cache()
+        cache.set_missing("d/e")
+        cache.set_stat("d", "dir")
+        cache.set_listing("d", [])
+        cache.set_listing("", [Entry("d")])
+        cache.set_stat("other", "stat")
+        cache.invalidate("d/e", parents=("d", ""))
+        self.assertIsNone(cache.get_stat("d/e"))
+        self.assertIsNone(cache.get_stat("d"))
+        self.assertIsNone(cache.get_listing("d"))
+        self.assertIsNone(cache.get_listing(""))
+        self.assertEqual(cache.get_stat("other"), "stat")
+
+    def test_invalidate_matching(self):
+        cache = self.make_cache()
+        for key in ("d", "d/a", "d/b/c", "d0"):
+            cache.set_stat(key, key)
+        cache.set_listing("d/b", [])
+        cache.invalidate_matching(lambda key: key == "d" or key.startswith("d/"))
+        self.assertEqual(cache.stats()["entries"], 1)
+        self.assertEqual(cache.get_stat("d0"), "d0")
+
+    def test_clear(self):
+        cache = self.make_cache()
+        cache.set_stat("a", 1)
+        cache.set_listing("", [])
+        cache.clear()
+        self.assertEqual(cache.stats()["entries"], 0)
+
+
+class ListingContainsTests(MetadataCacheTestCase):
+
+    def test_without_listing(self):
+        cache = self.make_cache()
+        self.assertIsNone(cache.listing_contains("d", "x"))
+
+    def test_listed_name(self):
+        cache = self.make_cache()
+        cache.set_listing("d", [Entry("x")])
+        self.assertTrue(cache.listing_contains("d", "x"))
+        # while the listing is valid, whatever its age
+        self.now += 29
+        self.assertTrue(cache.listing_contains("d", "x"))
+
+    def test_absent_name(self):
+        cache = self.make_cache()
+        cache.set_listing("d", [Entry("x")])
+        self.assertIs(cache.listing_contains("d", "y"), False)
+        # older than the negative TTL, an absent name is unknown
+        self.now += 6
+        self.assertIsNone(cache.listing_contains("d", "y"))
+        self.assertTrue(cache.listing_contains("d", "x"))
+
+    def test_negative_entries_disabled(self):
+        cache = self.make_cache(negative_ttl=0)
+        cache.set_listing("d", [Entry("x")])
+        self.assertIsNone(cache.listing_contains("d", "y"))
@@ -0,0 +1,282 @@
+"""tests>test_nsindex.py"""
+
+import multiprocessing
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from CONFIG import nsindex
+from CONFIG.nsindex import LEASE_TIME, NamespaceIndex
+
+from .utils import S3TestCase
+
+
+def _take_lease_in_child(path, results):
+    from storages.backends.s3 import S3Storage
+
+    results.put(NamespaceIndex(path, S3Storage())._take_lease())
+
+
+class IndexTestMixin:
+
+    def make_index(self, storage=None):
+        """Return a NamespaceIndex in a new directory; its background
+        thread is not started."""
+        if storage is None:
+            from storages.backends.s3 import S3Storage
+
+            # nothing is requested from S3 unless a test lists the bucket
+            storage = S3Storage()
+        directory = tempfile.mkdtemp(prefix="nsindex-")
+        self.addCleanup(shutil.rmtree, directory, True)
+        return NamespaceIndex(directory + "/index.sqlite3", storage)
+
+    def rows(self, index):
+        """Return {key: (size, mtime, etag, deleted, touched)}."""
+        rows = index._connection().execute("SELECT key, size, mtime, etag, deleted, touched FROM objects")
+        return {row[0]: row[1:] for row in rows}
+
+    def entries(self, index, key):
+        return [entry for batch in index.listing(key) for entry in batch]
+
+
+class ApplyTests(IndexTestMixin, unittest.TestCase):
+
+    def test_adds_updates_and_removes(self):
+        index = self.make_index()
+        index._apply("", None, None, {"a": (1, 10, "e1"), "b": (2, 20, "e2"), "c": (3, 30, "e3")}, time.time())
+        index._apply("", None, None, {"a": (4, 40, "e4"), "c": (3, 30, "e3")}, time.time())
+        self.assertEqual(self.rows(index), {"a": (4, 40, "e4", 0, 0), "c": (3, 30, "e3", 0, 0)})
+
+    def test_writes_after_the_listing_are_kept(self):
+        index = self.make_index()
+        index._apply("", None, None, {"a": (1, 10, "e1")}, time.time())
+        listed_at = time.time()
+        index.put("a", 5, "new", 50)
+        index.put("b", 6, "new", 60)
+        # the listing requested before both writes shows neither
+        index._apply("", None, None, {"a": (1, 10, "e1")}, listed_at)
+        self.assertEqual(index.lookup("a"), (False, 5, 50))
+        self.assertEqual(index.lookup("b"), (False, 6, 60))
+
+    def test_writes_before_the_listing_are_replaced(self):
+        index = self.make_index()
+        index.put("a", 5, "new", 50)
+        index.put("b", 6, "new", 60)
+        index._apply("", None, None, {"a": (1, 10, "e1")}, time.time() + 1)
+        self.assertEqual(self.rows(index), {"a": (1, 10, "e1", 0, 0)})
+
+    def test_tombstones(self):
+        index = self.make_index()
+        index._apply("", None, None, {"a": (1, 10, "e1"), "b": (2, 20, "e2")}, time.time())
+        listed_at = time.time()
+        index.delete("a")
+        index.delete("b")
+        self.assertIsNone(index.lookup("a"))
+        self.assertEqual(self.entries(index, ""), [])
+        # a listing requested before the deletes does not bring them back
+        index._apply("", None, None, {"a": (1, 10, "e1"), "b": (2, 20, "e2")}, listed_at)
+        self.assertIsNone(index.lookup("a"))
+        self.assertIsNone(index.lookup("b"))
+        # a later one confirms the delete of "a", and shows "b" was stored again
+        index._apply("", None, None, {"b": (3, 30, "e3")}, time.time() + 1)
+        self.assertEqual(self.rows(index), {"b": (3, 30, "e3", 0, 0)})
+
+    def test_page_range(self):
+        index = self.make_index()
+        keys = ["a", "b", "b0", "c", "d", "e"]
+        index._apply("", None, None, {key: (1, 1, "e") for key in keys}, time.time())
+        # a page listing (b, d]: "b0" and "d" are gone, "c" changed
+        index._apply("", "b", "d", {"c": (2, 2, "e")}, time.time())
+        self.assertEqual(sorted(self.rows(index)), ["a", "b", "c", "e"])
+        self.assertEqual(index.lookup("c"), (False, 2, 2))
+
+    def test_prefix_range(self):
+        index = self.make_index()
+        keys = ["d", "d/a", "d/b", "d/c", "d0", "e"]
+        index._apply("", None, None, {key: (1, 1, "e") for key in keys}, time.time())
+        # the first page of "d/" goes from the prefix, the last one up to
+        # its end: keys around the prefix are not touched
+        index._apply("d/", None, "d/a", {"d/a": (1, 1, "e")}, time.time())
+        index._apply("d/", "d/a", None, {"d/c": (1, 1, "e")}, time.time())
+        self.assertEqual(sorted(self.rows(index)), ["d", "d/a", "d/c", "d0", "e"])
+
+
+class ListingTests(IndexTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.index = self.make_index()
+        for key in ("a-b", "a/x", "a/y/z", "a0", "b", "dir/", "dir/f"):
+            self.index.put(key, len(key), mtime=100)
+
+    def test_directory_entries(self):
+        self.assertEqual(self.entries(self.index, ""), [
+            ("a", True, 0, 0),
+            ("dir", True, 0, 0),
+            ("a-b", False, 3, 100),
+            ("a0", False, 2, 100),
+            ("b", False, 1, 100),
+        ])
+        self.assertEqual(self.entries(self.index, "a/"), [("y", True, 0, 0), ("x", False, 3, 100)])
+        # the "dir/" marker is the directory itself, not an entry of it
+        self.assertEqual(self.entries(self.index, "dir/"), [("f", False, 5, 100)])
+
+    def test_subdirectories_are_skipped_over(self):
+        for i in range(500):
+            self.index.put("a/many/%03d" % i, 1)
+        queries = []
+        conn = self.index._connection()
+        conn.set_trace_callback(queries.append)
+        self.addCleanup(conn.set_trace_callback, None)
+        self.assertEqual([entry[0] for entry in self.entries(self.index, "")], ["a", "dir", "a-b", "a0", "b"])
+        # one query up to "a/", one from "a0" on, one from "dir0" on
+        self.assertEqual(len([query for query in queries if query.startswith("SELECT")]), 3)
+
+    def test_batches(self):
+        for i in range(5):
+            self.index.put("f%d" % i, 1, mtime=100)
+            self.index.put("g%d/x" % i, 1)
+        with mock.patch.object(nsindex, "LISTING_BATCH_SIZE", 3):
+            batches = list(self.index.listing(""))
+        self.assertEqual(sum(len(batch) for batch in batches), 15)
+        for batch in batches:
+            # directories then files, like a ListObjectsV2 page
+            self.assertEqual(batch, sorted(batch, key=lambda entry: not entry[1]))
+        keys = [[entry[0] + "/" if entry[1] else entry[0] for entry in batch] for batch in batches]
+        for previous, following in zip(keys, keys[1:]):
+            self.assertLess(max(previous), min(following))
+
+    def test_tombstones_are_not_listed(self):
+        self.index.delete("b")
+        self.index.delete("a/x")
+        self.index.delete("a/y/z")
+        self.assertEqual([entry[0] for entry in self.entries(self.index, "")], ["dir", "a-b", "a0"])
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup("a0"), (False, 2, 100))
+        self.assertEqual(self.index.lookup("a"), (True, 0, 0))
+        self.assertEqual(self.index.lookup("a/y/"), (True, 0, 0))
+        self.assertEqual(self.index.lookup(""), (True, 0, 0))
+        self.assertIsNone(self.index.lookup("a/nope"))
+        # an object wins over a directory of the same name
+        self.index.put("a", 7, mtime=100)
+        self.assertEqual(self.index.lookup("a"), (False, 7, 100))
+
+
+class LeaseTests(IndexTestMixin, unittest.TestCase):
+
+    def test_one_holder(self):
+        index = self.make_index()
+        other = NamespaceIndex(index.path, index.storage)
+        self.assertTrue(index._take_lease())
+        self.assertFalse(other._take_lease())
+        # the holder renews it
+        self.assertTrue(index._take_lease())
+        with self.assertRaises(RuntimeError):
+            other._renew_lease()
+
+    def test_expired_lease(self):
+        index = self.make_index()
+        other = NamespaceIndex(index.path, index.storage)
+        self.assertTrue(index._take_lease())
+        with mock.patch.object(nsindex.time, "time", return_value=time.time() + LEASE_TIME + 1):
+            self.assertTrue(other._take_lease())
+            self.assertFalse(index._take_lease())
+
+    def test_other_process(self):
+        index = self.make_index()
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+
+        def take_in_child():
+            child = context.Process(target=_take_lease_in_child, args=(index.path, results))
+            child.start()
+            child.join(30)
+            return results.get(timeout=5)
+
+        self.assertTrue(index._take_lease())
+        self.assertFalse(take_in_child())
+        # once the lease expires, another process takes it over
+        conn = index._connection()
+        index._set_meta(conn, "lease", "%s %f" % (index._owner, time.time() - 1))
+        self.assertTrue(take_in_child())
+        self.assertFalse(index._take_lease())
+
+
+class ReconcileTests(IndexTestMixin, S3TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.index = self.make_index(self.storage)
+
+    def test_reconcile(self):
+        self.assertFalse(self.index.ready)
+        self.put("a.txt", "d/b.txt", "d/e/c.txt")
+        self.index.reconcile()
+        self.assertTrue(self.index.ready)
+        self.assertEqual(self.index.lookup("a.txt")[:2], (False, 5))
+        self.assertEqual(self.index.lookup("d/e"), (True, 0, 0))
+        self.assertEqual([entry[0] for entry in self.entries(self.index, "d/")], ["e", "b.txt"])
+
+    def test_pages(self):
+        names = ["k%02d" % i for i in range(9)]
+        self.put(*names)
+        self.index.reconcile()
+        self.remove("k01", "k04", "k08")
+        self.put("k035")
+        with mock.patch.object(nsindex, "SCAN_PAGE_SIZE", 2):
+            self.index.reconcile()
+        self.assertEqual(sorted(self.rows(self.index)), ["k00", "k02", "k03", "k035", "k05", "k06", "k07"])
+
+    def test_location_marker(self):
+        # the "ftp/" marker of the location itself is not an object in it
+        self.client.put_object(Bucket=self.storage.bucket_name, Key="ftp/", Body=b"")
+        self.put("a")
+        with mock.patch.object(nsindex, "SCAN_PAGE_SIZE", 1):
+            self.index.reconcile()
+        self.assertEqual(list(self.rows(self.index)), ["a"])
+
+    def test_deletes_are_confirmed(self):
+        self.put("a", "b")
+        self.index.reconcile()
+        self.remove("a")
+        self.index.delete("a")
+        self.assertEqual(self.rows(self.index)["a"][3], 1)
+        self.index.reconcile()
+        self.assertEqual(list(self.rows(self.index)), ["b"])
+
+    def test_writes_during_the_listing_are_kept(self):
+        self.put("a")
+        list_objects_v2 = self.client.list_objects_v2
+
+        def list_then_write(**params):
+            response = list_objects_v2(**params)
+            self.index.put("late", 4)
+            self.index.delete("a")
+            return response
+
+        with mock.patch.object(self.client, "list_objects_v2", side_effect=list_then_write):
+            self.index.reconcile()
+        self.assertEqual(self.index.lookup("late")[:2], (False, 4))
+        self.assertIsNone(self.index.lookup("a"))
+
+    def test_refresh(self):
+        self.put("copied")
+        self.index.refresh("copied")
+        self.assertEqual(self.index.lookup("copied")[:2], (False, 6))
+        self.remove("copied")
+        self.index.refresh("copied")
+        self.assertIsNone(self.index.lookup("copied"))
+
+    def test_rescan(self):
+        self.put("d/1", "d/2", "e")
+        self.index.reconcile()
+        self.remove("d/1", "e")
+        self.put("d/3")
+        self.index.rescan("d/")
+        self.assertEqual([entry[0] for entry in self.entries(self.index, "d/")], ["2", "3"])
+        # outside the prefix, the next reconciliation catches up
+        self.assertIsNotNone(self.index.lookup("e"))
@@ -0,0 +1,90 @@
+"""tests>test_qos.py"""
+
+import threading
+import time
+import unittest
+
+from CONFIG.qos import RequestLimiter, fair_shares
+
+
+class FairSharesTests(unittest.TestCase):
+
+    def test_equal_weights(self):
+        self.assertEqual(fair_shares(90, {"a": (1, None), "b": (1, None), "c": (1, None)}),
+                         {"a": 30, "b": 30, "c": 30})
+
+    def test_weights(self):
+        self.assertEqual(fair_shares(100, {"a": (3, None), "b": (1, None)}), {"a": 75, "b": 25})
+
+    def test_caps_are_redistributed(self):
+        # "a" can only use 10 of its 30; "b" and "c" share the rest
+        self.assertEqual(fair_shares(90, {"a": (1, 10), "b": (1, None), "c": (2, None)}),
+                         {"a": 10, "b": 80 / 3, "c": 160 / 3})
+
+    def test_caps_in_turn(self):
+        # once "a" is capped, "b" is capped too at its larger share
+        self.assertEqual(fair_shares(100, {"a": (1, 10), "b": (1, 40), "c": (1, None)}),
+                         {"a": 10, "b": 40, "c": 50})
+
+    def test_everyone_capped(self):
+        self.assertEqual(fair_shares(100, {"a": (1, 10), "b": (1, 20)}), {"a": 10, "b": 20})
+
+    def test_cap_above_the_share(self):
+        self.assertEqual(fair_shares(100, {"a": (1, 60), "b": (1, None)}), {"a": 50, "b": 50})
+
+    def test_no_users(self):
+        self.assertEqual(fair_shares(100, {}), {})
+
+
+class RequestLimiterTests(unittest.TestCase):
+
+    def serve(self, requests):
+        """Queue `requests` ((label, user, weight)) one after the other on a
+        limiter of one request, held until all of them wait; return the
+        labels in the order they were served."""
+        limiter = RequestLimiter("test", 1)
+        limiter.acquire("holder", 1)
+        served = []
+        threads = []
+        for label, user, weight in requests:
+            def request(label=label, user=user, weight=weight):
+                limiter.acquire(user, weight)
+                served.append(label)
+                limiter.release()
+
+            thread = threading.Thread(target=request)
+            thread.start()
+            threads.append(thread)
+            deadline = time.monotonic() + 5
+            while len(limiter._waiting) < len(threads) and time.monotonic() < deadline:
+                time.sleep(0.001)
+            self.assertEqual(len(limiter._waiting), len(threads))
+        limiter.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(limiter.active, 0)
+        return served
+
+    def test_free_slots(self):
+        limiter = RequestLimiter("test", 2)
+        limiter.acquire("a", 1)
+        limiter.acquire("a", 1)
+        self.assertEqual(limiter.active, 2)
+        limiter.release()
+        self.assertEqual(limiter.active, 1)
+
+    def test_users_take_turns(self):
+        served = self.serve([
+            ("a1", "a", 1), ("a2", "a", 1), ("a3", "a", 1),
+            ("b1", "b", 1),
+        ])
+        # "b" queued last, but is served after one request of "a"
+        self.assertEqual(served, ["a1", "b1", "a2", "a3"])
+
+    def test_weights(self):
+        served = self.serve([
+            ("b1", "b", 1), ("b2", "b", 1),
+            ("a1", "a", 2), ("a2", "a", 2), ("a3", "a", 2), ("a4", "a", 2),
+        ])
+        # "a" is served twice as often as "b"
+        self.assertEqual(served, ["a1", "b1", "a2", "a3", "b2", "a4"])
@@ -0,0 +1,42 @@
+"""tests>test_s3ops.py"""
+
+from unittest import mock
+
+from CONFIG import s3ops
+
+from .utils import S3TestCase
+
+
+class ProbeKeyTests(S3TestCase):
+
+    def test_object(self):
+        self.put("a.txt")
+        is_dir, size, mtime = s3ops.probe_key(self.storage, "a.txt")
+        self.assertEqual((is_dir, size), (False, 5))
+        self.assertGreater(mtime, 0)
+
+    def test_marker_directory(self):
+        self.put("d/")
+        self.assertEqual(s3ops.probe_key(self.storage, "d"), (True, 0, 0))
+
+    def test_implicit_directory(self):
+        self.put("d/e/f")
+        self.assertEqual(s3ops.probe_key(self.storage, "d"), (True, 0, 0))
+        self.assertEqual(s3ops.probe_key(self.storage, "d/e"), (True, 0, 0))
+
+    def test_missing(self):
+        self.put("ab", "a-b", "a0/c")
+        self.assertIsNone(s3ops.probe_key(self.storage, "a"))
+        self.assertIsNone(s3ops.probe_key(self.storage, "d/e"))
+
+    def test_object_wins_over_directory(self):
+        self.put("a", "a/b")
+        self.assertEqual(s3ops.probe_key(self.storage, "a")[:2], (False, 1))
+
+    def test_directory_after_the_first_page(self):
+        # "a-0" .. "a-4" sort before "a/", which is not on the first page
+        self.put("a-0", "a-1", "a-2", "a-3", "a-4", "a/x")
+        with mock.patch.object(s3ops, "PROBE_MAX_KEYS", 2):
+            self.assertEqual(s3ops.probe_key(self.storage, "a"), (True, 0, 0))
+            self.remove("a/x")
+            self.assertIsNone(s3ops.probe_key(self.storage, "a"))
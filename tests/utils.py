@@ -0,0 +1,45 @@
+"""tests>utils.py"""
+
+import unittest
+
+from django.conf import settings
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+
+@unittest.skipIf(mock_aws is None, "moto is not installed")
+class S3TestCase(unittest.TestCase):
+    """
+    Test case with an empty S3 bucket (AWS_STORAGE_BUCKET_NAME) mocked by
+    moto, and `self.storage`, an S3Storage on it under AWS_LOCATION.
+    """
+
+    def setUp(self):
+        super().setUp()
+        mock = mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+        from storages.backends.s3 import S3Storage
+
+        self.storage = S3Storage()
+        self.client = self.storage.connection.meta.client
+        self.client.create_bucket(Bucket=settings.AWS_STORAGE_BUCKET_NAME)
+
+    def put(self, *names):
+        """Store an object named `name` (a storage name, under the location)
+        for every name, with the name as content."""
+        for name in names:
+            self.client.put_object(
+                Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+                Key="%s/%s" % (settings.AWS_LOCATION, name),
+                Body=name.encode(),
+            )
+
+    def remove(self, *names):
+        for name in names:
+            self.client.delete_object(
+                Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key="%s/%s" % (settings.AWS_LOCATION, name)
+            )